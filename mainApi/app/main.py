@@ -12,6 +12,7 @@ import os
 from mainApi.app.auth.routers import router as auth_router
 from mainApi.app.db.mongodb_utils import connect_to_mongo, close_mongo_connection
 from mainApi.app.images.routers import router as image_router
+from mainApi.app.tiles.routers import router as tile_router
 from mainApi.config import ALLOWED_HOSTS
 from fastapi.staticfiles import StaticFiles 
 from fastapi.responses import JSONResponse, FileResponse
@@ -71,6 +72,7 @@ app.add_event_handler("shutdown", close_mongo_connection)
 # ================= Routers  ===============
 app.include_router(auth_router)
 app.include_router(image_router)
+app.include_router(tile_router)
 
 test_router = APIRouter(
     prefix="/test",
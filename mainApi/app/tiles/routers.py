@@ -0,0 +1,146 @@
+from typing import Optional
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status
+)
+
+from mainApi.app.auth.auth import get_current_user
+from mainApi.app.auth.models.user import UserModelDB
+from mainApi.config import TILE_MAX_AGE
+from .utils import (
+    MEDIA_TYPES,
+    TILE_FORMATS,
+    TILE_SIZES,
+    MosaicTileSource,
+    get_source,
+    stitched_path
+)
+
+router = APIRouter(
+    prefix="/tiles",
+    tags=["tiles"]
+)
+
+
+def _get_source(user: UserModelDB, channel: int) -> MosaicTileSource:
+    path = stitched_path(str(user.id), channel)
+    if not path.exists():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"No stitched image for channel {channel}")
+    return get_source(path)
+
+
+def _check_tile_size(tile_size: int):
+    if tile_size not in TILE_SIZES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"tile_size must be one of {TILE_SIZES}")
+
+
+def _tile_response(request: Request, source: MosaicTileSource, r: int, col: int, row: int,
+                   tile_size: int, fmt: str, low: Optional[float], high: Optional[float],
+                   pad: bool) -> Response:
+    _check_tile_size(tile_size)
+    image_format = TILE_FORMATS.get(fmt.lower())
+    if image_format is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Tiles are served as {', '.join(TILE_FORMATS)}")
+    headers = {
+        'ETag': source.etag(r, col, row, tile_size, image_format, low, high, pad),
+        # Tiles are per user, and the mosaic may be re-stitched under the same URL.
+        'Cache-Control': f'private, max-age={TILE_MAX_AGE}',
+    }
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    try:
+        data = source.render(r, col, row, tile_size, image_format, low, high, pad)
+    except IndexError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    return Response(content=data, media_type=MEDIA_TYPES[image_format], headers=headers)
+
+
+# ============= Creating path operations ==============
+@router.get("/stitched/{channel:int}/info",
+            response_description="Size and tile levels of a stitched mosaic")
+def stitched_info(channel: int, user: UserModelDB = Depends(get_current_user)):
+    source = _get_source(user, channel)
+    return {
+        'width': source.width,
+        'height': source.height,
+        'dtype': str(source.dtype),
+        'tile_sizes': TILE_SIZES,
+        'deep_zoom_max_level': source.deep_zoom_max_level,
+        'xyz_max_zoom': {str(t): source.xyz_max_zoom(t) for t in TILE_SIZES},
+    }
+
+
+@router.get("/stitched/{channel:int}.dzi",
+            response_description="Deep Zoom descriptor of a stitched mosaic")
+def deep_zoom_descriptor(channel: int,
+                         tile_size: int = 256,
+                         tile_format: str = Query('png', alias='format'),
+                         user: UserModelDB = Depends(get_current_user)) -> Response:
+    """
+    Deep Zoom (DZI) descriptor, e.g. for OpenSeadragon. Its tiles are served from
+    /tiles/stitched/{channel}_files/{level}/{col}_{row}.{format}, and viewers
+    carry the tile_size query parameter over to the tile URLs.
+    """
+    _check_tile_size(tile_size)
+    if tile_format not in TILE_FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"format must be one of {', '.join(TILE_FORMATS)}")
+    source = _get_source(user, channel)
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"'
+        f' Format="{tile_format}" Overlap="0" TileSize="{tile_size}">'
+        f'<Size Width="{source.width}" Height="{source.height}"/>'
+        '</Image>'
+    )
+    return Response(content=xml, media_type='application/xml')
+
+
+@router.get("/stitched/{channel:int}_files/{level:int}/{col:int}_{row:int}.{fmt}",
+            response_description="Deep Zoom tile of a stitched mosaic")
+def deep_zoom_tile(request: Request, channel: int, level: int, col: int, row: int, fmt: str,
+                   tile_size: int = 256,
+                   low: Optional[float] = None,
+                   high: Optional[float] = None,
+                   user: UserModelDB = Depends(get_current_user)) -> Response:
+    """
+    Deep Zoom tile; level 0 is the whole mosaic in one pixel. Tiles are 8-bit, with
+    intensities from low to high (default: the mosaic's display window) stretched
+    to the full range.
+    """
+    source = _get_source(user, channel)
+    if level > source.deep_zoom_max_level:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"No Deep Zoom level {level}")
+    r = source.deep_zoom_max_level - level
+    return _tile_response(request, source, r, col, row, tile_size, fmt, low, high, pad=False)
+
+
+@router.get("/stitched/{channel:int}/xyz/{z:int}/{x:int}/{y:int}.{fmt}",
+            response_description="XYZ tile of a stitched mosaic")
+def xyz_tile(request: Request, channel: int, z: int, x: int, y: int, fmt: str,
+             tile_size: int = 256,
+             low: Optional[float] = None,
+             high: Optional[float] = None,
+             user: UserModelDB = Depends(get_current_user)) -> Response:
+    """
+    XYZ (slippy map) tile; zoom 0 is the whole mosaic in one tile. Edge tiles are
+    padded with black to the full tile size.
+    """
+    _check_tile_size(tile_size)
+    source = _get_source(user, channel)
+    max_zoom = source.xyz_max_zoom(tile_size)
+    if z > max_zoom:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"No zoom level {z}")
+    return _tile_response(request, source, max_zoom - z, x, y, tile_size, fmt, low, high,
+                          pad=True)
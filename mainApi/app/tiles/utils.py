@@ -0,0 +1,287 @@
+"""
+Tiles of stitched mosaics for Deep Zoom and XYZ viewers.
+
+Tiles are cut from the stitched TIFF on demand. Only the TIFF tiles or strips
+that a tile overlaps are read and decoded (uncompressed contiguous images are
+memory-mapped instead), so the cost of a tile doesn't depend on the size of
+the mosaic. Reduced levels come from the TIFF's own pyramid, which the
+stitching worker appends to every mosaic it writes. Levels missing from it are
+built by 2x2 averaging of a region of the nearest finer stored level, up to
+MAX_REDUCE_PIXELS read per tile, so the full-resolution image of a large
+mosaic is never reduced in a request.
+
+Decoded and encoded tiles are kept in an in-process LRU cache keyed by the
+file's modification time and size, so a re-stitched mosaic is never served
+from stale entries.
+"""
+import hashlib
+import io
+import math
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import cachetools
+import numpy as np
+import tifffile
+from PIL import Image
+
+from mainApi.config import CACHE_PATH, TILE_CACHE_SIZE
+
+TILE_SIZES = (256, 512)
+# URL extension -> Pillow format
+TILE_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG'}
+MEDIA_TYPES = {'PNG': 'image/png', 'JPEG': 'image/jpeg'}
+# Most pixels read from a stored level to build one tile of a missing level.
+MAX_REDUCE_PIXELS = 2 ** 22
+# Most pixels of the coarsest stored level used for the display window, which
+# is otherwise estimated from a grid of WINDOW_SAMPLES x WINDOW_SAMPLES tiles.
+MAX_WINDOW_PIXELS = 2 ** 20
+WINDOW_SAMPLES = 4
+
+
+def _sizeof(value) -> int:
+    return value.nbytes if isinstance(value, np.ndarray) else len(value)
+
+
+# Decoded tiles (arrays) and encoded responses (bytes) share one budget.
+_tile_cache = cachetools.LRUCache(maxsize=TILE_CACHE_SIZE, getsizeof=_sizeof)
+_sources = cachetools.LRUCache(maxsize=32)
+_lock = threading.Lock()
+
+
+def stitched_path(user_id: str, channel: int) -> Path:
+    """
+    Path of a mosaic channel written by the stitching worker (stitching/main.py)
+    for a user, in /cache-storage/<user>/stitched
+    """
+    return CACHE_PATH / user_id / 'stitched' / f'stitched_{channel}.tif'
+
+
+def reduce_tile(img: np.ndarray) -> np.ndarray:
+    """
+    Halve an image by averaging 2x2 blocks, as ashlar does for its pyramids.
+    Odd trailing rows and columns are averaged with themselves.
+    """
+    h, w = img.shape
+    if h % 2 or w % 2:
+        img = np.pad(img, ((0, h % 2), (0, w % 2)), mode='edge')
+    if img.dtype.kind == 'f':
+        total = img[0::2, 0::2] + img[1::2, 0::2] + img[0::2, 1::2] + img[1::2, 1::2]
+        return total / img.dtype.type(4)
+    total = img[0::2, 0::2].astype(np.int64)
+    total += img[1::2, 0::2]
+    total += img[0::2, 1::2]
+    total += img[1::2, 1::2]
+    return ((total + 2) // 4).astype(img.dtype)
+
+
+class TiffLevel:
+    """
+    One resolution level (a single-channel TIFF page) of a mosaic, read a
+    region at a time.
+    """
+
+    def __init__(self, path: Path, page: tifffile.TiffPage, byteorder: str):
+        if len(page.shape) != 2:
+            raise ValueError(f"{path} is not a single-channel image")
+        self.path = path
+        self.shape = page.shape
+        self.dtype = page.dtype
+        self._memmap = None
+        if page.is_memmappable:
+            self._memmap = np.memmap(
+                path, dtype=page.dtype.newbyteorder(byteorder), mode='r',
+                offset=page.dataoffsets[0], shape=page.shape
+            )
+        self._offsets = page.dataoffsets
+        self._counts = page.databytecounts
+        # Tiles, or strips of full rows in untiled images.
+        self._chunk = page.chunks[:2]
+        self._grid = page.chunked[:2]
+        self._decode = page.decode
+        self._jpegtables = page.jpegtables
+
+    def read(self, y1: int, y2: int, x1: int, x2: int) -> np.ndarray:
+        if self._memmap is not None:
+            return np.array(self._memmap[y1:y2, x1:x2], self.dtype)
+        out = np.zeros((y2 - y1, x2 - x1), self.dtype)
+        ch, cw = self._chunk
+        rows, cols = self._grid
+        with open(self.path, 'rb') as fh:
+            for r in range(y1 // ch, min(-(-y2 // ch), rows)):
+                for c in range(x1 // cw, min(-(-x2 // cw), cols)):
+                    i = r * cols + c
+                    if not self._counts[i]:
+                        continue  # empty chunks hold zeros
+                    fh.seek(self._offsets[i])
+                    data = fh.read(self._counts[i])
+                    segment = self._decode(data, i, jpegtables=self._jpegtables)[0]
+                    segment = segment.reshape(segment.shape[1:3])
+                    sy, sx = r * ch, c * cw
+                    ya, yb = max(y1, sy), min(y2, sy + segment.shape[0])
+                    xa, xb = max(x1, sx), min(x2, sx + segment.shape[1])
+                    out[ya - y1:yb - y1, xa - x1:xb - x1] = \
+                        segment[ya - sy:yb - sy, xa - sx:xb - sx]
+        return out
+
+
+class MosaicTileSource:
+    """
+    Deep Zoom and XYZ tiles of one stitched mosaic file.
+
+    Tiles are addressed by their reduction r (the level is 2**r times smaller
+    than the full-resolution image), column and row. Tiles at the right and
+    bottom edges are cropped to the image.
+    """
+
+    def __init__(self, path: Path):
+        stat = path.stat()
+        self.path = path
+        self.version = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+        self._levels: Dict[int, TiffLevel] = {}
+        with tifffile.TiffFile(path) as tif:
+            series = tif.series[0]
+            base = TiffLevel(path, series.levels[0].pages[0], tif.byteorder)
+            self._levels[0] = base
+            for level in series.levels[1:]:
+                level = TiffLevel(path, level.pages[0], tif.byteorder)
+                r = round(math.log2(base.shape[1] / level.shape[1]))
+                if level.shape == self.level_shape(r, base.shape):
+                    self._levels[r] = level
+        self.height, self.width = base.shape
+        self.dtype = base.dtype
+        self._window: Optional[Tuple[float, float]] = None
+
+    @staticmethod
+    def level_shape(r: int, shape: Tuple[int, int]) -> Tuple[int, int]:
+        f = 2 ** r
+        return -(-shape[0] // f), -(-shape[1] // f)
+
+    @property
+    def deep_zoom_max_level(self) -> int:
+        """Deep Zoom level of the full-resolution image (level 0 is 1x1)."""
+        return max(math.ceil(math.log2(max(self.width, self.height))), 0)
+
+    def xyz_max_zoom(self, tile_size: int) -> int:
+        """XYZ zoom of the full-resolution image (zoom 0 is a single tile)."""
+        return max(math.ceil(math.log2(max(self.width, self.height) / tile_size)), 0)
+
+    def grid(self, r: int, tile_size: int) -> Tuple[int, int]:
+        h, w = self.level_shape(r, (self.height, self.width))
+        return -(-h // tile_size), -(-w // tile_size)
+
+    def tile(self, r: int, col: int, row: int, tile_size: int) -> np.ndarray:
+        """Return a tile, raising IndexError if it is outside the image."""
+        rows, cols = self.grid(r, tile_size)
+        if r < 0 or not (0 <= row < rows and 0 <= col < cols):
+            raise IndexError(f"No tile {col},{row} at reduction {r}")
+        key = (str(self.path), self.version, r, col, row, tile_size)
+        with _lock:
+            tile = _tile_cache.get(key)
+        if tile is not None:
+            return tile
+        if r in self._levels:
+            level = self._levels[r]
+            y1, x1 = row * tile_size, col * tile_size
+            tile = level.read(
+                y1, min(y1 + tile_size, level.shape[0]),
+                x1, min(x1 + tile_size, level.shape[1])
+            )
+        else:
+            # Reduce the region of the nearest finer stored level under the
+            # tile, which is always bounded for mosaics from the worker.
+            r0 = max(level for level in self._levels if level < r)
+            level = self._levels[r0]
+            size = tile_size * 2 ** (r - r0)
+            y1, x1 = row * size, col * size
+            y2, x2 = min(y1 + size, level.shape[0]), min(x1 + size, level.shape[1])
+            if (y2 - y1) * (x2 - x1) > MAX_REDUCE_PIXELS:
+                raise IndexError(
+                    f"No stored level near reduction {r}; re-stitch the mosaic"
+                    " to add its reduced levels"
+                )
+            tile = level.read(y1, y2, x1, x2)
+            for _ in range(r - r0):
+                tile = reduce_tile(tile)
+        with _lock:
+            _tile_cache[key] = tile
+        return tile
+
+    def display_window(self) -> Tuple[float, float]:
+        """
+        Intensity range mapped to black and white in 8-bit tiles: the 0.1
+        and 99.9 percentiles of the coarsest stored level of the mosaic, or of
+        a grid of tiles spread over it when it is too large to read whole.
+        """
+        if self._window is None:
+            level = self._levels[max(self._levels)]
+            h, w = level.shape
+            if h * w <= MAX_WINDOW_PIXELS:
+                sample = level.read(0, h, 0, w)
+            else:
+                t = TILE_SIZES[0]
+                sample = np.concatenate([
+                    level.read(y, min(y + t, h), x, min(x + t, w)).ravel()
+                    for y in np.linspace(0, max(h - t, 0), WINDOW_SAMPLES, dtype=int)
+                    for x in np.linspace(0, max(w - t, 0), WINDOW_SAMPLES, dtype=int)
+                ])
+            low, high = np.percentile(sample, (0.1, 99.9))
+            self._window = float(low), float(max(high, low + 1))
+        return self._window
+
+    def etag(self, *key) -> str:
+        """ETag of a rendered tile, from the file version and the tile key."""
+        digest = hashlib.sha1(repr((self.version,) + key).encode()).hexdigest()
+        return f'"{digest[:32]}"'
+
+    def render(self, r: int, col: int, row: int, tile_size: int, fmt: str,
+               low: Optional[float] = None, high: Optional[float] = None,
+               pad: bool = False) -> bytes:
+        """
+        Return a tile encoded as an 8-bit PNG or JPEG image, with the
+        intensities between `low` and `high` (by default the display window)
+        stretched to the full range. With `pad`, edge tiles are padded with
+        black to the full tile size as XYZ viewers expect.
+        """
+        key = (str(self.path), self.version, r, col, row, tile_size, fmt, low, high, pad)
+        with _lock:
+            data = _tile_cache.get(key)
+        if data is not None:
+            return data
+        tile = self.tile(r, col, row, tile_size)
+        if low is None or high is None:
+            default_low, default_high = self.display_window()
+            low = default_low if low is None else low
+            high = default_high if high is None else high
+        scale = 255 / max(high - low, 1e-9)
+        img = np.clip((tile.astype(np.float32) - low) * scale, 0, 255).astype(np.uint8)
+        if pad and img.shape != (tile_size, tile_size):
+            full = np.zeros((tile_size, tile_size), np.uint8)
+            full[:img.shape[0], :img.shape[1]] = img
+            img = full
+        buffer = io.BytesIO()
+        if fmt == 'JPEG':
+            Image.fromarray(img).save(buffer, format=fmt, quality=90)
+        else:
+            Image.fromarray(img).save(buffer, format=fmt)
+        data = buffer.getvalue()
+        with _lock:
+            _tile_cache[key] = data
+        return data
+
+
+def get_source(path: Path) -> MosaicTileSource:
+    """
+    Return the tile source for a mosaic file, reopening it if the file has
+    changed since it was last opened.
+    """
+    stat = path.stat()
+    version = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+    with _lock:
+        source = _sources.get(str(path))
+    if source is None or source.version != version:
+        source = MosaicTileSource(path)
+        with _lock:
+            _sources[str(path)] = source
+    return source
@@ -11,6 +11,12 @@ CURRENT_STATIC = Path('/static')
 IMAGE_PATH = Path('/image-storage')
 CACHE_PATH = Path('/cache-storage')
 
+# --------------- Tile serving (mainApi/app/tiles) -----------------------
+# Memory for decoded and encoded tiles of stitched mosaics, kept in-process.
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_MB", 256)) * 2 ** 20
+# How long browsers may reuse a tile before revalidating it with its ETag.
+TILE_MAX_AGE = int(os.getenv("TILE_MAX_AGE", 60))
+
 # CACHE_PATH = Path(os.path.join(os.path.dirname(__file__), "app/static/cache-storage"))
 
 ALLOWED_HOSTS = CommaSeparatedStrings(os.getenv("ALLOWED_HOSTS", ""))
@@ -0,0 +1,369 @@
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import weakref
+import zipfile
+import numpy as np
+import networkx as nx
+import sklearn.linear_model
+
+
+class TileCache(object):
+    """LRU cache of tile images with a memory budget.
+
+    Tiles are evicted in least-recently-used order once the total size of the
+    cached arrays exceeds `max_bytes` (None means unbounded). If `spill_path`
+    is given, evicted tiles are written there as .npy files and served back as
+    read-only memory maps rather than being decoded from the source image
+    again. Spill files live in a private subdirectory that is removed when the
+    cache is closed or garbage collected.
+
+    """
+
+    def __init__(self, max_bytes=None, spill_path=None):
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+        self.spill_hits = 0
+        self._entries = collections.OrderedDict()
+        self._spilled = {}
+        self._lock = threading.Lock()
+        self._spill_dir = None
+        if spill_path is not None:
+            spill_path = pathlib.Path(spill_path)
+            spill_path.mkdir(parents=True, exist_ok=True)
+            self._spill_dir = pathlib.Path(
+                tempfile.mkdtemp(prefix='ashlar-tiles-', dir=spill_path)
+            )
+            self._finalizer = weakref.finalize(
+                self, shutil.rmtree, str(self._spill_dir), True
+            )
+
+    def get(self, key):
+        """Return the cached tile for `key`, or None if it isn't cached."""
+        with self._lock:
+            img = self._entries.get(key)
+            if img is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return img
+            path = self._spilled.get(key)
+            if path is not None:
+                self.spill_hits += 1
+                return np.load(path, mmap_mode='r')
+            self.misses += 1
+            return None
+
+    def put(self, key, img):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = img
+            self.nbytes += img.nbytes
+            if self.max_bytes is None:
+                return
+            # Always keep the newest tile even if it alone exceeds the budget.
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_img = self._entries.popitem(last=False)
+                self.nbytes -= old_img.nbytes
+                self.evictions += 1
+                if self._spill_dir is not None and old_key not in self._spilled:
+                    path = self._spill_dir / ('%s.npy' % (old_key,))
+                    np.save(path, old_img)
+                    self._spilled[old_key] = path
+                    self.spills += 1
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._spilled
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        """Drop all cached tiles and delete any spill files."""
+        with self._lock:
+            self._entries.clear()
+            self._spilled.clear()
+            self.nbytes = 0
+            if self._spill_dir is not None:
+                self._finalizer()
+
+    def __getstate__(self):
+        # Copies (e.g. for worker processes) share the budget and spill
+        # location, not the tiles. Each copy spills to a private subdirectory
+        # of its own.
+        return {'max_bytes': self.max_bytes, 'spill_path': self.spill_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'], state['spill_path'])
+
+    def __repr__(self):
+        s = (
+            '%d hits, %d misses, %d evictions, %.1f MB resident'
+            % (self.hits, self.misses, self.evictions, self.nbytes / 2**20)
+        )
+        if self._spill_dir is not None:
+            s += ', %d spilled, %d spill hits' % (self.spills, self.spill_hits)
+        return s
+
+
+def _plain(value):
+    """Return `value` with numpy scalars and arrays turned into the Python
+    numbers and lists they hold, and tuples into lists."""
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    elif isinstance(value, (tuple, list)):
+        return [_plain(v) for v in value]
+    return value
+
+
+def digest(*parts):
+    """Return the SHA-256 hex digest of `parts`.
+
+    Parts are hashed as JSON, so numpy numbers give the same digest as the
+    equal Python ones whatever their type and repr (which changed in numpy 2).
+    Parts JSON can't represent raise TypeError.
+
+    """
+    text = json.dumps(_plain(parts), separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def file_digest(path, chunk_size=2**20):
+    """Return the SHA-256 hex digest of the contents of the file at `path`."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def array_digest(img):
+    """Return the SHA-256 hex digest of an array's shape, dtype and pixels."""
+    img = np.ascontiguousarray(img)
+    h = hashlib.sha256(repr((img.shape, img.dtype.str)).encode())
+    h.update(img.data)
+    return h.hexdigest()
+
+
+def save_arrays(path, header, arrays):
+    """Save a JSON-serializable `header` and a dict of `arrays` to an .npz
+    file at `path`, through a temporary file in the same directory so readers
+    never see a partially written file."""
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, header=np.array(json.dumps(header)), **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_arrays(path):
+    """Return the header and the dict of arrays saved by `save_arrays`, or
+    None if `path` doesn't hold such a file.
+
+    Files are read without unpickling anything, so a corrupt or malicious file
+    can't run code.
+
+    """
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            header = json.loads(str(data['header']))
+            arrays = {k: data[k] for k in data.files if k != 'header'}
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+    return header, arrays
+
+
+class RegistrationCache(object):
+    """Content-addressed store of registration results on disk.
+
+    Keys are tuples of plain values (typically content digests and
+    parameters) and values arrays, numbers or tuples of them. Each entry is a
+    separate .npz file named by the digest of its key, written atomically so
+    concurrent jobs sharing `path` never see partial entries. Entries are
+    checked against their key when read, and anything else found in `path`
+    is treated as a miss.
+
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _entry_path(self, name):
+        return self.path / name[:2] / (name + '.npz')
+
+    def get(self, key, default=None):
+        name = digest(*key)
+        entry = load_arrays(self._entry_path(name))
+        value = None if entry is None else self._decode(name, *entry)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    @staticmethod
+    def _decode(name, header, arrays):
+        """Return the value of an entry, or None if it isn't one for `name`."""
+        if not isinstance(header, dict) or header.get('key') != name:
+            return None
+        count = header.get('count')
+        if not isinstance(count, int) or count < 1:
+            return None
+        names = ['arr_%d' % i for i in range(count)]
+        if set(names) != set(arrays):
+            return None
+        # 0-d arrays come back as the scalars they were saved from.
+        values = [a[()] if a.ndim == 0 else a for a in map(arrays.get, names)]
+        return tuple(values) if header.get('tuple') else values[0]
+
+    def put(self, key, value):
+        name = digest(*key)
+        is_tuple = isinstance(value, tuple)
+        values = value if is_tuple else (value,)
+        arrays = {}
+        for i, v in enumerate(values):
+            a = np.asarray(v)
+            if a.dtype.hasobject:
+                raise TypeError("can't cache %s values" % type(v).__name__)
+            arrays['arr_%d' % i] = a
+        header = {'key': name, 'tuple': is_tuple, 'count': len(values)}
+        save_arrays(self._entry_path(name), header, arrays)
+        self.writes += 1
+
+    def __repr__(self):
+        return '%d hits, %d misses, %d writes in %s' % (
+            self.hits, self.misses, self.writes, self.path
+        )
+
+
+def encode_value(value):
+    """Return the kind of a saved value and the arrays that represent it.
+
+    Handles arrays and numbers, edge registration dicts mapping (t1, t2) tile
+    pairs to (shift, error), networkx graphs and fitted linear regressions,
+    which covers the outputs of the aligner stages.
+
+    """
+    if isinstance(value, dict):
+        keys = sorted(value)
+        return 'edges', {
+            'keys': np.array(keys, dtype=int).reshape(-1, 2),
+            'shifts': np.array(
+                [value[k][0] for k in keys], dtype=float
+            ).reshape(-1, 2),
+            'errors': np.array([value[k][1] for k in keys], dtype=float),
+        }
+    elif isinstance(value, nx.Graph):
+        return 'graph', {
+            'nodes': np.array(list(value.nodes), dtype=int),
+            'edges': np.array(list(value.edges), dtype=int).reshape(-1, 2),
+        }
+    elif isinstance(value, sklearn.linear_model.LinearRegression):
+        return 'linear_model', {
+            'coef': value.coef_, 'intercept': np.asarray(value.intercept_),
+        }
+    a = np.asarray(value)
+    if a.dtype.hasobject:
+        raise TypeError("can't save %s values" % type(value).__name__)
+    return 'array', {'value': a}
+
+
+def decode_value(kind, arrays):
+    """Return the value saved by `encode_value` as `kind` and `arrays`.
+
+    Raises ValueError for unknown kinds and KeyError for missing arrays.
+
+    """
+    if kind == 'array':
+        a = arrays['value']
+        # 0-d arrays come back as the scalars they were saved from.
+        return a[()] if a.ndim == 0 else a
+    elif kind == 'edges':
+        return {
+            (int(t1), int(t2)): (shift, error)
+            for (t1, t2), shift, error
+            in zip(arrays['keys'], arrays['shifts'], arrays['errors'])
+        }
+    elif kind == 'graph':
+        graph = nx.Graph()
+        graph.add_nodes_from(arrays['nodes'].tolist())
+        graph.add_edges_from(arrays['edges'].tolist())
+        return graph
+    elif kind == 'linear_model':
+        lr = sklearn.linear_model.LinearRegression()
+        lr.coef_ = arrays['coef']
+        lr.intercept_ = arrays['intercept']
+        lr.n_features_in_ = lr.coef_.shape[-1]
+        return lr
+    raise ValueError("unknown value kind %r" % (kind,))
+
+
+class Checkpoint(object):
+    """Saved outputs of the completed stages of a multi-stage job.
+
+    `fingerprint` is a tuple of plain values identifying the job's inputs and
+    parameters. A checkpoint file written with a different fingerprint, or
+    one that can't be read, is ignored rather than resumed. The state is
+    saved with `save_arrays`, so it may only hold the values `encode_value`
+    handles.
+
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = pathlib.Path(path)
+        self.fingerprint = digest(*fingerprint)
+
+    def load(self):
+        """Return the number of completed stages and their saved state."""
+        entry = load_arrays(self.path)
+        if entry is None:
+            return 0, {}
+        header, arrays = entry
+        try:
+            if header['fingerprint'] != self.fingerprint:
+                return 0, {}
+            stages = header['stages']
+            if not isinstance(stages, int) or stages < 0:
+                return 0, {}
+            state = {}
+            for i, (name, kind) in enumerate(header['values']):
+                prefix = 'v%d_' % i
+                state[name] = decode_value(kind, {
+                    k[len(prefix):]: a for k, a in arrays.items()
+                    if k.startswith(prefix)
+                })
+        except (KeyError, TypeError, ValueError):
+            return 0, {}
+        return stages, state
+
+    def save(self, stages, state):
+        values = []
+        arrays = {}
+        for i, (name, value) in enumerate(sorted(state.items())):
+            kind, parts = encode_value(value)
+            values.append((name, kind))
+            for part, a in parts.items():
+                arrays['v%d_%s' % (i, part)] = a
+        header = {
+            'fingerprint': self.fingerprint, 'stages': stages,
+            'values': values,
+        }
+        save_arrays(self.path, header, arrays)
@@ -3,6 +3,7 @@ import pathlib
 import numpy as np
 import skimage.io
 from . import reg
+from . import cache
 
 
 # Classes for reading datasets consisting of TIFF files with a naming pattern.
@@ -116,6 +117,13 @@ class FilePatternReader(reg.Reader):
             kwargs['key'] = 0
         return skimage.io.imread(path, **kwargs)
 
+    def tile_digest(self, series, c):
+        path = self.path / self.filename(series, c)
+        digest = cache.file_digest(path)
+        if self.metadata.multi_channel_tiles:
+            digest = cache.digest(digest, c)
+        return digest
+
     def filename(self, series, c):
         row, col = self.metadata.tile_rc(series)
         return self.pattern.format(row=row, col=col, channel=c)
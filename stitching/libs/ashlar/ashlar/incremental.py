@@ -0,0 +1,240 @@
+"""Incremental re-stitching of datasets whose tiles change between runs.
+
+A `StitchState` records what one run produced: the content digest and final
+position of every tile, the edge registrations and the error threshold. Given
+the state of the previous run, `align` registers only the edges touching tiles
+that were added or replaced, keeps every other tile where it was and places the
+changed ones relative to their unchanged neighbors. The regions it returns are
+what `Mosaic.update` needs to redraw in the existing output files.
+
+"""
+import numpy as np
+import networkx as nx
+from . import cache
+
+
+def tile_keys(metadata):
+    """Return a key identifying each tile across runs.
+
+    Tile indices shift when tiles are added, so tiles are identified by their
+    nominal stage position instead.
+
+    """
+    return [tuple(p) for p in metadata.positions.tolist()]
+
+
+class StitchState(object):
+
+    # Identifies state files in their JSON header.
+    format = 'ashlar-stitch-state'
+    version = 1
+
+    def __init__(self, aligner, shape):
+        keys = tile_keys(aligner.metadata)
+        self.tile_size = tuple(aligner.metadata.size)
+        self.shape = tuple(shape)
+        self.max_error = aligner.max_error
+        self.digests = dict(zip(keys, aligner.tile_digests))
+        self.positions = dict(zip(keys, aligner.positions.tolist()))
+        self.edges = {
+            (keys[t1], keys[t2]): (shift, error)
+            for (t1, t2), (shift, error) in aligner._cache.items()
+        }
+
+    @classmethod
+    def load(cls, path):
+        """Return the state saved at `path`, or None if there is none.
+
+        Files that can't be read or fail validation are treated as missing,
+        so the next run stitches from scratch.
+
+        """
+        entry = cache.load_arrays(path)
+        if entry is None:
+            return None
+        header, arrays = entry
+        try:
+            return cls._decode(header, arrays)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @classmethod
+    def _decode(cls, header, arrays):
+        if header['format'] != cls.format or header['version'] != cls.version:
+            raise ValueError("not a version %d stitch state" % cls.version)
+        tile_size = tuple(int(s) for s in header['tile_size'])
+        shape = tuple(int(s) for s in header['shape'])
+        digests = header['digests']
+        keys = arrays['keys']
+        positions = arrays['positions']
+        edge_tiles = arrays['edge_tiles']
+        edge_shifts = arrays['edge_shifts']
+        edge_errors = arrays['edge_errors']
+        n = len(digests)
+        m = len(edge_tiles)
+        if (
+            len(tile_size) != 2 or len(shape) != 2
+            or keys.shape != (n, 2) or positions.shape != (n, 2)
+            or edge_tiles.shape != (m, 2) or edge_shifts.shape != (m, 2)
+            or edge_errors.shape != (m,)
+            or not isinstance(digests, list)
+            or not all(isinstance(d, str) for d in digests)
+            or not (np.isfinite(keys).all() and np.isfinite(positions).all())
+            or edge_tiles.dtype.kind not in 'iu'
+            or not ((edge_tiles >= 0) & (edge_tiles < n)).all()
+        ):
+            raise ValueError("inconsistent stitch state")
+        keys = [tuple(k) for k in keys.astype(float).tolist()]
+        state = cls.__new__(cls)
+        state.tile_size = tile_size
+        state.shape = shape
+        state.max_error = float(arrays['max_error'])
+        state.digests = dict(zip(keys, digests))
+        state.positions = dict(zip(keys, positions.astype(float).tolist()))
+        state.edges = {
+            (keys[t1], keys[t2]): (shift, error)
+            for (t1, t2), shift, error
+            in zip(edge_tiles.tolist(), edge_shifts.astype(float), edge_errors)
+        }
+        return state
+
+    def save(self, path):
+        """Save the state as an .npz file with a JSON header."""
+        keys = list(self.positions)
+        index = {k: i for i, k in enumerate(keys)}
+        edges = list(self.edges.items())
+        header = {
+            'format': self.format, 'version': self.version,
+            'tile_size': [int(s) for s in self.tile_size],
+            'shape': [int(s) for s in self.shape],
+            'digests': [self.digests[k] for k in keys],
+        }
+        cache.save_arrays(path, header, {
+            'keys': np.array(keys, dtype=float).reshape(-1, 2),
+            'positions': np.array(
+                [self.positions[k] for k in keys], dtype=float
+            ).reshape(-1, 2),
+            'max_error': np.array(self.max_error, dtype=float),
+            'edge_tiles': np.array(
+                [(index[k1], index[k2]) for (k1, k2), _ in edges], dtype=int
+            ).reshape(-1, 2),
+            'edge_shifts': np.array(
+                [shift for _, (shift, _) in edges], dtype=float
+            ).reshape(-1, 2),
+            'edge_errors': np.array(
+                [error for _, (_, error) in edges], dtype=float
+            ),
+        })
+
+
+def align(aligner, state):
+    """Align the tiles of an EdgeAligner incrementally.
+
+    Tiles whose content is unchanged since the run recorded in `state` keep
+    their previous positions, and only edges touching new or replaced tiles
+    are registered, against the previous error threshold. Returns the mosaic
+    regions to redraw as ((y1, x1), (y2, x2)) boxes within `state.shape`, or
+    None if the mosaic has to be rendered from scratch (no usable state, or
+    changed tiles that moved outside the previous mosaic).
+
+    """
+    metadata = aligner.metadata
+    size = metadata.size
+    if state is None or tuple(size) != state.tile_size:
+        aligner.run()
+        return None
+    keys = tile_keys(metadata)
+    digests = aligner.tile_digests
+    changed = np.array(
+        [state.digests.get(k) != d for k, d in zip(keys, digests)], dtype=bool
+    )
+    removed = set(state.positions) - set(keys)
+    if aligner.verbose:
+        print(
+            '    %d of %d tiles new or changed, %d removed'
+            % (changed.sum(), len(keys), len(removed))
+        )
+    if changed.all():
+        aligner.run()
+        return None
+    fixed = np.flatnonzero(~changed)
+    aligner.check_overlaps()
+    aligner.errors_negative_sampled = np.empty(0)
+    aligner.num_negative_samples = 0
+    aligner.max_error = state.max_error
+    # Reuse the registrations of edges between unchanged tiles.
+    for edge in aligner.neighbors_graph.edges:
+        t1, t2 = sorted(edge)
+        if changed[t1] or changed[t2]:
+            continue
+        k1, k2 = keys[t1], keys[t2]
+        if (k1, k2) in state.edges:
+            aligner._cache[t1, t2] = state.edges[k1, k2]
+        elif (k2, k1) in state.edges:
+            shift, error = state.edges[k2, k1]
+            aligner._cache[t1, t2] = (-shift, error)
+    aligner.register_all()
+    positions = solve_positions(aligner, changed, [
+        state.positions[keys[i]] for i in fixed
+    ])
+    aligner.positions = positions
+    aligner.centers = positions + size / 2
+    if (positions < 0).any() or (positions + size > state.shape).any():
+        aligner.positions -= positions.min(axis=0)
+        aligner.centers = aligner.positions + size / 2
+        return None
+    # Redraw both where the changed tiles are now and where they (and any
+    # removed tiles) were before.
+    old_keys = removed.union(
+        k for k, c in zip(keys, changed) if c and k in state.positions
+    )
+    old_positions = np.array(
+        [state.positions[k] for k in sorted(old_keys)]
+    ).reshape(-1, 2)
+    return [
+        (p, p + size) for p in np.vstack([positions[changed], old_positions])
+    ]
+
+
+def solve_positions(aligner, changed, fixed_positions):
+    """Return tile positions with only the `changed` tiles re-solved.
+
+    Unchanged tiles are pinned at `fixed_positions`. Each changed tile is
+    placed along its lowest-error path of accepted registrations from the
+    nearest unchanged tile, the way `EdgeAligner.calculate_positions` walks
+    the spanning tree from its center. Tiles with no such path are placed at
+    their nominal position plus the median correction of the unchanged tiles.
+
+    """
+    n = len(changed)
+    nominal = aligner.metadata.positions
+    fixed = np.flatnonzero(~changed)
+    positions = np.empty((n, 2))
+    positions[fixed] = fixed_positions
+    placed = ~changed
+    g = nx.Graph()
+    g.add_nodes_from(range(n))
+    g.add_weighted_edges_from(
+        (t1, t2, error)
+        for (t1, t2), (_, error) in aligner._cache.items()
+        if np.isfinite(error)
+    )
+    paths = nx.multi_source_dijkstra_path(g, set(fixed.tolist()))
+    for tile in sorted(np.flatnonzero(changed), key=lambda t: len(
+        paths.get(t, ())
+    )):
+        path = paths.get(tile)
+        if path is None:
+            continue
+        for source, dest in zip(path, path[1:]):
+            if not placed[dest]:
+                # Shifts are relative to the nominal offset between tiles.
+                shift = aligner.register_pair(source, dest)[0]
+                positions[dest] = (
+                    positions[source] + nominal[dest] - nominal[source] + shift
+                )
+                placed[dest] = True
+    if not placed.all():
+        offset = np.median(positions[fixed] - nominal[fixed], axis=0)
+        positions[~placed] = nominal[~placed] + offset
+    return positions
@@ -0,0 +1,322 @@
+"""OME-Zarr (NGFF) output.
+
+Mosaics are written as a Zarr v2 directory store in the OME-NGFF 0.4 layout:
+a group whose arrays "0", "1", ... hold the (c, y, x) image at successively
+halved resolutions, listed in the group's "multiscales" attribute. Each chunk
+is one square block of one channel in a file of its own, so a region of any
+level can be read with I/O proportional to its size, and chunks can be encoded
+and written in parallel.
+
+The store is written directly following the Zarr and NGFF specifications, so
+the zarr package isn't needed to produce it.
+
+"""
+import os
+import sys
+import json
+import shutil
+import zlib
+import collections
+import numpy as np
+from . import parallel
+from . import pyramid
+
+NGFF_VERSION = '0.4'
+
+# Chunk compressors with standard Zarr codec ids. zstd needs the imagecodecs
+# package.
+COMPRESSION_METHODS = ('none', 'zlib', 'zstd')
+
+
+def check_compression(method):
+    """Raise ValueError unless `method` can be used to compress chunks."""
+    if method not in COMPRESSION_METHODS:
+        raise ValueError(
+            "NGFF compression must be one of %s"
+            % ', '.join(COMPRESSION_METHODS)
+        )
+    if method == 'zstd':
+        try:
+            import imagecodecs
+            available = imagecodecs.ZSTD.available
+        except (ImportError, AttributeError):
+            available = False
+        if not available:
+            raise ValueError("zstd compression requires imagecodecs")
+
+
+def _write_json(path, obj):
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=4)
+
+
+class ZarrArray(object):
+    """A Zarr v2 array of shape (c, y, x) with one channel per chunk."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, '.zarray')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.fill_value = meta['fill_value']
+        compressor = meta['compressor']
+        self.compression = 'none' if compressor is None else compressor['id']
+        check_compression(self.compression)
+
+    @classmethod
+    def create(cls, path, shape, chunks, dtype, compression='none'):
+        check_compression(compression)
+        os.makedirs(path, exist_ok=True)
+        compressor = None
+        if compression == 'zlib':
+            compressor = {'id': 'zlib', 'level': 6}
+        elif compression == 'zstd':
+            compressor = {'id': 'zstd', 'level': 3}
+        _write_json(os.path.join(path, '.zarray'), {
+            'zarr_format': 2,
+            'shape': [int(s) for s in shape],
+            'chunks': [int(c) for c in chunks],
+            'dtype': np.dtype(dtype).str,
+            'compressor': compressor,
+            'fill_value': 0,
+            'order': 'C',
+            'filters': None,
+            'dimension_separator': '/',
+        })
+        return cls(path)
+
+    def resize(self, num_channels):
+        """Change the number of channels recorded in the array metadata."""
+        meta_path = os.path.join(self.path, '.zarray')
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta['shape'][0] = num_channels
+        _write_json(meta_path, meta)
+        self.shape = (num_channels,) + self.shape[1:]
+
+    @property
+    def grid(self):
+        """Number of chunks along y and x."""
+        return tuple(
+            -(-s // c) for s, c in zip(self.shape[1:], self.chunks[1:])
+        )
+
+    def _chunk_path(self, c, iy, ix):
+        return os.path.join(self.path, str(c), str(iy), str(ix))
+
+    def write_chunk(self, c, iy, ix, block):
+        """Write one chunk, padding blocks at the bottom and right edges."""
+        if block.shape != self.chunks[1:]:
+            full = np.full(self.chunks[1:], self.fill_value, self.dtype)
+            full[:block.shape[0], :block.shape[1]] = block
+            block = full
+        data = np.ascontiguousarray(block, self.dtype).tobytes()
+        if self.compression == 'zlib':
+            data = zlib.compress(data, 6)
+        elif self.compression == 'zstd':
+            import imagecodecs
+            data = imagecodecs.zstd_encode(data, 3)
+        path = self._chunk_path(c, iy, ix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read_chunk(self, c, iy, ix):
+        try:
+            with open(self._chunk_path(c, iy, ix), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            # Zarr leaves chunks that hold only the fill value unwritten.
+            return np.full(self.chunks[1:], self.fill_value, self.dtype)
+        if self.compression == 'zlib':
+            data = zlib.decompress(data)
+        elif self.compression == 'zstd':
+            import imagecodecs
+            data = imagecodecs.zstd_decode(data)
+        return np.frombuffer(data, self.dtype).reshape(self.chunks[1:])
+
+    def read_rows(self, c, y1, y2):
+        """Return rows `y1` to `y2` of channel `c`."""
+        ch = self.chunks[1]
+        rows, cols = self.grid
+        first = y1 // ch
+        strip = np.concatenate([
+            np.hstack([self.read_chunk(c, iy, ix) for ix in range(cols)])
+            for iy in range(first, min(-(-y2 // ch), rows))
+        ])
+        return strip[y1 - first * ch:y2 - first * ch, :self.shape[2]]
+
+
+def create(path):
+    """Create an empty store at `path`, replacing an earlier NGFF store."""
+    if os.path.exists(path):
+        if not os.path.exists(os.path.join(path, '.zgroup')):
+            raise ValueError("%s exists and is not a Zarr store" % path)
+        shutil.rmtree(path)
+    os.makedirs(path)
+    _write_json(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+
+
+def write_channel(
+    path, blocks, shape, dtype, chunk_size, compression='none', workers=None
+):
+    """Append a channel to the full-resolution array of the store at `path`.
+
+    `blocks` must yield the image in row-major order as blocks of
+    `chunk_size` pixels, as for `utils.imsave_blocks`. Chunks are encoded and
+    written on `workers` threads while later blocks are being produced.
+    Returns the index of the new channel.
+
+    """
+    shape = tuple(shape)
+    array_path = os.path.join(path, '0')
+    if os.path.exists(os.path.join(array_path, '.zarray')):
+        array = ZarrArray(array_path)
+        if (
+            array.shape[1:] != shape or array.dtype != dtype
+            or array.chunks[1:] != (chunk_size, chunk_size)
+        ):
+            raise ValueError(
+                "%s does not hold %s %s images with %d pixel chunks"
+                % (path, shape, np.dtype(dtype), chunk_size)
+            )
+    else:
+        array = ZarrArray.create(
+            array_path, (0,) + shape, (1, chunk_size, chunk_size), dtype,
+            compression
+        )
+    channel = array.shape[0]
+    cols = array.grid[1]
+    if workers is None:
+        workers = parallel.default_workers()
+    # Limit the blocks waiting to be written so memory use stays bounded.
+    pending = collections.deque()
+    with parallel.build_executor('thread', workers) as executor:
+        for i, block in enumerate(blocks):
+            pending.append(executor.submit(
+                array.write_chunk, channel, i // cols, i % cols, block
+            ))
+            while len(pending) > 2 * workers:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+    # Only count the channel once all of its chunks are on disk.
+    array.resize(channel + 1)
+    return channel
+
+
+class LevelReducer(object):
+    """Computes rows of chunks of the reduced levels of a store.
+
+    Instances only hold the store path, so they are cheap to send to process
+    pool workers.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def reduce_band(self, level, channel, iy):
+        """Compute row `iy` of the chunks of `level` from the level above."""
+        src = ZarrArray(os.path.join(self.path, str(level - 1)))
+        dst = ZarrArray(os.path.join(self.path, str(level)))
+        ch, cw = dst.chunks[1:]
+        y1, y2 = iy * ch, min((iy + 1) * ch, dst.shape[1])
+        band = pyramid.reduce_block(
+            src.read_rows(channel, 2 * y1, min(2 * y2, src.shape[1]))
+        )
+        for ix, x in enumerate(range(0, dst.shape[2], cw)):
+            dst.write_chunk(channel, iy, ix, band[:, x:x + cw])
+
+
+def update_levels(path, channel, rows):
+    """Recompute the reduced levels of a channel of the store at `path`.
+
+    `rows` are the rows of chunks of the full-resolution array that changed.
+    Only the rows of chunks of each existing reduced level that cover them
+    are recomputed, from the level above, so the levels match what
+    `build_multiscales` would build.
+
+    """
+    reducer = LevelReducer(path)
+    level = 1
+    while os.path.exists(os.path.join(path, str(level), '.zarray')):
+        # All levels share one chunk size, so each row of chunks is reduced
+        # from two rows of the level above.
+        rows = sorted({iy // 2 for iy in rows})
+        for iy in rows:
+            reducer.reduce_band(level, channel, iy)
+        level += 1
+
+
+def build_multiscales(
+    path, pixel_size, levels=True, verbose=False, executor='serial',
+    workers=None
+):
+    """Add the reduced levels and the NGFF metadata to the store at `path`.
+
+    If `levels` is true, levels are added until one fits in a single chunk,
+    each computed by 2x2 averaging of the one above in bands of chunks on a
+    worker pool. Otherwise the store only describes the full-resolution
+    array.
+
+    """
+    base = ZarrArray(os.path.join(path, '0'))
+    num_channels = base.shape[0]
+    shapes = [base.shape[1:]]
+    if levels:
+        shapes = pyramid.level_shapes(base.shape[1:], max(base.chunks[1:]))
+    for level, shape in enumerate(shapes[1:], 1):
+        level_path = os.path.join(path, str(level))
+        if os.path.exists(level_path):
+            shutil.rmtree(level_path)
+        ZarrArray.create(
+            level_path, (num_channels,) + shape, base.chunks, base.dtype,
+            base.compression
+        )
+    progress = None
+    if verbose:
+        def progress(done, total):
+            sys.stdout.write('\r        reducing band %d/%d' % (done, total))
+            sys.stdout.flush()
+    with parallel.WorkerPool(LevelReducer(path), executor, workers) as pool:
+        for level, shape in enumerate(shapes[1:], 1):
+            if verbose:
+                print("    Level %d:" % level)
+            tasks = [
+                (level, c, iy)
+                for c in range(num_channels)
+                for iy in range(-(-shape[0] // base.chunks[1]))
+            ]
+            _, stats = pool.map('reduce_band', tasks, progress=progress)
+            if verbose:
+                print()
+                print('        reduced %r' % stats)
+    datasets = []
+    for level in range(len(shapes)):
+        scale = pixel_size * 2 ** level
+        datasets.append({
+            'path': str(level),
+            'coordinateTransformations': [
+                {'type': 'scale', 'scale': [1.0, scale, scale]}
+            ],
+        })
+    _write_json(os.path.join(path, '.zattrs'), {
+        'multiscales': [{
+            'version': NGFF_VERSION,
+            'name': os.path.basename(os.path.normpath(path)),
+            'axes': [
+                {'name': 'c', 'type': 'channel'},
+                {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+                {'name': 'x', 'type': 'space', 'unit': 'micrometer'},
+            ],
+            'datasets': datasets,
+            'type': 'mean',
+            'metadata': {
+                'description': '2x2 box averaging',
+                'method': 'ashlar.pyramid.reduce_block',
+            },
+        }],
+    })
@@ -0,0 +1,232 @@
+import os
+import time
+import concurrent.futures
+import multiprocessing
+import multiprocessing.shared_memory
+import numpy as np
+
+
+# Worker-pool backends for the embarrassingly parallel stages of alignment and
+# mosaic assembly. All backends run the same per-task code on the same inputs,
+# so results never depend on which backend or how many workers were used.
+
+EXECUTORS = ('serial', 'thread', 'process')
+
+
+class SerialExecutor(concurrent.futures.Executor):
+    """Executor that runs each task immediately in the calling thread."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        return future
+
+
+def default_workers():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def build_executor(kind, workers=None, initializer=None, initargs=()):
+    if kind not in EXECUTORS:
+        raise ValueError(
+            "executor must be one of %s, not %r" % (', '.join(EXECUTORS), kind)
+        )
+    if workers is None:
+        workers = default_workers()
+    if kind == 'serial':
+        if initializer is not None:
+            initializer(*initargs)
+        return SerialExecutor()
+    elif kind == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(
+            workers, initializer=initializer, initargs=initargs
+        )
+    else:
+        # Always spawn rather than fork: the parent may hold a running JVM
+        # (BioformatsReader) or other thread state that is unsafe to fork.
+        return concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=initializer, initargs=initargs
+        )
+
+
+class PoolStats(object):
+    """Timing summary for one batch of tasks run through a worker pool."""
+
+    def __init__(self, num_tasks, workers, wall, busy):
+        self.num_tasks = num_tasks
+        self.workers = workers
+        self.wall = wall
+        self.busy = busy
+
+    @property
+    def speedup(self):
+        """Total task CPU time divided by elapsed time, i.e. the estimated
+        speedup over running the same tasks serially."""
+        return self.busy / self.wall if self.wall > 0 else 1.0
+
+    def __add__(self, other):
+        return PoolStats(
+            self.num_tasks + other.num_tasks, max(self.workers, other.workers),
+            self.wall + other.wall, self.busy + other.busy
+        )
+
+    def __repr__(self):
+        return (
+            '%d tasks in %.2fs on %d worker(s) (%.1fx speedup)'
+            % (self.num_tasks, self.wall, self.workers, self.speedup)
+        )
+
+
+# Target object for method calls in process pool workers, installed once per
+# worker by the pool initializer so it is only pickled once per process.
+_worker_target = None
+
+
+def _initialize_worker(target):
+    global _worker_target
+    _worker_target = target
+
+
+def _call_batch(target, method, batch):
+    if target is None:
+        target = _worker_target
+    fn = getattr(target, method)
+    results = []
+    # Measure CPU time rather than elapsed time so that tasks competing for
+    # cores in an oversubscribed pool don't inflate the speedup estimate.
+    start = time.thread_time()
+    for args in batch:
+        results.append(fn(*args))
+    return results, time.thread_time() - start
+
+
+class WorkerPool(object):
+    """Pool of workers for making many method calls on a single object.
+
+    For the process executor, `worker_target` (default `target`) is pickled
+    once into each worker and calls are made on that copy instead of `target`.
+    The pool stays up until `close` is called, so it can be reused for several
+    rounds of `map`.
+
+    """
+
+    def __init__(
+        self, target, executor='serial', workers=None, worker_target=None
+    ):
+        if workers is None:
+            workers = default_workers()
+        if executor == 'serial':
+            workers = 1
+        self.workers = workers
+        if executor == 'process':
+            if worker_target is None:
+                worker_target = target
+            self._executor = build_executor(
+                executor, workers, _initialize_worker, (worker_target,)
+            )
+            self._target = None
+        else:
+            self._executor = build_executor(executor, workers)
+            self._target = target
+
+    def map(self, method, arglist, batch_size=None, progress=None):
+        """Call ``target.method(*args)`` for each tuple in `arglist`.
+
+        Results are returned in `arglist` order along with a PoolStats
+        instance. Tasks are dispatched in batches of `batch_size` to amortize
+        the per-task overhead. If given, `progress` is called as
+        ``progress(done, total)`` whenever a batch completes.
+
+        """
+        arglist = list(arglist)
+        n = len(arglist)
+        if batch_size is None:
+            batch_size = max(1, n // (self.workers * 4))
+        batches = [
+            arglist[i:i + batch_size] for i in range(0, n, batch_size)
+        ]
+        results = [None] * len(batches)
+        busy = 0
+        done = 0
+        start = time.perf_counter()
+        futures = {
+            self._executor.submit(_call_batch, self._target, method, batch): i
+            for i, batch in enumerate(batches)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            results[i], batch_time = future.result()
+            busy += batch_time
+            done += len(results[i])
+            if progress is not None:
+                progress(done, n)
+        wall = time.perf_counter() - start
+        results = [r for batch_results in results for r in batch_results]
+        return results, PoolStats(n, self.workers, wall, busy)
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def map_method(
+    target, method, arglist, executor='serial', workers=None,
+    worker_target=None, batch_size=None, progress=None
+):
+    """Run a single `WorkerPool.map` on a temporary pool."""
+    with WorkerPool(target, executor, workers, worker_target) as pool:
+        return pool.map(method, arglist, batch_size, progress)
+
+
+class SharedArray(object):
+    """Numpy array in a named shared memory block.
+
+    Pickling a SharedArray transfers only the block name, so worker processes
+    attach to the same memory rather than receiving a copy of the data. The
+    creating process owns the block and must call `close` to release it.
+
+    """
+
+    def __init__(self, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self._shm = multiprocessing.shared_memory.SharedMemory(
+            create=True, size=nbytes
+        )
+        self._owner = True
+        self._attach_array()
+
+    def _attach_array(self):
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        return self.shape, self.dtype, self._shm.name
+
+    def __setstate__(self, state):
+        self.shape, self.dtype, name = state
+        # Spawned workers share the parent's resource tracker, so attaching
+        # here doesn't risk the block being unlinked when a worker exits.
+        self._shm = multiprocessing.shared_memory.SharedMemory(name=name)
+        self._owner = False
+        self._attach_array()
+
+    def close(self):
+        self.array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,443 @@
+"""Streaming construction of the reduced levels of pyramidal OME-TIFFs.
+
+The full-resolution level of each channel is read back one row of tiles at a
+time and every lower level is built from it in the same pass, by repeated 2x2
+box averaging in integer arithmetic. Memory use therefore depends on the image
+width and tile size but not on the image height or the number of levels.
+
+All of a level's channels come before the next level in the file, so only the
+first reduced level can be written as it is produced. The levels below it are
+held in temporary memory-mapped files next to the output until their turn.
+
+On a thread or process pool, each level is instead computed in bands of rows
+for all channels at once, from the level above it in the file or in its
+temporary file, and then written.
+
+"""
+import os
+import sys
+import time
+import tempfile
+import collections
+import numpy as np
+from . import utils
+from . import parallel
+
+
+def level_shapes(shape, tile_size):
+    """Return the shapes of all pyramid levels for a base image `shape`.
+
+    Each level is half the size of the one above, rounded up, and levels are
+    added until one fits in a single tile.
+
+    """
+    shapes = [tuple(shape)]
+    while any(s > tile_size for s in shapes[-1]):
+        shapes.append(tuple((np.array(shapes[-1]) + 1) // 2))
+    return shapes
+
+
+def reduce_block(img):
+    """Reduce an image by 2 in each dimension by averaging 2x2 blocks.
+
+    Odd trailing rows and columns are averaged with themselves. Integer images
+    are summed in a 32 or 64-bit accumulator and rounded back, so the result
+    has the dtype of the input without any float64 temporaries.
+
+    """
+    h, w = img.shape
+    if h % 2 or w % 2:
+        img = np.pad(img, ((0, h % 2), (0, w % 2)), mode='edge')
+    dtype = img.dtype
+    if dtype.kind == 'f':
+        total = img[0::2, 0::2] + img[1::2, 0::2]
+        total += img[0::2, 1::2]
+        total += img[1::2, 1::2]
+        return total / dtype.type(4)
+    acc = np.int32 if dtype.itemsize <= 2 else np.int64
+    total = img[0::2, 0::2].astype(acc)
+    total += img[1::2, 0::2]
+    total += img[0::2, 1::2]
+    total += img[1::2, 1::2]
+    total += 2
+    total //= 4
+    return total.astype(dtype)
+
+
+class Reducer(object):
+    """Reduces an image that arrives as strips of rows.
+
+    Each reduced strip is passed to `output` (a callable) as soon as the rows
+    for it have arrived, and pushed on to the `next` Reducer if there is one,
+    so a chain of Reducers builds a whole pyramid in one pass over the base
+    image.
+
+    """
+
+    def __init__(self, output, next=None):
+        self.output = output
+        self.next = next
+        self._carry = None
+
+    def push(self, strip):
+        if self._carry is not None:
+            strip = np.concatenate([self._carry, strip])
+            self._carry = None
+        if len(strip) % 2:
+            self._carry = strip[-1:]
+            strip = strip[:-1]
+        if len(strip):
+            self._emit(reduce_block(strip))
+
+    def close(self):
+        if self._carry is not None:
+            self._emit(reduce_block(self._carry))
+            self._carry = None
+        if self.next is not None:
+            self.next.close()
+
+    def _emit(self, reduced):
+        self.output(reduced)
+        if self.next is not None:
+            self.next.push(reduced)
+
+
+class RowWriter(object):
+    """Callable that stores successive strips of rows into an array."""
+
+    def __init__(self, array):
+        self.array = array
+        self.row = 0
+
+    def __call__(self, strip):
+        self.array[self.row:self.row + len(strip)] = strip
+        self.row += len(strip)
+
+
+def read_tiles(page, rows, cols):
+    """Return the region of a tiled TIFF page covered by some of its tiles.
+
+    `rows` and `cols` are ranges of tile indices, clipped to the page, and
+    the region is cropped to the image.
+
+    """
+    if not page.is_tiled:
+        raise ValueError("Pyramid levels must be tiled TIFF pages")
+    h, w = page.shape
+    th, tw = page.tilelength, page.tilewidth
+    num_rows, num_cols = page.chunked
+    rows = range(rows.start, min(rows.stop, num_rows))
+    cols = range(cols.start, min(cols.stop, num_cols))
+    region = np.empty((len(rows) * th, len(cols) * tw), page.dtype)
+    fh = page.parent.filehandle
+    for y, r in enumerate(rows):
+        for x, c in enumerate(cols):
+            i = r * num_cols + c
+            fh.seek(page.dataoffsets[i])
+            data = fh.read(page.databytecounts[i])
+            segment, _, _ = page.decode(data, i, jpegtables=page.jpegtables)
+            region[y * th:(y + 1) * th, x * tw:(x + 1) * tw] = \
+                segment.reshape(th, tw)
+    return region[:h - rows.start * th, :w - cols.start * tw]
+
+
+def read_strips(page, start=0, stop=None):
+    """Yield rows `start` to `stop` of the tiles of a tiled TIFF page.
+
+    Each row of tiles is read and decoded separately, so only one is in
+    memory at a time.
+
+    """
+    if not page.is_tiled:
+        raise ValueError("Pyramid base levels must be tiled TIFF pages")
+    rows, cols = page.chunked
+    stop = rows if stop is None else min(stop, rows)
+    for r in range(start, stop):
+        yield read_tiles(page, range(r, r + 1), range(cols))
+
+
+def rechunk(strips, height):
+    """Regroup strips of rows into strips of `height` rows.
+
+    The last strip may be shorter.
+
+    """
+    pending = []
+    count = 0
+    for strip in strips:
+        pending.append(strip)
+        count += len(strip)
+        while count >= height:
+            rows = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            yield rows[:height]
+            rest = rows[height:]
+            pending = [rest] if len(rest) else []
+            count = len(rest)
+    if count:
+        yield np.concatenate(pending)
+
+
+def strip_blocks(strips, tile_size):
+    """Yield the tiles of an image given as strips of `tile_size` rows."""
+    for strip in strips:
+        for x in range(0, strip.shape[1], tile_size):
+            yield strip[:, x:x + tile_size]
+
+
+def array_strips(array, height):
+    """Yield an array as strips of `height` rows."""
+    for y in range(0, len(array), height):
+        yield np.asarray(array[y:y + height])
+
+
+def reduce_channel(page, tile_size, spills):
+    """Yield the tiles of the first reduced level of one channel.
+
+    The levels below it are written into the arrays in `spills`, one per
+    level from the second reduced level down, while the tiles are consumed.
+
+    """
+    pending = collections.deque()
+    reducer = None
+    for spill in reversed(spills):
+        reducer = Reducer(RowWriter(spill), reducer)
+    reducer = Reducer(pending.append, reducer)
+
+    def level1_strips():
+        for strip in read_strips(page):
+            reducer.push(strip)
+            while pending:
+                yield pending.popleft()
+        reducer.close()
+        while pending:
+            yield pending.popleft()
+
+    return strip_blocks(rechunk(level1_strips(), tile_size), tile_size)
+
+
+class BandReducer(object):
+    """Computes bands of rows of pyramid levels from the level above.
+
+    The base level is read from the TIFF file at `path` and the reduced levels
+    are kept in memory-mapped files in `spill_dir`. Instances only hold file
+    names, so they are cheap to send to process pool workers.
+
+    """
+
+    def __init__(self, path, shapes, dtype, spill_dir):
+        self.path = path
+        self.shapes = shapes
+        self.dtype = np.dtype(dtype)
+        self.spill_dir = spill_dir
+
+    def level(self, level, channel, mode='r'):
+        """Return a reduced level of a channel as a memory-mapped array."""
+        return np.memmap(
+            os.path.join(self.spill_dir, 'c%d_l%d.raw' % (channel, level)),
+            self.dtype, mode, shape=self.shapes[level]
+        )
+
+    def reduce_band(self, level, channel, y1, y2):
+        """Compute rows `y1` to `y2` of a reduced level of a channel."""
+        if level == 1:
+            import tifffile
+            with tifffile.TiffFile(self.path) as tif:
+                page = tif.pages[channel]
+                th = page.tilelength
+                first = 2 * y1 // th
+                rows = np.concatenate(list(
+                    read_strips(page, first, -(-2 * y2 // th))
+                ))
+                src = rows[2 * y1 - first * th:2 * y2 - first * th]
+        else:
+            src = np.asarray(self.level(level - 1, channel)[2 * y1:2 * y2])
+        out = self.level(level, channel, 'r+')
+        out[y1:y2] = reduce_block(src)
+        out.flush()
+
+
+def write_levels(
+    path, num_channels, shapes, dtype, tile_size, verbose=False,
+    executor='serial', workers=None, compression='none'
+):
+    """Append the reduced levels of a pyramidal TIFF to its base level.
+
+    `path` must hold `num_channels` tiled pages of shape `shapes[0]`, and the
+    pages of `shapes[1:]` are appended for each level and channel in turn.
+    With the serial executor every level is built in one pass over the base
+    level; otherwise levels are computed in bands of rows on a worker pool.
+    The pages are compressed with `compression`, one of
+    `utils.COMPRESSION_METHODS`, on `workers` threads.
+
+    """
+    if len(shapes) < 2:
+        return
+    write_kwargs = dict(
+        append=True, photometric='minisblack', metadata=None,
+        **utils.compression_kwargs(compression)
+    )
+    if compression != 'none':
+        write_kwargs['maxworkers'] = workers
+    with tempfile.TemporaryDirectory(
+        prefix='.pyramid-', dir=os.path.dirname(os.path.abspath(path))
+    ) as spill_dir:
+        if executor == 'serial':
+            _write_levels_streaming(
+                path, num_channels, shapes, dtype, tile_size, spill_dir,
+                write_kwargs, verbose
+            )
+        else:
+            _write_levels_parallel(
+                path, num_channels, shapes, dtype, tile_size, spill_dir,
+                write_kwargs, verbose, executor, workers
+            )
+
+
+def has_levels(path):
+    """Return True if the TIFF file at `path` holds one tiled channel followed
+    by all of its reduced levels, as written by `write_levels`."""
+    import tifffile
+    with tifffile.TiffFile(path) as tif:
+        base = tif.pages[0]
+        if not base.is_tiled:
+            return False
+        shapes = level_shapes(base.shape, base.tilelength)
+        return (
+            [tuple(p.shape) for p in tif.pages]
+            == [tuple(int(s) for s in shape) for shape in shapes]
+        )
+
+
+def update_levels(path, indices):
+    """Recompute the reduced levels of a one-channel pyramid in place.
+
+    `path` must hold a channel and its uncompressed reduced levels (see
+    `has_levels`), and `indices` are the row-major positions of the tiles of
+    the full-resolution level that changed. Only the tiles of each reduced
+    level covering them are recomputed, from the tiles of the level above,
+    so the result is the same as rebuilding the levels from scratch.
+
+    """
+    import tifffile
+    if not has_levels(path):
+        raise ValueError("%s does not have reduced levels" % path)
+    with tifffile.TiffFile(path) as tif:
+        base = tif.pages[0]
+        tile = (base.tilelength, base.tilewidth)
+        cols = base.chunked[1]
+        shapes = [tuple(p.shape) for p in tif.pages]
+        dtype = base.dtype
+    tiles = {(i // cols, i % cols) for i in indices}
+    for level in range(1, len(shapes)):
+        tiles = sorted({(ty // 2, tx // 2) for ty, tx in tiles})
+        # Reopen the file for each level so the tiles just rewritten in the
+        # level above are read from disk rather than from stale buffers.
+        with tifffile.TiffFile(path) as tif:
+            src = tif.pages[level - 1]
+            cols = tif.pages[level].chunked[1]
+            blocks = (
+                (ty * cols + tx, reduce_block(read_tiles(
+                    src, range(2 * ty, 2 * ty + 2), range(2 * tx, 2 * tx + 2)
+                )))
+                for ty, tx in tiles
+            )
+            utils.rewrite_blocks(
+                path, blocks, shapes[level], dtype, tile, page=level
+            )
+
+
+def _print_progress(message, done, total):
+    sys.stdout.write('\r        %s %d/%d' % (message, done, total))
+    sys.stdout.flush()
+
+
+def _write_levels_streaming(
+    path, num_channels, shapes, dtype, tile_size, spill_dir, write_kwargs,
+    verbose
+):
+    import tifffile
+    tile = (tile_size, tile_size)
+    reducer = BandReducer(path, shapes, dtype, spill_dir)
+    with tifffile.TiffFile(path) as tif:
+        pages = [tif.pages[i] for i in range(num_channels)]
+        spills = [
+            [reducer.level(level, c, 'w+') for level in range(2, len(shapes))]
+            for c in range(num_channels)
+        ]
+        if verbose:
+            print("    Level 1:")
+        start = time.perf_counter()
+        for c, page in enumerate(pages):
+            if verbose:
+                _print_progress('processing channel', c + 1, num_channels)
+            utils.imsave_blocks(
+                path, reduce_channel(page, tile_size, spills[c]),
+                shapes[1], dtype, tile, **write_kwargs
+            )
+        if verbose:
+            print()
+            print(
+                '        reduced all levels and wrote level 1 in %.2fs'
+                % (time.perf_counter() - start)
+            )
+    for level, shape in enumerate(shapes[2:], 2):
+        if verbose:
+            print("    Level %d:" % level)
+        start = time.perf_counter()
+        for c in range(num_channels):
+            if verbose:
+                _print_progress('processing channel', c + 1, num_channels)
+            spill = spills[c][level - 2]
+            utils.imsave_blocks(
+                path, strip_blocks(array_strips(spill, tile_size), tile_size),
+                shape, dtype, tile, **write_kwargs
+            )
+            # Release the mapping; the file goes with the directory.
+            spills[c][level - 2] = None
+        if verbose:
+            print()
+            print('        wrote in %.2fs' % (time.perf_counter() - start))
+
+
+def _write_levels_parallel(
+    path, num_channels, shapes, dtype, tile_size, spill_dir, write_kwargs,
+    verbose, executor, workers
+):
+    tile = (tile_size, tile_size)
+    reducer = BandReducer(path, shapes, dtype, spill_dir)
+    for level in range(1, len(shapes)):
+        for c in range(num_channels):
+            reducer.level(level, c, 'w+')
+    progress = None
+    if verbose:
+        progress = lambda done, total: _print_progress(
+            'reducing band', done, total
+        )
+    with parallel.WorkerPool(reducer, executor, workers) as pool:
+        for level, shape in enumerate(shapes[1:], 1):
+            if verbose:
+                print("    Level %d:" % level)
+            # Bands are one output tile high, from every channel at once.
+            tasks = [
+                (level, c, y, min(y + tile_size, shape[0]))
+                for c in range(num_channels)
+                for y in range(0, shape[0], tile_size)
+            ]
+            _, stats = pool.map('reduce_band', tasks, progress=progress)
+            start = time.perf_counter()
+            for c in range(num_channels):
+                utils.imsave_blocks(
+                    path,
+                    strip_blocks(
+                        array_strips(reducer.level(level, c), tile_size),
+                        tile_size
+                    ),
+                    shape, dtype, tile, **write_kwargs
+                )
+            if verbose:
+                print()
+                print('        reduced %r' % stats)
+                print(
+                    '        wrote %d channels in %.2fs'
+                    % (num_channels, time.perf_counter() - start)
+                )
@@ -1,4 +1,11 @@
+import os
 import sys
+import copy
+import collections
+import contextlib
+import operator
+import time
+import threading
 import warnings
 import re
 import xml.etree.ElementTree
@@ -10,11 +17,12 @@ import jnius_config
 import numpy as np
 import scipy.spatial.distance
 import scipy.fft
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
 import skimage.util
-import skimage.util.dtype
 import skimage.io
 import skimage.exposure
-import skimage.transform
 import sklearn.linear_model
 import networkx as nx
 import matplotlib.pyplot as plt
@@ -23,6 +31,10 @@ import matplotlib.patches as mpatches
 import matplotlib.patheffects as mpatheffects
 from . import utils
 from . import thumbnail
+from . import parallel
+from . import cache
+from . import pyramid
+from . import ngff
 from . import __version__ as _version
 
 
@@ -184,6 +196,15 @@ class Reader(object):
     def read(self, series, c):
         raise NotImplementedError
 
+    def tile_digest(self, series, c):
+        """Return a digest identifying the content of one tile image.
+
+        Subclasses that know where their tiles are stored can override this
+        to hash the source files instead of decoding the pixels.
+
+        """
+        return cache.array_digest(self.read(series, c))
+
 
 class PlateReader(Reader):
     # No API here, just a way to signal that a subclass's metadata class
@@ -400,28 +421,238 @@ class BioformatsReader(PlateReader):
         img = np.frombuffer(byte_array.tostring(), dtype=dtype).reshape(shape)
         return img
 
+    def tile_digest(self, series, c):
+        # All tiles live in one file, so hash it once and add the tile's
+        # series and channel.
+        if not hasattr(self, '_file_digest'):
+            self._file_digest = cache.file_digest(self.path)
+        return cache.digest(
+            self._file_digest, self.metadata.active_series[series], c
+        )
+
+
+class StaticMetadata(Metadata):
+    """Frozen copy of the tile layout described by another Metadata.
+
+    This is cheap to pickle and doesn't depend on the source file or reader
+    library, so it is what we hand to worker processes.
+
+    """
+
+    def __init__(self, metadata):
+        self._positions = metadata.positions.copy()
+        self._size = metadata.size
+        self._static_num_images = metadata.num_images
+        self._num_channels = metadata.num_channels
+        self._pixel_size = metadata.pixel_size
+        self._pixel_dtype = metadata.pixel_dtype
+
+    @property
+    def _num_images(self):
+        return self._static_num_images
+
+    @property
+    def num_channels(self):
+        return self._num_channels
+
+    @property
+    def pixel_size(self):
+        return self._pixel_size
+
+    @property
+    def pixel_dtype(self):
+        return self._pixel_dtype
+
 
 class CachingReader(Reader):
-    """Wraps a reader to provide tile image caching."""
+    """Wraps a reader to provide tile image caching.
 
-    def __init__(self, reader, channel):
+    Only tiles from `channel` are cached. See TileCache for the meaning of
+    `cache_size` (in bytes) and `spill_path`; by default every tile is kept in
+    memory.
+
+    """
+
+    def __init__(self, reader, channel, cache_size=None, spill_path=None):
         self.reader = reader
         self.channel = channel
-        self._cache = {}
+        self._cache = cache.TileCache(cache_size, spill_path)
+        # Number of reads from the underlying reader per series on `channel`.
+        self.read_counts = collections.Counter()
+        # Most readers are not thread-safe, so we serialize the actual reads.
+        self._lock = threading.Lock()
 
     @property
     def metadata(self):
         return self.reader.metadata
 
     def read(self, series, c):
-        if c == self.channel and series in self._cache:
-            img = self._cache[series]
-        else:
-            img = self.reader.read(series, c)
-        if c == self.channel and series not in self._cache:
-            self._cache[series] = img
+        if c != self.channel:
+            with self._lock:
+                return self.reader.read(series, c)
+        img = self._cache.get(series)
+        if img is None:
+            with self._lock:
+                img = self.reader.read(series, c)
+                self.read_counts[series] += 1
+            self._cache.put(series, img)
         return img
 
+    def tile_digest(self, series, c):
+        return self.reader.tile_digest(series, c)
+
+
+class SharedTileReader(Reader):
+    """Reader for a single channel of tile images held in shared memory.
+
+    Process pool workers read the alignment channel through one of these
+    instead of the original reader, so the tiles are decoded only once in the
+    parent process and never copied.
+
+    """
+
+    def __init__(self, reader, channel):
+        self.metadata = StaticMetadata(reader.metadata)
+        self.channel = channel
+        num_images = self.metadata.num_images
+        self.tiles = parallel.SharedArray(
+            (num_images,) + tuple(self.metadata.size),
+            self.metadata.pixel_dtype
+        )
+        for i in range(num_images):
+            self.tiles.array[i] = reader.read(series=i, c=channel)
+
+    def read(self, series, c):
+        if c != self.channel:
+            raise ValueError(
+                "Only channel %d is available (requested %d)"
+                % (self.channel, c)
+            )
+        return self.tiles.array[series]
+
+    def close(self):
+        self.tiles.close()
+
+
+def hilbert_rank(positions, bits=16):
+    """Return the rank of each position along a Hilbert curve.
+
+    Positions are scaled onto a 2**bits square grid first. Points that are
+    close in the plane are mostly close along the curve, which makes this a
+    good visiting order for keeping recently read tiles in use.
+
+    """
+    positions = np.asarray(positions, dtype=float)
+    n = 1 << bits
+    span = np.ptp(positions, axis=0) if len(positions) else np.zeros(2)
+    scale = (n - 1) / max(span.max(), 1)
+    y, x = np.round((positions - positions.min(axis=0)) * scale).astype(
+        np.int64
+    ).T
+    d = np.zeros(len(positions), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve's sub-blocks line up.
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return np.argsort(np.argsort(d, kind='stable'), kind='stable')
+
+
+def bfs_rank(graph, positions):
+    """Return the rank of each node in a breadth-first sweep of `graph`.
+
+    Each connected component is swept from its node nearest the origin.
+
+    """
+    rank = np.empty(len(positions), dtype=int)
+    i = 0
+    for c in sorted(nx.connected_components(graph), key=min):
+        nodes = np.array(sorted(c))
+        start = nodes[np.argmin(positions[nodes].sum(axis=1))]
+        for node in nx.bfs_tree(graph, start):
+            rank[node] = i
+            i += 1
+    return rank
+
+
+def tree_center(tree, node):
+    """Return the center of the component of `node` in a sparse `tree`.
+
+    Uses a double sweep: a breadth-first search from `node` ends at one end of
+    a longest path and a second search from there ends at the other. In a tree
+    the middle of that path is a node of minimum eccentricity, found in linear
+    time instead of the all-pairs search of `nx.center`.
+
+    """
+    bfs = scipy.sparse.csgraph.breadth_first_order
+    start = bfs(tree, node, directed=False, return_predecessors=False)[-1]
+    order, predecessors = bfs(tree, start, directed=False)
+    path = [order[-1]]
+    while path[-1] != start:
+        path.append(predecessors[path[-1]])
+    return path[len(path) // 2]
+
+
+# Tile orders for edge registration: 'hilbert' follows a Hilbert curve through
+# the nominal positions, 'bfs' a breadth-first search of the neighbors graph.
+# None keeps the graph's own order.
+TRAVERSAL_METHODS = ('hilbert', 'bfs')
+
+
+def edge_schedule(graph, positions, method='hilbert'):
+    """Return the edges of `graph` as sorted pairs in a cache-friendly order.
+
+    Nodes are ranked by `method` ('hilbert' or 'bfs') and each edge is visited
+    right after the later-ranked of its two nodes, so every tile is needed
+    during a short window of the schedule and can then be evicted for good.
+    If `method` is None the graph's own edge order is used.
+
+    """
+    edges = [tuple(sorted(e)) for e in graph.edges]
+    if method is None:
+        return edges
+    elif method == 'hilbert':
+        rank = hilbert_rank(positions)
+    elif method == 'bfs':
+        rank = bfs_rank(graph, positions)
+    else:
+        raise ValueError(
+            "traversal must be one of %s or None" % ', '.join(TRAVERSAL_METHODS)
+        )
+    return sorted(
+        edges, key=lambda e: (max(rank[e[0]], rank[e[1]]),
+                              min(rank[e[0]], rank[e[1]]))
+    )
+
+
+def quantile_converged(values, q, tolerance, z=1.96):
+    """Return True if the sample `q` quantile of `values` is well determined.
+
+    Uses the distribution-free confidence interval for a quantile given by the
+    order statistics around rank n*q. The estimate has converged once that
+    interval (at the confidence level implied by `z`) is narrower than
+    `tolerance` times the magnitude of the estimate. Small samples whose
+    interval runs off either end of the data never count as converged.
+
+    """
+    n = len(values)
+    spread = z * np.sqrt(n * q * (1 - q))
+    lo = int(np.floor(n * q - spread))
+    hi = int(np.ceil(n * q + spread))
+    if lo < 0 or hi >= n:
+        return False
+    v = np.sort(values)
+    estimate = np.percentile(v, q * 100)
+    if not np.all(np.isfinite([v[lo], v[hi], estimate])):
+        return False
+    return v[hi] - v[lo] <= tolerance * abs(estimate)
+
 
 # TileStatistics = collections.namedtuple(
 #     'TileStatistics',
@@ -434,32 +665,143 @@ def neighbors_graph(aligner):
     """Return graph of neighboring (overlapping) tiles.
 
     Tiles are considered neighbors if the 'city block' distance between them
-    is less than the largest tile dimension.
+    is less than the largest tile dimension. Each edge's 'overlap' attribute
+    holds the height and width of the intersection of the two tiles' nominal
+    bounding rectangles, which is zero or negative if they don't overlap.
 
     """
-    # FIXME: This should properly test for overlap, possibly via
-    # intersection of bounding rectangles.
     if not hasattr(aligner, '_neighbors_graph'):
-        pdist = scipy.spatial.distance.pdist(aligner.metadata.positions,
-                                             metric='cityblock')
-        sp = scipy.spatial.distance.squareform(pdist)
-        max_distance = aligner.metadata.size.max() + 1
-        edges = zip(*np.nonzero((sp > 0) & (sp < max_distance)))
-        graph = nx.from_edgelist(edges)
+        positions = aligner.metadata.positions
+        size = aligner.metadata.size
+        max_distance = size.max() + 1
+        # A KD-tree finds the candidate pairs without the full O(n^2) distance
+        # matrix. The exact test is repeated below to match the strict
+        # inequality and to exclude coincident tiles.
+        tree = scipy.spatial.cKDTree(positions)
+        pairs = tree.query_pairs(max_distance, p=1, output_type='ndarray')
+        pairs = pairs.reshape(-1, 2)
+        delta = np.abs(positions[pairs[:, 0]] - positions[pairs[:, 1]])
+        distance = delta.sum(axis=1)
+        keep = (distance > 0) & (distance < max_distance)
+        pairs = pairs[keep]
+        overlaps = size - delta[keep]
+        # Add edges in the same row-major order as scanning the full
+        # symmetric neighbor matrix, so edge iteration order is stable.
+        both = np.vstack([pairs, pairs[:, ::-1]])
+        order = np.lexsort((both[:, 1], both[:, 0]))
+        graph = nx.Graph()
+        for i, j in both[order].tolist():
+            graph.add_edge(i, j)
         graph.add_nodes_from(range(aligner.metadata.num_images))
+        for (i, j), overlap in zip(pairs.tolist(), overlaps):
+            graph.edges[i, j]['overlap'] = overlap
         aligner._neighbors_graph = graph
     return aligner._neighbors_graph
 
 
+def run_stages(aligner, stages, checkpoint=None):
+    """Run the stage methods of an aligner in order.
+
+    `stages` is a sequence of (method name, attribute names) pairs, where the
+    attributes hold the outputs of that stage; dotted names reach into
+    attributes of attributes. If `checkpoint` is given the outputs of all
+    completed stages are saved to it after each stage, and if the aligner's
+    `resume` is set, stages completed by an earlier run are skipped and their
+    outputs restored instead.
+
+    """
+    done = 0
+    if checkpoint is not None and aligner.resume:
+        done, state = checkpoint.load()
+        # Only restore the outputs of stages we know about.
+        expected = {n for _, names in stages[:done] for n in names}
+        if done > len(stages) or not set(state) <= expected:
+            done, state = 0, {}
+        for name, value in state.items():
+            parent, _, attr = name.rpartition('.')
+            target = operator.attrgetter(parent)(aligner) if parent else aligner
+            setattr(target, attr, value)
+        if done and aligner.verbose:
+            print('    resuming after %s' % stages[done - 1][0])
+    for i, (method, _) in enumerate(stages[done:], done):
+        getattr(aligner, method)()
+        if checkpoint is None:
+            continue
+        state = {}
+        for _, names in stages[:i + 1]:
+            for name in names:
+                try:
+                    state[name] = operator.attrgetter(name)(aligner)
+                except AttributeError:
+                    # Skipped stages (e.g. no thumbnail) leave no output.
+                    pass
+        checkpoint.save(i + 1, state)
+
+
+def pyramid_factor(shape, coarse_size=256, min_size=16):
+    """Return the power-of-two reduction for a pyramid registration window.
+
+    The window is reduced until its longer side is about `coarse_size`, but
+    never so far that its shorter side drops below `min_size`.
+
+    """
+    factor = 1
+    while (
+        max(shape) / factor > coarse_size
+        and min(shape) / (factor * 2) >= min_size
+    ):
+        factor *= 2
+    return factor
+
+
+# Regions whitened for edge registration: 'window' whitens every registration
+# window separately, 'edge' whitens the largest window of each edge once and
+# takes the others as views of it, and 'tile' whitens whole tiles once. The
+# latter two save repeated filtering of the same pixels, at the cost of
+# slightly different filter responses along the window edges.
+WHITENING_MODES = ('window', 'edge', 'tile')
+
+# Edge registration strategies: 'ladder' registers a series of doubling
+# windows at full resolution and keeps the best, 'pyramid' registers a window
+# wide enough for max_shift at reduced resolution, then refines the estimate
+# at full resolution in the overlap implied by it.
+REGISTRATION_MODES = ('ladder', 'pyramid')
+
+# Tile placement: 'spanning_tree' sums the shifts along the minimum spanning
+# tree from the center of each connected component, 'least_squares' finds the
+# shifts that best agree with all accepted edges at once.
+POSITION_SOLVERS = ('spanning_tree', 'least_squares')
+
+
 class EdgeAligner(object):
 
     def __init__(
         self, reader, channel=0, max_shift=15, false_positive_ratio=0.01,
         randomize=False, filter_sigma=0.0, do_make_thumbnail=True, verbose=False,
-        permutations_multiplier=10,
+        permutations_multiplier=10, executor='serial', workers=None,
+        threshold_tolerance=None, tile_cache_size=None, tile_cache_spill=None,
+        traversal='hilbert', whitening='window', cache_path=None,
+        checkpoint_path=None, resume=False, registration='ladder',
+        position_solver='spanning_tree', prewhiten=None,
     ):
+        if prewhiten is not None:
+            warnings.warn(
+                "prewhiten is deprecated, use whitening='tile' instead",
+                DeprecationWarning, stacklevel=2
+            )
+            if prewhiten:
+                whitening = 'tile'
         self.channel = channel
-        self.reader = CachingReader(reader, self.channel)
+        # tile_cache_size is the budget for all cached tiles. In 'tile'
+        # whitening mode each tile is read once to be whitened and then only
+        # used whitened, so most of the budget goes to the whitened tiles.
+        raw_cache_size = whitened_cache_size = tile_cache_size
+        if whitening == 'tile' and tile_cache_size is not None:
+            raw_cache_size = tile_cache_size // 4
+            whitened_cache_size = tile_cache_size - raw_cache_size
+        self.reader = CachingReader(
+            reader, self.channel, raw_cache_size, tile_cache_spill
+        )
         self.verbose = verbose
         # Unit is micrometers.
         self.max_shift = max_shift
@@ -470,33 +812,94 @@ class EdgeAligner(object):
         self.do_make_thumbnail = do_make_thumbnail
         self._cache = {}
         self.permutations_multiplier = permutations_multiplier
+        if executor not in parallel.EXECUTORS:
+            raise ValueError(
+                "executor must be one of %s" % ', '.join(parallel.EXECUTORS)
+            )
+        self.executor = executor
+        self.workers = workers
+        self.threshold_tolerance = threshold_tolerance
+        if traversal is not None and traversal not in TRAVERSAL_METHODS:
+            raise ValueError(
+                "traversal must be one of %s or None"
+                % ', '.join(TRAVERSAL_METHODS)
+            )
+        self.traversal = traversal
+        if whitening not in WHITENING_MODES:
+            raise ValueError(
+                "whitening must be one of %s" % ', '.join(WHITENING_MODES)
+            )
+        self.whitening = whitening
+        if registration not in REGISTRATION_MODES:
+            raise ValueError(
+                "registration must be one of %s" % ', '.join(REGISTRATION_MODES)
+            )
+        self.registration = registration
+        if position_solver not in POSITION_SOLVERS:
+            raise ValueError(
+                "position_solver must be one of %s"
+                % ', '.join(POSITION_SOLVERS)
+            )
+        self.position_solver = position_solver
+        self._whitened = cache.TileCache(whitened_cache_size)
+        self._fft = utils.FFTWorkspace()
+        self.window_counts = collections.Counter()
+        # Edge registrations and the error threshold can be persisted across
+        # runs, keyed by tile content and the parameters that affect them.
+        self.registration_cache = None
+        if cache_path is not None:
+            self.registration_cache = cache.RegistrationCache(cache_path)
+        if resume and checkpoint_path is None:
+            raise ValueError("resume requires a checkpoint_path")
+        self.checkpoint_path = checkpoint_path
+        self.resume = resume
 
     neighbors_graph = neighbors_graph
 
+    # The stages of run, with the attributes holding their outputs.
+    stages = (
+        ('make_thumbnail', ('reader.thumbnail',)),
+        ('check_overlaps', ()),
+        ('compute_threshold', (
+            'errors_negative_sampled', 'num_negative_samples', 'max_error',
+        )),
+        ('register_all', ('_cache', 'all_errors')),
+        ('build_spanning_tree', (
+            'spanning_tree', 'tree_order', 'tree_predecessors',
+        )),
+        ('calculate_positions', ('shifts', 'positions')),
+        ('fit_model', ('lr', 'origin', 'positions', 'centers')),
+    )
+
     def run(self):
-        self.make_thumbnail()
-        self.check_overlaps()
-        self.compute_threshold()
-        self.register_all()
-        self.build_spanning_tree()
-        self.calculate_positions()
-        self.fit_model()
+        run_stages(self, self.stages, self._checkpoint())
+
+    def _checkpoint(self):
+        if self.checkpoint_path is None:
+            return None
+        fingerprint = (
+            'EdgeAligner', self._cache_params(), tuple(self.tile_digests),
+            cache.array_digest(self.metadata.positions),
+            self.do_make_thumbnail, self.permutations_multiplier,
+            self.false_positive_ratio, self.randomize, self.threshold_tolerance,
+            self.position_solver,
+        )
+        return cache.Checkpoint(self.checkpoint_path, fingerprint)
 
     def make_thumbnail(self):
         if not self.do_make_thumbnail:
             return
         self.reader.thumbnail = thumbnail.make_thumbnail(
-            self.reader, channel=self.channel
+            self.reader, channel=self.channel, verbose=self.verbose
         )
 
     def check_overlaps(self):
         # This might be better addressed by removing the +1 from the
         # neighbors_graph max_distance calculation and ensuring the graph is
         # fully connected.
-        pos = self.metadata.positions
         overlaps = np.array([
-            self.metadata.size - abs(pos[t1] - pos[t2])
-            for t1, t2 in self.neighbors_graph.edges
+            overlap for _, _, overlap
+            in self.neighbors_graph.edges(data='overlap')
         ])
         failures = np.any(overlaps < 1, axis=1) if len(overlaps) else []
         if len(failures) and all(failures):
@@ -514,13 +917,24 @@ class EdgeAligner(object):
         # If not enough tiles overlap to matter, skip this whole thing.
         if len(edges) <= 1:
             self.errors_negative_sampled = np.empty(0)
+            self.num_negative_samples = 0
             self.max_error = np.inf
             return
-        widths = np.array([
-            self.intersection(t1, t2).shape.min()
-            for t1, t2 in edges
-        ])
+        cache_key = self._threshold_cache_key()
+        if cache_key is not None:
+            cached = self.registration_cache.get(cache_key)
+            if cached is not None:
+                self.errors_negative_sampled = cached
+                self.num_negative_samples = len(cached)
+                self.max_error = np.percentile(
+                    cached, self.false_positive_ratio * 100
+                )
+                if self.verbose:
+                    print('    using %d cached samples' % len(cached))
+                return
+        widths = self.intersections.shape.min(axis=1)
         w = widths.max()
+        strip_table = self._edge_table(np.repeat(w, 2))
         max_offset = self.metadata.size[0] - w
         # Number of possible pairs minus number of actual neighbor pairs.
         num_distant_pairs = num_tiles * (num_tiles - 1) // 2 - len(edges)
@@ -555,10 +969,12 @@ class EdgeAligner(object):
                 elif (t1, t2) in edges:
                     # Neighbors OK if either strip is entirely outside the
                     # expected overlap region (based on nominal positions).
-                    its = self.intersection(t1, t2, np.repeat(w, 2))
-                    ioff1, ioff2 = its.offsets[:, 0]
+                    row = self.edge_index[min(t1, t2), max(t1, t2)]
+                    ioff1, ioff2 = strip_table.offsets[row, :, 0]
+                    if t1 > t2:
+                        ioff1, ioff2 = ioff2, ioff1
                     if (
-                        its.shape[0] > its.shape[1]
+                        strip_table.shape[row, 0] > strip_table.shape[row, 1]
                         or o1 < ioff1 - w or o1 > ioff1 + w
                         or o2 < ioff2 - w or o2 > ioff2 + w
                     ):
@@ -570,32 +986,126 @@ class EdgeAligner(object):
                 )
             pairs[i] = t1, t2
             offsets[i] = o1, o2
-        errors = np.empty(n)
-        for i, ((t1, t2), (offset1, offset2)) in enumerate(zip(pairs, offsets)):
-            #  todo this is where we could check if the error is staying the same and quit early
-            if self.verbose and (i % 10 == 9 or i == n - 1):
-                sys.stdout.write(
-                    '\r    quantifying alignment error %d/%d' % (i + 1, n)
+        # Evaluate the strips in batches so we can stop early once the
+        # threshold has converged. Without a tolerance we always use all n.
+        tasks = [
+            (t1, t2, o1, o2, w) for (t1, t2), (o1, o2) in zip(pairs, offsets)
+        ]
+        q = self.false_positive_ratio
+        if self.threshold_tolerance is None:
+            batch_size = n
+        else:
+            batch_size = max(100, 10 * (self.workers or 1))
+        # The pairs are random, but grouping each batch by tile still lets
+        # the tile cache serve repeated reads of the first tile.
+        rank = self._traversal_rank()
+        errors = []
+        stats = []
+        stable = False
+        with self._worker_pool() as pool:
+            for start in range(0, n, batch_size):
+                batch = tasks[start:start + batch_size]
+                order = sorted(
+                    range(len(batch)),
+                    key=lambda i: (rank[batch[i][0]], rank[batch[i][1]])
                 )
-                sys.stdout.flush()
-            img1 = self.reader.read(t1, self.channel)[offset1:offset1+w, :]
-            img2 = self.reader.read(t2, self.channel)[offset2:offset2+w, :]
-            _, errors[i] = utils.register(img1, img2, self.filter_sigma, upsample=1)
+                batch_errors, batch_stats = self._map(
+                    pool, '_register_strip', [batch[i] for i in order],
+                    'quantifying alignment error', start, n
+                )
+                batch_errors = np.array(batch_errors)[np.argsort(order)]
+                errors.extend(batch_errors)
+                stats.append(batch_stats)
+                if self.threshold_tolerance is not None:
+                    # Require two consecutive batches to meet the tolerance so
+                    # one lucky batch doesn't end the sampling.
+                    converged = quantile_converged(
+                        errors, q, self.threshold_tolerance
+                    )
+                    if converged and stable:
+                        break
+                    stable = converged
         if self.verbose:
             print()
+        errors = np.array(errors)
+        self.threshold_stats = sum(stats[1:], stats[0])
+        self.num_negative_samples = len(errors)
+        if self.verbose:
+            print(
+                '    used %d of %d samples in %.2fs (%.1fx speedup)'
+                % (len(errors), n, self.threshold_stats.wall,
+                   self.threshold_stats.speedup)
+            )
         self.errors_negative_sampled = errors
-        self.max_error = np.percentile(errors, self.false_positive_ratio * 100)
+        self.max_error = np.percentile(errors, q * 100)
+        if cache_key is not None:
+            self.registration_cache.put(cache_key, errors)
+
+    def _register_strip(self, t1, t2, offset1, offset2, width):
+        """Return the alignment error between two horizontal image strips."""
+        if self.whitening == 'tile':
+            img1 = self._whitened_tile(t1)[offset1:offset1+width, :]
+            img2 = self._whitened_tile(t2)[offset2:offset2+width, :]
+        else:
+            img1 = self.reader.read(t1, self.channel)[offset1:offset1+width, :]
+            img2 = self.reader.read(t2, self.channel)[offset2:offset2+width, :]
+            img1 = utils.whiten(img1, self.filter_sigma)
+            img2 = utils.whiten(img2, self.filter_sigma)
+        _, error = utils.register_whitened(
+            img1, img2, upsample=1, workspace=self._fft
+        )
+        return error
 
     def register_all(self):
-        n = self.neighbors_graph.size()
-        for i, (t1, t2) in enumerate(self.neighbors_graph.edges, 1):
-            if self.verbose:
-                sys.stdout.write('\r    aligning edge %d/%d' % (i, n))
-                sys.stdout.flush()
-            self.register_pair(t1, t2)
+        keys = [tuple(sorted(e)) for e in self.neighbors_graph.edges]
+        schedule = edge_schedule(
+            self.neighbors_graph, self.metadata.positions, self.traversal
+        )
+        pending = [k for k in schedule if k not in self._cache]
+        if self.registration_cache is not None:
+            for key in pending:
+                result = self.registration_cache.get(self._edge_cache_key(*key))
+                if result is not None:
+                    self._cache[key] = result
+            pending = [k for k in pending if k not in self._cache]
+        with self._worker_pool() as pool:
+            results, self.register_stats = self._map(
+                pool, '_register_edge_counted', pending, 'aligning edge'
+            )
         if self.verbose:
             print()
-        self.all_errors = np.array([x[1] for x in self._cache.values()])
+        for key, (shift, error, counts) in zip(pending, results):
+            self._cache[key] = (shift, error)
+            self.window_counts.update(counts)
+            if self.registration_cache is not None:
+                self.registration_cache.put(
+                    self._edge_cache_key(*key), (shift, error)
+                )
+        if self.verbose:
+            stats = self.register_stats
+            print(
+                '    aligned %d edges in %.2fs (%.1fx speedup)'
+                % (stats.num_tasks, stats.wall, stats.speedup)
+            )
+            counts = self.window_counts
+            print(
+                '    edge windows: %d tile reads and %d whitening passes'
+                ' (saved %d reads and %d whitening passes)'
+                % (counts['reads'], counts['whitens'],
+                   counts['reads_saved'], counts['whitens_saved'])
+            )
+            print('    tile cache: %s' % self.reader._cache)
+            if self.registration_cache is not None:
+                print('    registration cache: %s' % self.registration_cache)
+            if self.whitening == 'tile':
+                print('    whitened tile cache: %s' % self._whitened)
+            print('    FFT plan cache: %r' % self._fft)
+            reads = self.tile_read_counts
+            print(
+                '    tile reads: %d total, at most %d per tile'
+                % (reads.sum(), reads.max())
+            )
+        self.all_errors = np.array([self._cache[k][1] for k in keys])
         # Set error values above the threshold to infinity.
         for k, v in self._cache.items():
             if v[1] > self.max_error or any(np.abs(v[0]) > self.max_shift_pixels):
@@ -603,41 +1113,104 @@ class EdgeAligner(object):
 
     def build_spanning_tree(self):
         # Note that this may be disconnected, so it's technically a forest.
-        g = nx.Graph()
-        g.add_nodes_from(self.neighbors_graph)
-        g.add_weighted_edges_from(
+        # We take the minimum spanning tree of the accepted edges weighted by
+        # error and record a breadth-first traversal of each component from
+        # its center, which calculate_positions follows to place the tiles.
+        n = self.metadata.num_images
+        edges = np.array([
             (t1, t2, error)
             for (t1, t2), (_, error) in self._cache.items()
             if np.isfinite(error)
+        ]).reshape(-1, 3)
+        t1, t2 = edges[:, :2].T.astype(int)
+        # csgraph ignores zero weights, so offset the (non-negative) errors.
+        # Adding a constant to every weight doesn't change the tree.
+        graph = scipy.sparse.csr_matrix(
+            (edges[:, 2] + 1, (t1, t2)), shape=(n, n)
         )
+        tree = scipy.sparse.csgraph.minimum_spanning_tree(graph)
         spanning_tree = nx.Graph()
-        spanning_tree.add_nodes_from(g)
-        for c in nx.connected_components(g):
-            cc = g.subgraph(c)
-            center = nx.center(cc)[0]
-            paths = nx.single_source_dijkstra_path(cc, center).values()
-            for path in paths:
-                nx.add_path(spanning_tree, path)
+        spanning_tree.add_nodes_from(range(n))
+        spanning_tree.add_edges_from(zip(*tree.nonzero()))
+        tree = (tree + tree.T).tocsr()
+        _, labels = scipy.sparse.csgraph.connected_components(
+            tree, directed=False
+        )
+        sizes = np.bincount(labels, minlength=1)
+        order = [np.flatnonzero(sizes[labels] == 1)]
+        predecessors = np.full(n, -1)
+        for label in np.flatnonzero(sizes > 1):
+            center = tree_center(tree, np.argmax(labels == label))
+            component, parents = scipy.sparse.csgraph.breadth_first_order(
+                tree, center, directed=False
+            )
+            order.append(component)
+            predecessors[component[1:]] = parents[component[1:]]
         self.spanning_tree = spanning_tree
+        self.tree_order = np.concatenate(order)
+        self.tree_predecessors = predecessors
 
     def calculate_positions(self):
-        shifts = {}
-        for c in nx.connected_components(self.spanning_tree):
-            cc = self.spanning_tree.subgraph(c)
-            center = nx.center(cc)[0]
-            shifts[center] = np.array([0, 0])
-            for edge in nx.traversal.bfs_edges(cc, center):
-                source, dest = edge
-                if source not in shifts:
-                    source, dest = dest, source
-                shift = self.register_pair(source, dest)[0]
-                shifts[dest] = shifts[source] + shift
-        if shifts:
-            self.shifts = np.array([s for _, s in sorted(shifts.items())])
+        if self.metadata.num_images == 0:
+            raise ValueError("No images to align")
+        if self.position_solver == 'least_squares':
+            self.shifts = self._solve_least_squares()
             self.positions = self.metadata.positions + self.shifts
-        else:
-            # TODO: fill in shifts and positions with 0x2 arrays
-            raise NotImplementedError("No images")
+            return
+        # Tiles come in breadth-first order from the center of each tree, so
+        # every tile's predecessor has already been placed.
+        self.shifts = np.zeros((self.metadata.num_images, 2))
+        for dest in self.tree_order:
+            source = self.tree_predecessors[dest]
+            if source >= 0:
+                shift = self.register_pair(source, dest)[0]
+                self.shifts[dest] = self.shifts[source] + shift
+        self.positions = self.metadata.positions + self.shifts
+
+    def _solve_least_squares(self):
+        """Return the tile shifts that best agree with all accepted edges.
+
+        Each accepted edge (t1, t2) asks for shifts[t2] - shifts[t1] to equal
+        its registered shift. These equations are solved together in the
+        weighted least-squares sense, weighting each edge by its correlation
+        exp(-error), with one tile of every connected component held at zero
+        shift. Unlike summing along spanning tree paths, this spreads the
+        registration errors over all edges instead of accumulating them.
+
+        """
+        n = self.metadata.num_images
+        edges = [
+            (t1, t2, shift, error)
+            for (t1, t2), (shift, error) in self._cache.items()
+            if np.isfinite(error)
+        ]
+        shifts = np.zeros((n, 2))
+        if not edges:
+            return shifts
+        t1, t2, edge_shifts, errors = zip(*edges)
+        m = len(edges)
+        weights = np.exp(-np.array(errors))
+        # Incidence matrix: row i is +1 at t2 and -1 at t1 of edge i.
+        incidence = scipy.sparse.csr_matrix(
+            (np.tile([-1.0, 1.0], m), (np.repeat(np.arange(m), 2),
+             np.column_stack([t1, t2]).ravel())),
+            shape=(m, n),
+        )
+        weighted = scipy.sparse.diags(weights) @ incidence
+        laplacian = (incidence.T @ weighted).tocsc()
+        rhs = weighted.T @ np.array(edge_shifts, dtype=float)
+        _, labels = scipy.sparse.csgraph.connected_components(
+            laplacian, directed=False
+        )
+        _, pinned = np.unique(labels, return_index=True)
+        free = np.ones(n, dtype=bool)
+        free[pinned] = False
+        if free.any():
+            solution = scipy.sparse.linalg.spsolve(
+                laplacian[free][:, free], rhs[free]
+            )
+            shifts[free] = solution.reshape(-1, 2)
+        return shifts
 
     def fit_model(self):
         components = sorted(
@@ -666,52 +1239,399 @@ class EdgeAligner(object):
         self.centers = self.positions + self.metadata.size / 2
 
 
+    def _traversal_rank(self):
+        positions = self.metadata.positions
+        if self.traversal == 'bfs':
+            return bfs_rank(self.neighbors_graph, positions)
+        elif self.traversal == 'hilbert':
+            return hilbert_rank(positions)
+        else:
+            # No traversal: keep the tiles in index order.
+            return np.arange(len(positions))
+
+    @property
+    def tile_digests(self):
+        """Content digest of each tile on the alignment channel."""
+        if not hasattr(self, '_tile_digests'):
+            self._tile_digests = [
+                self.reader.tile_digest(i, self.channel)
+                for i in range(self.metadata.num_images)
+            ]
+        return self._tile_digests
+
+    def _cache_params(self):
+        # Everything besides the tile contents and layout that changes the
+        # registration results. Results from other ashlar versions are not
+        # reused in case the algorithms have changed.
+        return (
+            _version, self.channel, self.filter_sigma, self.max_shift,
+            self.whitening, self.registration, tuple(self.metadata.size),
+        )
+
+    def _edge_cache_key(self, t1, t2):
+        positions = self.metadata.positions
+        offset = tuple((positions[t2] - positions[t1]).tolist())
+        digests = self.tile_digests
+        return (
+            'edge', self._cache_params(), digests[t1], digests[t2], offset
+        )
+
+    def _threshold_cache_key(self):
+        # Randomized sampling is deliberately not repeatable.
+        if self.registration_cache is None or self.randomize is not False:
+            return None
+        return (
+            'threshold', self._cache_params(), tuple(self.tile_digests),
+            cache.array_digest(self.metadata.positions),
+            self.permutations_multiplier, self.false_positive_ratio,
+            self.threshold_tolerance,
+        )
+
+    @property
+    def tile_read_counts(self):
+        """Number of times each tile has been read from the source image on
+        the alignment channel."""
+        counts = np.zeros(self.metadata.num_images, dtype=int)
+        for series, count in self.reader.read_counts.items():
+            counts[series] = count
+        return counts
+
+    @contextlib.contextmanager
+    def _worker_pool(self):
+        """Context manager providing a WorkerPool on our executor."""
+        worker_target = None
+        if self.executor == 'process':
+            worker_target = self._worker_copy()
+        try:
+            with parallel.WorkerPool(
+                self, self.executor, self.workers, worker_target
+            ) as pool:
+                yield pool
+        finally:
+            if worker_target is not None:
+                worker_target.reader.close()
+
+    def _map(self, pool, method, arglist, message, done=0, total=None):
+        """Run ``self.method(*args)`` for each args on `pool`.
+
+        `done` and `total` offset the progress display for callers that split
+        one logical job across several calls.
+
+        """
+        if total is None:
+            total = len(arglist)
+        def progress(n, _):
+            sys.stdout.write('\r    %s %d/%d' % (message, done + n, total))
+            sys.stdout.flush()
+        return pool.map(
+            method, arglist, progress=progress if self.verbose else None
+        )
+
+    def _worker_copy(self):
+        """Return a copy of this aligner for use in process pool workers.
+
+        The copy reads the alignment channel from shared memory and carries no
+        cached registrations, so it is cheap to pickle.
+
+        """
+        worker = copy.copy(self)
+        worker.reader = SharedTileReader(self.reader, self.channel)
+        worker._cache = {}
+        return worker
+
     def register_pair(self, t1, t2):
         """Return relative shift between images and the alignment error."""
         key = tuple(sorted((t1, t2)))
         try:
             shift, error = self._cache[key]
         except KeyError:
-            # We test a series of increasing overlap window sizes to help avoid
-            # missing alignments when the stage position error is large relative
-            # to the tile overlap. Simply using a large overlap in all cases
-            # limits the maximum achievable correlation thus increasing the
-            # error metric, leading to worse overall results. The window size
-            # starts at the nominal size and doubles until it's at least 10% of
-            # the tile size. If the nominal overlap is already 10% or greater,
-            # we only use that one size.
-            smin = self.intersection(key[0], key[1]).shape
-            smax = np.round(self.metadata.size * 0.1)
-            sizes = [smin]
-            while any(sizes[-1] < smax):
-                sizes.append(sizes[-1] * 2)
-            results = [self._register(key[0], key[1], s) for s in sizes]
-            # Use the shift from the window size that gave the lowest error.
-            shift, _ = min(results, key=lambda r: r[1])
-            # Extract the images from the nominal overlap window but with the
-            # shift applied to the second tile's position, and compute the error
-            # metric on these images. This should be even lower than the error
-            # computed above.
-            _, o1, o2 = self.overlap(key[0], key[1], shift=shift)
-            error = utils.nccw(o1, o2, self.filter_sigma)
+            shift, error = self._register_edge(*key)
             self._cache[key] = (shift, error)
         if t1 > t2:
             shift = -shift
         # Return copy of shift to prevent corruption of cached values.
         return shift.copy(), error
 
+    def _register_edge(self, t1, t2):
+        """Register the tiles of an edge (t1 < t2), bypassing the cache."""
+        shift, error, counts = self._register_edge_counted(t1, t2)
+        self.window_counts.update(counts)
+        return shift, error
+
+    def _register_edge_counted(self, t1, t2):
+        """Like `_register_edge`, but also return a Counter of the tile reads
+        and whitening passes used, and of those saved relative to cropping
+        and whitening every window from scratch."""
+        # We test a series of increasing overlap window sizes to help avoid
+        # missing alignments when the stage position error is large relative
+        # to the tile overlap. Simply using a large overlap in all cases
+        # limits the maximum achievable correlation thus increasing the
+        # error metric, leading to worse overall results. The window size
+        # starts at the nominal size and doubles until it's at least 10% of
+        # the tile size. If the nominal overlap is already 10% or greater,
+        # we only use that one size.
+        row = self.edge_index[t1, t2]
+        counts = collections.Counter()
+        if self.registration == 'pyramid':
+            windows = []
+            shift, sources = self._register_pyramid(t1, t2, row, counts)
+        else:
+            windows = [
+                (table.offsets[row], table.shape[row], table.padding[row])
+                for table in self._window_tables[:self._window_counts[row]]
+            ]
+            # Each tile is fetched once for all windows and the final error.
+            sources = self._edge_sources(t1, t2, windows, counts)
+            results = []
+            for offsets, shape, padding in windows:
+                img1, img2 = self._edge_crops(sources, offsets, shape, counts)
+                results.append(
+                    self._register_whitened_window(t1, t2, img1, img2, padding)
+                )
+            # Use the shift from the window size that gave the lowest error.
+            shift, _ = min(results, key=lambda r: r[1])
+        # Extract the images from the nominal overlap window but with the
+        # shift applied to the second tile's position, and compute the error
+        # metric on these images. This should be even lower than the error
+        # computed above.
+        its = self.intersection(t1, t2, shift=shift)
+        w1, w2 = self._edge_crops(sources, its.offsets, its.shape, counts)
+        error = utils.nccw_whitened(w1, w2)
+        # Without batching every window and the final error read and whiten
+        # both tiles. The pyramid has two windows, coarse and fine.
+        passes = 2 * (max(len(windows), 2) + 1)
+        counts['reads_saved'] = passes - counts['reads']
+        counts['whitens_saved'] = passes - counts['whitens']
+        return shift, error, counts
+
+    def _register_pyramid(self, t1, t2, row, counts):
+        """Register an edge coarse-to-fine.
+
+        The coarse window is the nominal overlap widened by the maximum shift
+        in each direction, so phase correlation can find any acceptable
+        shift, and is registered at a resolution reduced by `pyramid_factor`.
+        The overlap of the tiles at the coarse estimate is then registered at
+        full resolution. Returns the shift and the sources for the final
+        error, as `_edge_sources` does.
+
+        """
+        table = self._coarse_table
+        shape, padding = table.shape[row], table.padding[row]
+        factor = pyramid_factor(shape)
+        tiles = [self.reader.read(series=t, c=self.channel) for t in (t1, t2)]
+        counts['reads'] += 2
+        img1, img2 = (
+            utils.whiten(
+                utils.downsample(utils.crop(tile, offset, shape), factor),
+                self.filter_sigma / factor
+            )
+            for tile, offset in zip(tiles, table.offsets[row])
+        )
+        counts['whitens'] += 2
+        coarse, _ = self._register_whitened_window(
+            t1, t2, img1, img2, padding / factor, upsample=1
+        )
+        # The peak position is only known modulo the window size, and at low
+        # resolution the quadrant test in register_whitened often picks the
+        # wrong alias. Corrections are bounded by max_shift, so take the alias
+        # closest to the nominal offset instead.
+        size = np.array(img1.shape)
+        coarse = (coarse - np.round(coarse / size) * size) * factor
+        # Once shifted, the tiles overlap in their common region, so no
+        # padding is needed around it.
+        its = self.intersection(t1, t2, shift=coarse)
+        if self.whitening == 'tile':
+            sources = [
+                (None, self._whitened_tile(t), np.zeros(2, int))
+                for t in (t1, t2)
+            ]
+        else:
+            # The final error window is this one moved by the fine shift,
+            # which is within about one coarse pixel, so whiten a region
+            # covering both once per tile.
+            sources = []
+            for tile, offset in zip(tiles, its.offsets):
+                start = offset.round().astype(int)
+                origin = np.maximum(start - factor - 1, 0)
+                end = np.minimum(start + its.shape + factor + 1, tile.shape)
+                region = utils.whiten(
+                    tile[origin[0]:end[0], origin[1]:end[1]], self.filter_sigma
+                )
+                counts['whitens'] += 1
+                sources.append((tile, region, origin))
+        img1, img2 = self._edge_crops(sources, its.offsets, its.shape, counts)
+        fine, _ = self._register_whitened_window(
+            t1, t2, img1, img2, its.padding
+        )
+        return coarse + fine, sources
+
+    def _edge_sources(self, t1, t2, windows, counts):
+        """Fetch the images that the windows of an edge are cropped from.
+
+        Returns a (tile, region, origin) tuple per tile, where region is the
+        whitened bounding box of all the windows in 'edge' whitening mode and
+        origin is its position in the tile. In 'tile' mode the whole tile is
+        already whitened and in 'window' mode there is no region.
+
+        """
+        if self.whitening == 'tile':
+            sources = []
+            for t in (t1, t2):
+                if t not in self._whitened:
+                    counts['reads'] += 1
+                    counts['whitens'] += 1
+                sources.append((None, self._whitened_tile(t), np.zeros(2, int)))
+            return sources
+        sources = []
+        for i, t in enumerate((t1, t2)):
+            tile = self.reader.read(series=t, c=self.channel)
+            counts['reads'] += 1
+            region = origin = None
+            if self.whitening == 'edge':
+                # Pad the region by the largest acceptable shift so it also
+                # covers the shifted window used for the final error.
+                starts = np.array([o[i].round() for o, _, _ in windows], int)
+                ends = starts + [s for _, s, _ in windows]
+                margin = int(np.ceil(self.max_shift_pixels))
+                origin = np.maximum(starts.min(axis=0) - margin, 0)
+                end = np.minimum(ends.max(axis=0) + margin, tile.shape)
+                region = utils.whiten(
+                    tile[origin[0]:end[0], origin[1]:end[1]], self.filter_sigma
+                )
+                counts['whitens'] += 1
+            sources.append((tile, region, origin))
+        return sources
+
+    def _edge_crops(self, sources, offsets, shape, counts):
+        img1, img2 = (
+            self._edge_crop(source, offset, shape, counts)
+            for source, offset in zip(sources, offsets)
+        )
+        return img1, img2
+
+    def _edge_crop(self, source, offset, shape, counts):
+        tile, region, origin = source
+        if region is not None:
+            # The final error window is shifted from the nominal overlap and
+            # may fall outside the whitened region. Windows running past the
+            # tile edge are clipped the same way in the region and the tile,
+            # so only those cut short by the region itself need the tile.
+            start = offset.round().astype(int)
+            end = start + shape
+            size = self.metadata.size
+            region_end = origin + region.shape
+            if tile is None or ((start >= origin).all() and (
+                (np.minimum(end, size) <= region_end) | (region_end == size)
+            ).all()):
+                start = start - origin
+                end = end - origin
+                return region[start[0]:end[0], start[1]:end[1]]
+        counts['whitens'] += 1
+        return utils.whiten(utils.crop(tile, offset, shape), self.filter_sigma)
+
     def _register(self, t1, t2, min_size=0):
-        its, img1, img2 = self.overlap(t1, t2, min_size)
+        its = self.intersection(t1, t2, min_size)
+        return self._register_window(
+            t1, t2, its.shape, its.padding, its.offsets
+        )
+
+    def _register_window(self, t1, t2, shape, padding, offsets):
+        img1, img2 = self._whitened_crops(t1, t2, offsets, shape)
+        return self._register_whitened_window(t1, t2, img1, img2, padding)
+
+    def _register_whitened_window(
+        self, t1, t2, img1, img2, padding, upsample=10
+    ):
         # Account for padding, flipping the sign depending on the direction
         # between the tiles.
-        p1, p2 = self.metadata.positions[[t1, t2]]
+        p1, p2 = self._nominal_positions[[t1, t2]]
         sx = 1 if p1[1] >= p2[1] else -1
         sy = 1 if p1[0] >= p2[0] else -1
-        padding = its.padding * [sy, sx]
-        shift, error = utils.register(img1, img2, self.filter_sigma)
+        padding = padding * [sy, sx]
+        shift, error = utils.register_whitened(
+            img1, img2, upsample=upsample, workspace=self._fft
+        )
         shift += padding
         return shift, error
 
+    def _whitened_tile(self, tile):
+        img = self._whitened.get(tile)
+        if img is None:
+            img = utils.whiten(
+                self.reader.read(series=tile, c=self.channel), self.filter_sigma
+            )
+            self._whitened.put(tile, img)
+        return img
+
+    def _whitened_overlap(self, t1, t2, min_size=0, shift=None):
+        """Like `overlap`, but return the images after `utils.whiten`."""
+        its = self.intersection(t1, t2, min_size, shift)
+        img1, img2 = self._whitened_crops(t1, t2, its.offsets, its.shape)
+        return its, img1, img2
+
+    def _whitened_crops(self, t1, t2, offsets, shape):
+        if self.whitening == 'tile':
+            img1 = utils.crop(self._whitened_tile(t1), offsets[0], shape)
+            img2 = utils.crop(self._whitened_tile(t2), offsets[1], shape)
+        else:
+            img1 = utils.whiten(self.crop(t1, offsets[0], shape), self.filter_sigma)
+            img2 = utils.whiten(self.crop(t2, offsets[1], shape), self.filter_sigma)
+        return img1, img2
+
+    @property
+    def intersections(self):
+        """IntersectionTable of the nominal overlaps of all neighbor edges.
+
+        Rows are in `neighbors_graph.edges` order, with the tiles of each
+        edge in ascending order; `edge_index` maps (t1, t2) to a row.
+
+        """
+        if not hasattr(self, '_intersections'):
+            self._build_intersections()
+        return self._intersections
+
+    @property
+    def _nominal_positions(self):
+        if not hasattr(self, '_intersections'):
+            self._build_intersections()
+        return self._positions
+
+    @property
+    def edge_index(self):
+        if not hasattr(self, '_intersections'):
+            self._build_intersections()
+        return self._edge_index
+
+    def _edge_table(self, min_size):
+        corners1 = self._positions[self._edges]
+        corners2 = corners1 + self.metadata.size
+        return IntersectionTable(corners1, corners2, min_size)
+
+    def _build_intersections(self):
+        self._positions = self.metadata.positions
+        edges = [tuple(sorted(e)) for e in self.neighbors_graph.edges]
+        self._edges = np.array(edges, dtype=int).reshape(-1, 2)
+        self._edge_index = {e: i for i, e in enumerate(edges)}
+        table = self._edge_table(0)
+        self._intersections = table
+        # Precompute the window ladder used by _register_edge for every edge:
+        # windows start at the nominal overlap and double until at least 10%
+        # of the tile size. Edges stop at different rungs, so we record how
+        # many tables apply to each.
+        # The pyramid's coarse windows allow for max_shift either way.
+        margin = 2 * int(np.ceil(self.max_shift_pixels))
+        self._coarse_table = self._edge_table(table.shape + margin)
+        smax = np.round(self.metadata.size * 0.1)
+        sizes = table.shape
+        self._window_tables = [self._edge_table(sizes)]
+        self._window_counts = np.ones(len(edges), dtype=int)
+        growing = np.any(sizes < smax, axis=1)
+        while growing.any():
+            sizes = sizes * 2
+            self._window_tables.append(self._edge_table(sizes))
+            self._window_counts[growing] += 1
+            growing &= np.any(sizes < smax, axis=1)
+
     def intersection(self, t1, t2, min_size=0, shift=None):
         corners1 = self.metadata.positions[[t1, t2]]
         if shift is not None:
@@ -787,7 +1707,8 @@ class EdgeAligner(object):
 class LayerAligner(object):
 
     def __init__(self, reader, reference_aligner, channel=None, max_shift=15,
-                 filter_sigma=0.0, verbose=False):
+                 filter_sigma=0.0, verbose=False, checkpoint_path=None,
+                 resume=False, executor='serial', workers=None):
         self.reader = reader
         self.reference_aligner = reference_aligner
         if channel is None:
@@ -798,6 +1719,16 @@ class LayerAligner(object):
         self.max_shift_pixels = self.max_shift / self.metadata.pixel_size
         self.filter_sigma = filter_sigma
         self.verbose = verbose
+        self.executor = executor
+        self.workers = workers
+        self._fft = utils.FFTWorkspace()
+        # Our reader isn't wrapped in a CachingReader, so we serialize reads
+        # from worker threads here.
+        self._read_lock = threading.Lock()
+        if resume and checkpoint_path is None:
+            raise ValueError("resume requires a checkpoint_path")
+        self.checkpoint_path = checkpoint_path
+        self.resume = resume
         # FIXME Still a bit muddled here on the use of metadata positions vs.
         # corrected positions from the reference aligner. We probably want to
         # use metadata positions to find the cycle-to-cycle tile
@@ -806,20 +1737,43 @@ class LayerAligner(object):
 
     neighbors_graph = neighbors_graph
 
+    # The stages of run, with the attributes holding their outputs.
+    stages = (
+        ('make_thumbnail', ('reader.thumbnail',)),
+        ('coarse_align', (
+            'cycle_offset', 'corrected_nominal_positions', 'reference_idx',
+            'reference_positions', 'reference_aligner_positions',
+        )),
+        ('register_all', ('shifts', 'errors')),
+        ('calculate_positions', ('positions', 'discard', 'offset', 'centers')),
+    )
+
     def run(self):
-        self.make_thumbnail()
-        self.coarse_align()
-        self.register_all()
-        self.calculate_positions()
+        run_stages(self, self.stages, self._checkpoint())
+
+    def _checkpoint(self):
+        if self.checkpoint_path is None:
+            return None
+        # Our results also depend on the reference aligner's.
+        n = self.metadata.num_images
+        fingerprint = (
+            'LayerAligner', _version, self.channel, self.max_shift,
+            self.filter_sigma, tuple(self.metadata.size),
+            tuple(self.reader.tile_digest(i, self.channel) for i in range(n)),
+            cache.array_digest(self.metadata.positions),
+            tuple(self.reference_aligner.tile_digests),
+            cache.array_digest(self.reference_aligner.positions),
+        )
+        return cache.Checkpoint(self.checkpoint_path, fingerprint)
 
     def make_thumbnail(self):
         self.reader.thumbnail = thumbnail.make_thumbnail(
-            self.reader, channel=self.channel
+            self.reader, channel=self.channel, verbose=self.verbose
         )
 
     def coarse_align(self):
         self.cycle_offset = thumbnail.calculate_cycle_offset(
-            self.reference_aligner.reader, self.reader
+            self.reference_aligner.reader, self.reader, verbose=self.verbose
         )
         self.corrected_nominal_positions = self.metadata.positions + self.cycle_offset
         reference_positions = self.reference_aligner.metadata.positions
@@ -831,17 +1785,64 @@ class LayerAligner(object):
 
     def register_all(self):
         n = self.metadata.num_images
+        def progress(done, total):
+            sys.stdout.write("\r    aligning tile %d/%d" % (done, total))
+            sys.stdout.flush()
+        with self._worker_pool() as pool:
+            results, self.register_stats = pool.map(
+                'register', [(i,) for i in range(n)],
+                progress=progress if self.verbose else None
+            )
         self.shifts = np.empty((n, 2))
         self.errors = np.empty(n)
-        for i in range(n):
-            if self.verbose:
-                sys.stdout.write("\r    aligning tile %d/%d" % (i + 1, n))
-                sys.stdout.flush()
-            shift, error = self.register(i)
+        for i, (shift, error) in enumerate(results):
             self.shifts[i] = shift
             self.errors[i] = error
         if self.verbose:
             print()
+            stats = self.register_stats
+            print(
+                '    aligned %d tiles in %.2fs (%.1fx speedup)'
+                % (stats.num_tasks, stats.wall, stats.speedup)
+            )
+
+    @contextlib.contextmanager
+    def _worker_pool(self):
+        """Context manager providing a WorkerPool on our executor."""
+        worker_target = None
+        if self.executor == 'process':
+            worker_target = self._worker_copy()
+        try:
+            with parallel.WorkerPool(
+                self, self.executor, self.workers, worker_target
+            ) as pool:
+                yield pool
+        finally:
+            if worker_target is not None:
+                worker_target.reader.close()
+                worker_target.reference_aligner.reader.close()
+
+    def _worker_copy(self):
+        """Return a copy of this aligner for use in process pool workers.
+
+        The copy reads both its own and the reference tiles of the alignment
+        channels from shared memory, and only what `register` needs of the
+        reference aligner, so it is cheap to pickle.
+
+        """
+        worker = copy.copy(self)
+        worker.reader = SharedTileReader(self.reader, self.channel)
+        worker.reference_aligner = ReferenceTiles(self.reference_aligner)
+        return worker
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_read_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._read_lock = threading.Lock()
 
     def calculate_positions(self):
         self.positions = (
@@ -896,7 +1897,9 @@ class LayerAligner(object):
         its, ref_img, img = self.overlap(t)
         if np.any(np.array(its.shape) == 0):
             return (0, 0), np.inf
-        shift, error = utils.register(ref_img, img, self.filter_sigma)
+        shift, error = utils.register(
+            ref_img, img, self.filter_sigma, workspace=self._fft
+        )
         # We don't use padding and thus can skip the math to account for it.
         assert (its.padding == 0).all(), "Unexpected non-zero padding"
         return shift, error
@@ -915,7 +1918,8 @@ class LayerAligner(object):
         img1 = self.reference_aligner.reader.read(
             series=ref_t, c=self.reference_aligner.channel
         )
-        img2 = self.reader.read(series=t, c=self.channel)
+        with self._read_lock:
+            img2 = self.reader.read(series=t, c=self.channel)
         ov1 = utils.crop(img1, its.offsets[0], its.shape)
         ov2 = utils.crop(img2, its.offsets[1], its.shape)
         return its, ov1, ov2
@@ -972,12 +1976,86 @@ class Intersection(object):
         return s.format(self)
 
 
+class IntersectionTable(object):
+    """Intersections for many pairs of rectangles, computed all at once.
+
+    `corners1` and `corners2` have shape (n, 2, 2), holding the upper-left and
+    lower-right corners of n pairs of rectangles, and `min_size` is a scalar
+    or an (n, 2) array. Row i of the `shape`, `padding` and `offsets` arrays
+    holds what Intersection(corners1[i], corners2[i], min_size[i]) would, and
+    indexing the table returns that Intersection.
+
+    """
+
+    def __init__(self, corners1, corners2, min_size=0):
+        max_shape = (corners2 - corners1).max(axis=1)
+        min_size = np.broadcast_to(min_size, max_shape.shape)
+        min_size = min_size.clip(1, max_shape)
+        position = corners1.max(axis=1)
+        initial_shape = np.floor(corners2.min(axis=1) - position).astype(int)
+        clipped_shape = np.maximum(initial_shape, min_size)
+        self.shape = np.ceil(clipped_shape).astype(int)
+        self.padding = self.shape - initial_shape
+        self.offsets = np.maximum(
+            position[:, None] - corners1 - self.padding[:, None], 0
+        )
+
+    def __len__(self):
+        return len(self.shape)
+
+    def __getitem__(self, i):
+        its = Intersection.__new__(Intersection)
+        its.shape = self.shape[i]
+        its.padding = self.padding[i]
+        its.offsets = self.offsets[i]
+        return its
+
+
+class AlignmentResult(object):
+    """Final tile positions and the reader they refer to.
+
+    This is the part of an aligner that Mosaic needs, without the alignment
+    state or tile cache, so it is cheap to send to worker processes.
+
+    """
+
+    def __init__(self, aligner):
+        self.positions = aligner.positions
+        reader = aligner.reader
+        if isinstance(reader, CachingReader):
+            reader = reader.reader
+        self.reader = reader
+
+    @property
+    def metadata(self):
+        return self.reader.metadata
+
+
+class ReferenceTiles(object):
+    """The alignment channel of a reference aligner's tiles in shared memory.
+
+    This stands in for the reference aligner in LayerAligner's process pool
+    workers, which only read the reference tiles.
+
+    """
+
+    def __init__(self, aligner):
+        self.channel = aligner.channel
+        self.reader = SharedTileReader(aligner.reader, aligner.channel)
+
+
+# Mosaic output formats: TIFF files, or OME-Zarr (NGFF) directory stores.
+OUTPUT_FORMATS = ('tiff', 'ngff')
+
+
 class Mosaic(object):
 
     def __init__(
             self, aligner, shape, filename_format, channels=None,
             ffp_path=None, dfp_path=None, flip_mosaic_x=False, flip_mosaic_y=False,
-            combined=False, tile_size=None, first=False, verbose=False
+            combined=False, tile_size=None, first=False, verbose=False,
+            streaming=False, executor='serial', workers=None,
+            subpixel='spline', compression='none', output_format='tiff'
     ):
         self.aligner = aligner
         self.shape = tuple(shape)
@@ -991,6 +2069,32 @@ class Mosaic(object):
         self.dtype = aligner.metadata.pixel_dtype
         self._load_correction_profiles(dfp_path, ffp_path)
         self.verbose = verbose
+        self.streaming = streaming
+        if executor not in parallel.EXECUTORS:
+            raise ValueError(
+                "executor must be one of %s" % ', '.join(parallel.EXECUTORS)
+            )
+        self.executor = executor
+        self.workers = workers
+        if subpixel not in utils.SUBPIXEL_METHODS:
+            raise ValueError(
+                "subpixel must be one of %s"
+                % ', '.join(utils.SUBPIXEL_METHODS)
+            )
+        self.subpixel = subpixel
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                "output_format must be one of %s" % ', '.join(OUTPUT_FORMATS)
+            )
+        self.output_format = output_format
+        # Fail on a missing codec now rather than after assembling a channel.
+        if self.ngff:
+            ngff.check_compression(compression)
+        else:
+            utils.compression_kwargs(compression)
+        self.compression = compression
+        # Readers are generally not thread-safe.
+        self._read_lock = threading.Lock()
 
     def _sanitize_channels(self, channels):
         all_channels = range(self.aligner.metadata.num_channels)
@@ -1068,84 +2172,484 @@ class Mosaic(object):
             self.dfp /= np.iinfo(self.dtype).max
             self.do_correction = True
 
+    @property
+    def ngff(self):
+        return self.output_format == 'ngff'
+
+    @property
+    def block_size(self):
+        """Edge length of the square output blocks used in streaming mode."""
+        return self.tile_size or 1024
+
     def run(self, mode='write', debug=False):
         if mode not in ('write', 'return'):
             raise ValueError('Invalid mode')
-        num_tiles = len(self.aligner.positions)
+        if self.streaming:
+            if mode != 'write' or debug:
+                raise ValueError(
+                    "Streaming mode only supports mode='write' without debug"
+                )
+            self.run_streaming()
+            return
         all_images = []
         if debug:
-            node_colors = nx.greedy_color(self.aligner.neighbors_graph)
-            num_colors = max(node_colors.values()) + 1
-            if num_colors > 3:
-                raise ValueError("neighbor graph requires more than 3 colors")
-        for ci, channel in enumerate(self.channels):
-            if self.verbose:
-                print('    Channel %d:' % channel)
-            if not debug:
-                mosaic_image = np.zeros(self.shape, self.dtype)
-            else:
-                mosaic_image = np.zeros(self.shape + (3,), np.float32)
-            for tile, position in enumerate(self.aligner.positions):
-                if self.verbose:
-                    sys.stdout.write('\r        merging tile %d/%d'
-                                     % (tile + 1, num_tiles))
-                    sys.stdout.flush()
-                tile_image = self.aligner.reader.read(c=channel, series=tile)
-                tile_image = self.correct_illumination(tile_image, channel)
-                if debug:
-                    color_channel = node_colors[tile]
-                    rgb_image = np.zeros(tile_image.shape + (3,),
-                                         tile_image.dtype)
-                    rgb_image[:,:,color_channel] = tile_image
-                    tile_image = rgb_image
-                func = utils.pastefunc_blend if not debug else np.add
-                utils.paste(mosaic_image, tile_image, position, func=func)
-            if debug:
-                np.clip(mosaic_image, 0, 1, out=mosaic_image)
-                w = int(1e6)
-                mi_flat = mosaic_image.reshape(-1, 3)
-                for p in np.arange(0, mi_flat.shape[0], w, dtype=int):
-                    mi_flat[p:p+w] = skimage.exposure.adjust_gamma(
-                        mi_flat[p:p+w], 1/2.2
-                    )
+            channel_images = self._assemble_debug()
+        else:
+            channel_images = self._assemble_parallel(mode)
+        for ci, channel, mosaic_image in channel_images:
             if self.flip_mosaic_x:
                 mosaic_image = np.fliplr(mosaic_image)
             if self.flip_mosaic_y:
                 mosaic_image = np.flipud(mosaic_image)
-            if self.verbose:
-                print()
             if mode == 'write':
                 filename = self.filename_format.format(channel=channel)
-                kwargs = {}
-                if self.combined:
-                    kwargs['bigtiff'] = True
-                    # FIXME Propagate this from input files (esp. RGB).
-                    kwargs['photometric'] = 'minisblack'
-                    resolution = np.round(10000 / self.aligner.reader.metadata.pixel_size)
-                    # FIXME Switch to "CENTIMETER" once we use tifffile directly.
-                    kwargs['resolution'] = (resolution, resolution, 'cm')
-                    kwargs['metadata'] = None
-                    if self.first and ci == 0:
-                        # Set description to a short placeholder that will fit
-                        # within the IFD. We'll check for this string later.
-                        kwargs['description'] = '!!xml!!'
-                        kwargs['software'] = (
-                            'Ashlar v{} (Glencoe/Faas pyramid output)'
-                            .format(_version)
-                        )
-                    else:
-                        # Overwite if first channel of first cycle.
-                        kwargs['append'] = True
+                kwargs = self._write_kwargs(ci)
                 if self.tile_size:
                     kwargs['tile'] = (self.tile_size, self.tile_size)
                 if self.verbose:
                     print("        writing to %s" % filename)
-                utils.imsave(filename, mosaic_image, **kwargs)
+                if self.ngff:
+                    b = self.block_size
+                    self._write_ngff(ci, filename, pyramid.strip_blocks(
+                        pyramid.array_strips(mosaic_image, b), b
+                    ))
+                elif self.compression != 'none':
+                    # The vendored tifffile behind utils.imsave can't use
+                    # the other codecs, so write compressed output in tiles.
+                    b = self.block_size
+                    kwargs.pop('tile', None)
+                    utils.imsave_blocks(
+                        filename,
+                        pyramid.strip_blocks(
+                            pyramid.array_strips(mosaic_image, b), b
+                        ),
+                        mosaic_image.shape, mosaic_image.dtype, (b, b),
+                        **kwargs
+                    )
+                else:
+                    utils.imsave(filename, mosaic_image, **kwargs)
             elif mode == 'return':
                 all_images.append(mosaic_image)
+            # Let the channel go before the next one is assembled.
+            del mosaic_image
         if mode == 'return':
             return all_images
 
+    def _assemble_debug(self):
+        num_tiles = len(self.aligner.positions)
+        node_colors = nx.greedy_color(self.aligner.neighbors_graph)
+        num_colors = max(node_colors.values()) + 1
+        if num_colors > 3:
+            raise ValueError("neighbor graph requires more than 3 colors")
+        for ci, channel in enumerate(self.channels):
+            if self.verbose:
+                print('    Channel %d:' % channel)
+            mosaic_image = np.zeros(self.shape + (3,), np.float32)
+            for tile, position in enumerate(self.aligner.positions):
+                if self.verbose:
+                    sys.stdout.write('\r        merging tile %d/%d'
+                                     % (tile + 1, num_tiles))
+                    sys.stdout.flush()
+                tile_image = self._read_tile(tile, channel)
+                color_channel = node_colors[tile]
+                rgb_image = np.zeros(tile_image.shape + (3,), tile_image.dtype)
+                rgb_image[:,:,color_channel] = tile_image
+                utils.paste(
+                    mosaic_image, rgb_image, position, func=np.add,
+                    subpixel=self.subpixel
+                )
+            np.clip(mosaic_image, 0, 1, out=mosaic_image)
+            w = int(1e6)
+            mi_flat = mosaic_image.reshape(-1, 3)
+            for p in np.arange(0, mi_flat.shape[0], w, dtype=int):
+                mi_flat[p:p+w] = skimage.exposure.adjust_gamma(
+                    mi_flat[p:p+w], 1/2.2
+                )
+            if self.verbose:
+                print()
+            yield ci, channel, mosaic_image
+
+    def _assemble_parallel(self, mode):
+        """Assemble channel mosaics on a worker pool.
+
+        The mosaic is split into horizontal bands, one per worker. In 'write'
+        mode channels are assembled one at a time, so only one channel's
+        mosaic is held while it is written. In 'return' mode all channels are
+        assembled in one wave, and each task assembles one band for a group
+        of channels, so each tile is read once per channel and band it
+        touches. Blending only depends on the tiles covering each pixel, so
+        the result is identical for any executor and worker count.
+
+        """
+        with self._worker_pool() as pool:
+            regions = self._regions(pool.workers)
+            if mode == 'return':
+                wave_size = len(self.channels)
+            else:
+                wave_size = 1
+            indexed = list(enumerate(self.channels))
+            for w in range(0, len(indexed), wave_size):
+                wave = indexed[w:w + wave_size]
+                # Split the wave's channels further if there aren't enough
+                # bands to keep every worker busy.
+                num_groups = min(len(wave), -(-pool.workers // len(regions)))
+                groups = [wave[g::num_groups] for g in range(num_groups)]
+                arglist = [
+                    (y1, y2, [c for _, c in group])
+                    for group in groups for y1, y2 in regions
+                ]
+                if self.verbose:
+                    print('    Channels %s:'
+                          % ', '.join(str(c) for _, c in wave))
+                    def progress(n, total):
+                        sys.stdout.write('\r        merged %d/%d regions'
+                                         % (n, total))
+                        sys.stdout.flush()
+                else:
+                    progress = None
+                results, stats = pool.map(
+                    '_assemble_region', arglist, batch_size=1,
+                    progress=progress
+                )
+                if self.verbose:
+                    print()
+                    print('        %r' % stats)
+                bands = {channel: [] for _, channel in wave}
+                for (y1, y2, channels), images in zip(arglist, results):
+                    for channel, image in zip(channels, images):
+                        bands[channel].append((y1, y2, image))
+                # Only the bands should hold on to the images from here on.
+                results = images = image = None
+                for ci, channel in wave:
+                    channel_bands = bands.pop(channel)
+                    if len(channel_bands) == 1:
+                        mosaic_image = channel_bands.pop()[2]
+                    else:
+                        # Drop each band once copied so the channel is held
+                        # about once rather than twice.
+                        mosaic_image = np.empty(self.shape, self.dtype)
+                        while channel_bands:
+                            y1, y2, image = channel_bands.pop()
+                            mosaic_image[y1:y2] = image
+                            del image
+                    yield ci, channel, mosaic_image
+                    del mosaic_image
+
+    def _regions(self, num_regions):
+        """Split the mosaic rows into up to `num_regions` bands.
+
+        Bands are at least one tile tall so that no tile has to be read for
+        more than two or three of them.
+
+        """
+        height = self.shape[0]
+        tile_height = self.aligner.metadata.size[0]
+        num_regions = max(1, min(num_regions, height // tile_height))
+        edges = np.linspace(0, height, num_regions + 1).round().astype(int)
+        return list(zip(edges[:-1], edges[1:]))
+
+    def _assemble_region(self, y1, y2, channels):
+        """Return the mosaic rows y1:y2 for each of `channels`.
+
+        The rows are blended one block of `block_size` pixels at a time, so
+        the float32 blending buffers are small next to the output whatever
+        the size of the mosaic. Tiles are read and placed once per channel and
+        kept while the blocks they overlap are being blended.
+
+        """
+        b = self.block_size
+        width = self.shape[1]
+        positions = self.aligner.positions
+        # Conservative tile extents allowing for the sub-pixel shift.
+        lower = np.floor(positions).astype(int) - 1
+        upper = lower + self.aligner.metadata.size + 2
+        images = []
+        for channel in channels:
+            image = np.empty((y2 - y1, width), self.dtype)
+            prepared = {}
+            for by in range(y1, y2, b):
+                bh = min(b, y2 - by)
+                in_rows = np.flatnonzero(
+                    (lower[:, 0] < by + bh) & (upper[:, 0] > by)
+                )
+                for bx in range(0, width, b):
+                    bw = min(b, width - bx)
+                    blender = utils.WeightedBlender((bh, bw), self.dtype)
+                    for tile in in_rows[
+                        (lower[in_rows, 1] < bx + bw) & (upper[in_rows, 1] > bx)
+                    ]:
+                        if tile not in prepared:
+                            tile_image = self._read_tile(tile, channel)
+                            prepared[tile] = utils.place_weighted(
+                                tile_image, positions[tile], self.shape,
+                                self.subpixel
+                            )
+                        if prepared[tile] is None:
+                            continue
+                        img, weights, (yi, xi) = prepared[tile]
+                        blender.add(img, weights, (yi - by, xi - bx))
+                    image[by - y1:by - y1 + bh, bx:bx + bw] = blender.result()
+                # Tiles ending in this row of blocks aren't needed again.
+                for tile in [t for t in prepared if upper[t, 0] <= by + bh]:
+                    del prepared[tile]
+            images.append(image)
+        return images
+
+    def _read_tile(self, tile, channel):
+        with self._read_lock:
+            tile_image = self.aligner.reader.read(c=channel, series=tile)
+        return self.correct_illumination(tile_image, channel)
+
+    @contextlib.contextmanager
+    def _worker_pool(self):
+        """Context manager providing a WorkerPool on our executor."""
+        worker_target = None
+        if self.executor == 'process':
+            worker_target = copy.copy(self)
+            worker_target.aligner = AlignmentResult(self.aligner)
+        with parallel.WorkerPool(
+            self, self.executor, self.workers, worker_target
+        ) as pool:
+            yield pool
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_read_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._read_lock = threading.Lock()
+
+    def _write_kwargs(self, ci):
+        kwargs = {}
+        if self.combined:
+            kwargs['bigtiff'] = True
+            # FIXME Propagate this from input files (esp. RGB).
+            kwargs['photometric'] = 'minisblack'
+            resolution = np.round(10000 / self.aligner.reader.metadata.pixel_size)
+            # FIXME Switch to "CENTIMETER" once we use tifffile directly.
+            kwargs['resolution'] = (resolution, resolution, 'cm')
+            kwargs['metadata'] = None
+            if self.first and ci == 0:
+                # Set description to a short placeholder that will fit
+                # within the IFD. We'll check for this string later.
+                kwargs['description'] = '!!xml!!'
+                kwargs['software'] = (
+                    'Ashlar v{} (Glencoe/Faas pyramid output)'
+                    .format(_version)
+                )
+            else:
+                # Overwite if first channel of first cycle.
+                kwargs['append'] = True
+        if self.compression != 'none':
+            kwargs.update(utils.compression_kwargs(self.compression))
+            # tifffile compresses the tiles on a pool of threads.
+            kwargs['maxworkers'] = self.workers
+        return kwargs
+
+    def run_streaming(self):
+        """Assemble and write each channel one output block at a time.
+
+        Instead of allocating the whole mosaic, blocks of `block_size` pixels
+        are assembled from the tiles that overlap them and written straight
+        to a tiled BigTIFF, so memory use depends on the tile and block sizes
+        but not on the size of the slide. Tiles are read, corrected and
+        sub-pixel shifted once per visit in a small LRU, so a tile may be read
+        again for each row of blocks it spans. Blending only depends on the
+        tiles covering each pixel, so the output is identical to `run`.
+
+        """
+        b = self.block_size
+        for ci, channel in enumerate(self.channels):
+            if self.verbose:
+                print('    Channel %d:' % channel)
+            filename = self.filename_format.format(channel=channel)
+            if self.ngff:
+                self._write_ngff(ci, filename, self._iter_blocks(channel))
+            else:
+                kwargs = self._write_kwargs(ci)
+                kwargs.setdefault('photometric', 'minisblack')
+                kwargs.setdefault('metadata', None)
+                utils.imsave_blocks(
+                    filename, self._iter_blocks(channel), self.shape,
+                    self.dtype, (b, b), **kwargs
+                )
+            if self.verbose:
+                print()
+                print("        wrote %s" % filename)
+
+    def _write_ngff(self, ci, filename, blocks):
+        # Combined output puts every channel of every cycle in one store,
+        # created by the first channel of the first cycle.
+        if not self.combined or (self.first and ci == 0):
+            ngff.create(filename)
+        ngff.write_channel(
+            filename, blocks, self.shape, self.dtype, self.block_size,
+            self.compression, self.workers
+        )
+
+    def write_levels(self):
+        """Append reduced levels to each channel file written by `run`.
+
+        Each file gets the levels `pyramid.write_levels` builds for a single
+        channel, so viewers can read zoomed-out regions without reducing the
+        full-resolution image, and `update` keeps them current.
+
+        """
+        if self.combined or self.ngff:
+            raise ValueError(
+                "Reduced levels can only be added to separate TIFF files"
+            )
+        b = self.block_size
+        shapes = pyramid.level_shapes(self.shape, b)
+        for channel in self.channels:
+            filename = self.filename_format.format(channel=channel)
+            if self.verbose:
+                print('    Channel %d levels:' % channel)
+            pyramid.write_levels(
+                filename, 1, shapes, self.dtype, b, self.verbose,
+                self.executor, self.workers, self.compression
+            )
+
+    def update(self, regions):
+        """Re-render the output blocks overlapping `regions` in place.
+
+        `regions` are ((y1, x1), (y2, x2)) boxes in mosaic coordinates, e.g.
+        the old and new extents of tiles that changed since the output files
+        were written by `run_streaming` with the same shape and block size.
+        Only the blocks touching a region are assembled and overwritten; the
+        rest of each file is left as it is. Reduced levels added by
+        `write_levels` or `ngff.build_multiscales` are updated to match.
+        Returns the number of blocks rewritten per channel.
+
+        """
+        if self.combined:
+            raise ValueError("Combined output files can't be updated in place")
+        if self.compression != 'none' and not self.ngff:
+            raise ValueError(
+                "Compressed output files can't be updated in place"
+            )
+        b = self.block_size
+        h, w = self.shape
+        cols = -(-w // b)
+        indices = set()
+        for (y1, x1), (y2, x2) in regions:
+            # Allow for the sub-pixel shift as in _iter_blocks.
+            y1, x1 = max(int(np.floor(y1)) - 1, 0), max(int(np.floor(x1)) - 1, 0)
+            y2, x2 = min(int(np.ceil(y2)) + 1, h), min(int(np.ceil(x2)) + 1, w)
+            if y1 >= y2 or x1 >= x2:
+                continue
+            # Output blocks are laid out on the flipped image.
+            if self.flip_mosaic_y:
+                y1, y2 = h - y2, h - y1
+            if self.flip_mosaic_x:
+                x1, x2 = w - x2, w - x1
+            for by in range(y1 // b, (y2 - 1) // b + 1):
+                for bx in range(x1 // b, (x2 - 1) // b + 1):
+                    indices.add(by * cols + bx)
+        indices = sorted(indices)
+        for channel in self.channels:
+            filename = self.filename_format.format(channel=channel)
+            if self.verbose:
+                print('    Channel %d:' % channel)
+            blocks = zip(indices, self._iter_blocks(channel, indices))
+            if self.ngff:
+                # Each store holds one channel, and chunks are whole blocks.
+                array = ngff.ZarrArray(os.path.join(filename, '0'))
+                for index, block in blocks:
+                    array.write_chunk(0, index // cols, index % cols, block)
+                # Keep any levels added by build_multiscales in step.
+                ngff.update_levels(
+                    filename, 0, {index // cols for index in indices}
+                )
+            else:
+                utils.rewrite_blocks(
+                    filename, blocks, self.shape, self.dtype, (b, b)
+                )
+                # Keep the reduced levels added by write_levels in step.
+                if pyramid.has_levels(filename):
+                    pyramid.update_levels(filename, indices)
+            if self.verbose:
+                print()
+                print("        updated %d blocks in %s"
+                      % (len(indices), filename))
+        return len(indices)
+
+    def _iter_blocks(self, channel, indices=None):
+        """Yield the mosaic for `channel` in row-major blocks.
+
+        If `indices` is given, only yield the blocks at those positions in the
+        row-major order.
+
+        """
+        b = self.block_size
+        h, w = self.shape
+        positions = self.aligner.positions
+        # Conservative tile extents allowing for the sub-pixel shift.
+        lower = np.floor(positions).astype(int) - 1
+        upper = lower + self.aligner.metadata.size + 2
+        block_origins = [
+            (y, x) for y in range(0, h, b) for x in range(0, w, b)
+        ]
+        if indices is not None:
+            block_origins = [block_origins[i] for i in indices]
+        overlapping = []
+        for y, x in block_origins:
+            by, bx = self._mosaic_block_origin(y, x)
+            bh, bw = min(b, h - y), min(b, w - x)
+            overlapping.append(np.flatnonzero(
+                (lower[:, 0] < by + bh) & (upper[:, 0] > by)
+                & (lower[:, 1] < bx + bw) & (upper[:, 1] > bx)
+            ))
+        # Keep enough prepared tiles to cover the current and the next block.
+        capacity = 2 * max(len(o) for o in overlapping) if overlapping else 0
+        prepared = collections.OrderedDict()
+        for i, ((y, x), tiles) in enumerate(zip(block_origins, overlapping)):
+            if self.verbose:
+                sys.stdout.write('\r        merging block %d/%d'
+                                 % (i + 1, len(block_origins)))
+                sys.stdout.flush()
+            by, bx = self._mosaic_block_origin(y, x)
+            blender = utils.WeightedBlender(
+                (min(b, h - y), min(b, w - x)), self.dtype
+            )
+            for tile in tiles:
+                if tile in prepared:
+                    prepared.move_to_end(tile)
+                else:
+                    tile_image = self._read_tile(tile, channel)
+                    prepared[tile] = utils.place_weighted(
+                        tile_image, positions[tile], self.shape, self.subpixel
+                    )
+                    while len(prepared) > capacity:
+                        prepared.popitem(last=False)
+                if prepared[tile] is None:
+                    continue
+                img, weights, (yi, xi) = prepared[tile]
+                blender.add(img, weights, (yi - by, xi - bx))
+            block = blender.result()
+            if self.flip_mosaic_x:
+                block = np.fliplr(block)
+            if self.flip_mosaic_y:
+                block = np.flipud(block)
+            yield block
+
+    def _mosaic_block_origin(self, y, x):
+        """Return the mosaic coordinates of the output block at (y, x).
+
+        Output blocks are laid out on the final (possibly flipped) image, so
+        for flipped axes the block maps to the mirrored mosaic region.
+
+        """
+        b = self.block_size
+        h, w = self.shape
+        if self.flip_mosaic_y:
+            y = h - y - min(b, h - y)
+        if self.flip_mosaic_x:
+            x = w - x - min(b, w - x)
+        return y, x
+
     def correct_illumination(self, img, channel):
         if self.do_correction:
             img = skimage.util.img_as_float(img, force_copy=True)
@@ -1156,37 +2660,23 @@ class Mosaic(object):
 
 
 def build_pyramid(
-        path, num_channels, shape, dtype, pixel_size, tile_size, verbose=False
+        path, num_channels, shape, dtype, pixel_size, tile_size, verbose=False,
+        executor='serial', workers=None, compression='none'
 ):
-    max_level = 0
-    shapes = [shape]
-    while any(s > tile_size for s in shape):
-        prev_level = max_level
-        max_level += 1
-        if verbose:
-            print("    Level %d:" % max_level)
-        for i in range(num_channels):
-            if verbose:
-                sys.stdout.write('\r        processing channel %d/%d'
-                                 % (i + 1, num_channels))
-                sys.stdout.flush()
-            img = skimage.io.imread(path, series=prev_level, key=i)
-            img = skimage.transform.pyramid_reduce(img, multichannel=False)
-            img = skimage.util.dtype.convert(img, dtype)
-            utils.imsave(
-                path, img, bigtiff=True, metadata=None, append=True,
-                tile=(tile_size, tile_size), photometric='minisblack'
-            )
-        shapes.append(img.shape)
-        if verbose:
-            print()
-        shape = img.shape
+    # The reduced levels are built in one streaming pass over the base level,
+    # or in bands of rows on a worker pool.
+    shapes = pyramid.level_shapes(shape, tile_size)
+    max_level = len(shapes) - 1
+    pyramid.write_levels(
+        path, num_channels, shapes, dtype, tile_size, verbose=verbose,
+        executor=executor, workers=workers, compression=compression
+    )
     # Now that we have the number and dimensions of all levels, we can generate
     # the corresponding OME-XML and patch it into the Image Description tag of
     # the first IFD.
     filename = pathlib.Path(path).name
     img_uuid = uuid.uuid4().urn
-    ome_dtype = BioformatsMetadata._ome_dtypes[dtype]
+    ome_dtype = BioformatsMetadata._ome_dtypes[np.dtype(dtype)]
     ifd = 0
     xml = io.StringIO()
     xml.write(u'<?xml version="1.0" encoding="UTF-8"?>')
@@ -3,6 +3,7 @@ import sys
 import re
 import argparse
 import pathlib
+import collections
 import blessed
 from .. import __version__ as VERSION
 from .. import reg
@@ -72,15 +73,40 @@ def main(argv=sys.argv):
     )
     parser.add_argument(
         '--pyramid', default=False, action='store_true',
-        help='write output as a single pyramidal TIFF'
+        help=('write output as a single pyramidal TIFF, or add reduced'
+              ' resolution levels to --output-format ngff')
+    )
+    parser.add_argument(
+        '--output-format', default='tiff', choices=reg.OUTPUT_FORMATS,
+        help=('write TIFF files, or a single OME-Zarr (NGFF) directory store'
+              ' holding every cycle and channel (ngff); default is tiff')
     )
     # Implement default-value logic ourselves so we can detect when the user
     # has explicitly set a value.
     tile_size_default = 1024
     parser.add_argument(
         '--tile-size', type=int, default=None, metavar='PIXELS',
-        help=('set tile width and height to PIXELS (pyramid output only);'
-              ' default is {default}'.format(default=tile_size_default))
+        help=('set tile width and height to PIXELS (pyramid output only), or'
+              ' the chunk width and height for --output-format ngff; default'
+              ' is {default}'.format(default=tile_size_default))
+    )
+    parser.add_argument(
+        '--streaming', default=False, action='store_true',
+        help=('assemble and write the mosaic one block at a time instead of'
+              ' holding the whole image in memory')
+    )
+    parser.add_argument(
+        '--subpixel', default='spline', choices=reg.utils.SUBPIXEL_METHODS,
+        help=('interpolation used to place tiles at fractional pixel'
+              ' positions in the mosaic; linear and fourier are faster than'
+              ' the default spline')
+    )
+    parser.add_argument(
+        '--compression', default='none',
+        choices=reg.utils.COMPRESSION_METHODS,
+        help=('losslessly compress output images with this codec, on --workers'
+              ' threads; all but zlib need the imagecodecs package; default is'
+              ' none')
     )
     parser.add_argument(
         '--ffp', metavar='FILE', nargs='*',
@@ -96,6 +122,87 @@ def main(argv=sys.argv):
         '--plates', default=False, action='store_true',
         help='enable plate mode for HTS data'
     )
+    parser.add_argument(
+        '--threshold-tolerance', type=float, default=None, metavar='TOL',
+        help=('stop sampling the alignment error distribution once the'
+              ' confidence interval of the error threshold is within TOL'
+              ' (relative); default is to use every sample')
+    )
+    parser.add_argument(
+        '--tile-cache-mb', type=float, default=None, metavar='MB',
+        help=('limit the alignment tile cache to MB megabytes, evicting least'
+              ' recently used tiles; with --whitening tile, three quarters'
+              ' of it hold whitened tiles; default is unlimited')
+    )
+    parser.add_argument(
+        '--tile-cache-spill', default=None, metavar='DIR',
+        help=('write tiles evicted from the tile cache to DIR and read them'
+              ' back as memory-mapped files instead of decoding them again')
+    )
+    parser.add_argument(
+        '--traversal', default='hilbert',
+        choices=reg.TRAVERSAL_METHODS + ('none',),
+        help=('order in which to visit tiles during alignment so recently read'
+              ' tiles are reused from the tile cache; default is hilbert')
+    )
+    parser.add_argument(
+        '--whitening', default='window', choices=reg.WHITENING_MODES,
+        help=('whiten every registration window separately (window), the'
+              ' largest window of each edge once (edge) or each alignment tile'
+              ' once (tile); edge and tile are faster, with slightly different'
+              ' filter responses at window edges; default is window')
+    )
+    parser.add_argument(
+        '--prewhiten', default=False, action='store_true',
+        help='deprecated alias for --whitening tile'
+    )
+    parser.add_argument(
+        '--registration', default='ladder', choices=reg.REGISTRATION_MODES,
+        help=('register each edge over windows growing from the nominal'
+              ' overlap (ladder), or coarse-to-fine from a downsampled window'
+              ' covering --maximum-shift, refined at full resolution'
+              ' (pyramid); pyramid finds larger stage errors; default is'
+              ' ladder')
+    )
+    parser.add_argument(
+        '--position-solver', default='spanning_tree',
+        choices=reg.POSITION_SOLVERS,
+        help=('place tiles by summing alignments along a spanning tree'
+              ' (spanning_tree) or by a weighted least-squares fit to all'
+              ' accepted alignments (least_squares); default is spanning_tree')
+    )
+    parser.add_argument(
+        '--registration-cache', default=None, metavar='DIR',
+        help=('store edge alignments and the error threshold in DIR, keyed by'
+              ' tile contents and alignment parameters, and reuse them when'
+              ' the same tiles are aligned again')
+    )
+    parser.add_argument(
+        '--checkpoint-dir', default=None, metavar='DIR',
+        help=('save the results of each alignment stage for every cycle to'
+              ' DIR so an interrupted run can be resumed with --resume')
+    )
+    parser.add_argument(
+        '--resume', default=False, action='store_true',
+        help=('skip the alignment stages already completed by an earlier run'
+              ' with the same --checkpoint-dir and parameters')
+    )
+    parser.add_argument(
+        '--executor', default='serial', choices=reg.parallel.EXECUTORS,
+        help=('run tile alignment, mosaic assembly and pyramid building on a'
+              ' pool of threads or processes; default is serial')
+    )
+    parser.add_argument(
+        '--workers', type=int, default=None, metavar='N',
+        help=('use N workers for --executor thread or process; default is the'
+              ' number of available CPUs')
+    )
+    parser.add_argument(
+        '--pipeline-cycles', type=int, default=0, metavar='N',
+        help=('align up to N later cycles in the background while the mosaic'
+              ' of the current cycle is written; each cycle held ahead keeps'
+              ' its alignment results in memory; default is 0 (no pipelining)')
+    )
     parser.add_argument(
         '-q', '--quiet', dest='quiet', default=False, action='store_true',
         help='suppress progress display'
@@ -124,9 +231,36 @@ def main(argv=sys.argv):
         print_error("Output directory '{}' does not exist".format(output_path))
         return 1
 
-    if args.tile_size and not args.pyramid:
-        print_error("--tile-size can only be used with --pyramid")
+    ngff = args.output_format == 'ngff'
+    if args.tile_size and not (args.pyramid or ngff):
+        print_error(
+            "--tile-size can only be used with --pyramid or --output-format"
+            " ngff"
+        )
+        return 1
+    if ngff and args.compression not in reg.ngff.COMPRESSION_METHODS:
+        print_error(
+            "--output-format ngff supports --compression %s"
+            % ', '.join(reg.ngff.COMPRESSION_METHODS)
+        )
+        return 1
+    if args.workers is not None and args.workers < 1:
+        print_error("--workers must be at least 1")
+        return 1
+    if args.pipeline_cycles < 0:
+        print_error("--pipeline-cycles must not be negative")
+        return 1
+    if args.tile_cache_spill and args.tile_cache_mb is None:
+        print_error("--tile-cache-spill requires --tile-cache-mb")
         return 1
+    if args.resume and args.checkpoint_dir is None:
+        print_error("--resume requires --checkpoint-dir")
+        return 1
+    if args.prewhiten:
+        if args.whitening not in ('window', 'tile'):
+            print_error("--prewhiten is an alias for --whitening tile")
+            return 1
+        args.whitening = 'tile'
     if args.tile_size is None:
         # Implement default value logic as mentioned in argparser setup above.
         args.tile_size = tile_size_default
@@ -158,30 +292,53 @@ def main(argv=sys.argv):
     aligner_args['verbose'] = not args.quiet
     aligner_args['max_shift'] = args.maximum_shift
     aligner_args['filter_sigma'] = args.filter_sigma
+    aligner_args['threshold_tolerance'] = args.threshold_tolerance
+    if args.tile_cache_mb is not None:
+        aligner_args['tile_cache_size'] = int(args.tile_cache_mb * 2**20)
+        aligner_args['tile_cache_spill'] = args.tile_cache_spill
+    aligner_args['traversal'] = (
+        None if args.traversal == 'none' else args.traversal
+    )
+    aligner_args['whitening'] = args.whitening
+    aligner_args['registration'] = args.registration
+    aligner_args['position_solver'] = args.position_solver
+    aligner_args['cache_path'] = args.registration_cache
+    # Replaced with a per-cycle file name in process_single.
+    aligner_args['checkpoint_path'] = args.checkpoint_dir
+    aligner_args['resume'] = args.resume
+    aligner_args['executor'] = args.executor
+    aligner_args['workers'] = args.workers
 
     mosaic_args = {}
     if args.output_channels:
         mosaic_args['channels'] = args.output_channels
-    if args.pyramid:
+    if args.pyramid or ngff:
         mosaic_args['tile_size'] = args.tile_size
     if args.quiet is False:
         mosaic_args['verbose'] = True
     mosaic_args['flip_mosaic_x'] = args.flip_mosaic_x
     mosaic_args['flip_mosaic_y'] = args.flip_mosaic_y
+    if args.streaming:
+        mosaic_args['streaming'] = True
+    mosaic_args['subpixel'] = args.subpixel
+    mosaic_args['compression'] = args.compression
+    mosaic_args['output_format'] = args.output_format
+    mosaic_args['executor'] = args.executor
+    mosaic_args['workers'] = args.workers
 
     try:
         if args.plates:
             return process_plates(
                 filepaths, output_path, args.filename_format, args.flip_x,
                 args.flip_y, ffp_paths, dfp_paths, aligner_args, mosaic_args,
-                args.pyramid, args.quiet
+                args.pyramid, args.quiet, args.pipeline_cycles
             )
         else:
             mosaic_path_format = str(output_path / args.filename_format)
             return process_single(
                 filepaths, mosaic_path_format, args.flip_x, args.flip_y,
                 ffp_paths, dfp_paths, aligner_args, mosaic_args, args.pyramid,
-                args.quiet
+                args.quiet, args.pipeline_cycles
             )
     except ProcessingError as e:
         print_error(str(e))
@@ -190,19 +347,21 @@ def main(argv=sys.argv):
 
 def process_single(
     filepaths, mosaic_path_format, flip_x, flip_y, ffp_paths, dfp_paths,
-    aligner_args, mosaic_args, pyramid, quiet, plate_well=None
+    aligner_args, mosaic_args, pyramid, quiet, pipeline_cycles=0,
+    plate_well=None
 ):
 
     output_path_0 = format_cycle(mosaic_path_format, 0)
-    if pyramid:
+    ngff = mosaic_args.get('output_format') == 'ngff'
+    if pyramid or ngff:
         if output_path_0 != mosaic_path_format:
             raise ProcessingError(
-                "For pyramid output, please use -f to specify an output"
-                " filename without {cycle} or {channel} placeholders"
+                "For pyramid or NGFF output, please use -f to specify an"
+                " output filename without {cycle} or {channel} placeholders"
             )
 
     mosaic_args = mosaic_args.copy()
-    if pyramid:
+    if pyramid or ngff:
         mosaic_args['combined'] = True
     num_channels = 0
 
@@ -212,6 +371,9 @@ def process_single(
     reader = build_reader(filepaths[0], plate_well=plate_well)
     process_axis_flip(reader, flip_x, flip_y)
     ea_args = aligner_args.copy()
+    ea_args['checkpoint_path'] = cycle_checkpoint(
+        aligner_args.get('checkpoint_path'), 0, plate_well
+    )
     if len(filepaths) == 1:
         ea_args['do_make_thumbnail'] = False
     edge_aligner = reg.EdgeAligner(reader, **ea_args)
@@ -229,14 +391,38 @@ def process_single(
     mosaic.run()
     num_channels += len(mosaic.channels)
 
-    for cycle, filepath in enumerate(filepaths[1:], 1):
-        if not quiet:
+    la_args = {
+        k: v for k, v in aligner_args.items()
+        if k not in (
+            'threshold_tolerance', 'tile_cache_size', 'tile_cache_spill',
+            'traversal', 'whitening', 'registration', 'position_solver',
+            'cache_path',
+        )
+    }
+    # Cycles aligned in the background would garble the progress display of
+    # the mosaic being written, so they only report when they're written.
+    if pipeline_cycles:
+        la_args['verbose'] = False
+
+    def align_cycle(cycle, filepath):
+        if not quiet and not pipeline_cycles:
             print('Cycle %d:' % cycle)
             print('    reading %s' % filepath)
         reader = build_reader(filepath, plate_well=plate_well)
         process_axis_flip(reader, flip_x, flip_y)
-        layer_aligner = reg.LayerAligner(reader, edge_aligner, **aligner_args)
+        cycle_args = la_args.copy()
+        cycle_args['checkpoint_path'] = cycle_checkpoint(
+            aligner_args.get('checkpoint_path'), cycle, plate_well
+        )
+        layer_aligner = reg.LayerAligner(reader, edge_aligner, **cycle_args)
         layer_aligner.run()
+        return layer_aligner
+
+    def write_cycle(cycle, future):
+        layer_aligner = future.result()
+        if not quiet and pipeline_cycles:
+            print('Cycle %d:' % cycle)
+            print('    aligned %s' % filepaths[cycle])
         mosaic_args_final = mosaic_args.copy()
         if ffp_paths:
             mosaic_args_final['ffp_path'] = ffp_paths[cycle]
@@ -247,13 +433,40 @@ def process_single(
             **mosaic_args_final
         )
         mosaic.run()
-        num_channels += len(mosaic.channels)
+        return len(mosaic.channels)
 
-    if pyramid:
+    # Later cycles are aligned while a mosaic is being written, but at most
+    # pipeline_cycles of them are submitted ahead of the one being written,
+    # which bounds how many aligned cycles are held in memory.
+    if pipeline_cycles:
+        executor = reg.parallel.build_executor('thread', 1)
+    else:
+        executor = reg.parallel.SerialExecutor()
+    pending = collections.deque()
+    with executor:
+        for cycle, filepath in enumerate(filepaths[1:], 1):
+            pending.append(
+                (cycle, executor.submit(align_cycle, cycle, filepath))
+            )
+            if len(pending) > pipeline_cycles:
+                num_channels += write_cycle(*pending.popleft())
+        while pending:
+            num_channels += write_cycle(*pending.popleft())
+
+    if ngff:
+        if pyramid:
+            print("Building pyramid")
+        reg.ngff.build_multiscales(
+            output_path_0, reader.metadata.pixel_size, pyramid, not quiet,
+            mosaic_args['executor'], mosaic_args['workers']
+        )
+    elif pyramid:
         print("Building pyramid")
         reg.build_pyramid(
             output_path_0, num_channels, mshape, reader.metadata.pixel_dtype,
-            reader.metadata.pixel_size, mosaic_args['tile_size'], not quiet
+            reader.metadata.pixel_size, mosaic_args['tile_size'], not quiet,
+            mosaic_args['executor'], mosaic_args['workers'],
+            mosaic_args['compression']
         )
 
     return 0
@@ -261,7 +474,7 @@ def process_single(
 
 def process_plates(
     filepaths, output_path, filename_format, flip_x, flip_y, ffp_paths,
-    dfp_paths, aligner_args, mosaic_args, pyramid, quiet
+    dfp_paths, aligner_args, mosaic_args, pyramid, quiet, pipeline_cycles=0
 ):
 
     temp_reader = build_reader(filepaths[0])
@@ -282,7 +495,7 @@ def process_plates(
                 process_single(
                     filepaths, mosaic_path_format, flip_x, flip_y,
                     ffp_paths, dfp_paths, aligner_args, mosaic_args, pyramid,
-                    quiet, plate_well=(p, w)
+                    quiet, pipeline_cycles, plate_well=(p, w)
                 )
             else:
                 print("Skipping -- No images found.")
@@ -296,6 +509,15 @@ def format_cycle(f, cycle):
     return f.format(cycle=cycle, channel='{channel}')
 
 
+def cycle_checkpoint(checkpoint_dir, cycle, plate_well=None):
+    if checkpoint_dir is None:
+        return None
+    name = 'cycle%d.npz' % cycle
+    if plate_well is not None:
+        name = 'plate%d_well%d_%s' % (plate_well + (name,))
+    return str(pathlib.Path(checkpoint_dir) / name)
+
+
 def process_axis_flip(reader, flip_x, flip_y):
     metadata = reader.metadata
     # Trigger lazy initialization.
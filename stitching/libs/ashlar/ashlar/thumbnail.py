@@ -6,7 +6,7 @@ from skimage.transform import rescale
 from skimage.feature import register_translation
 
 
-def make_thumbnail(reader, channel=0, scale=0.05):
+def make_thumbnail(reader, channel=0, scale=0.05, verbose=True):
     metadata = reader.metadata
     positions = metadata.positions - metadata.origin
     coordinate_max = (positions + metadata.size).max(axis=0)
@@ -14,15 +14,17 @@ def make_thumbnail(reader, channel=0, scale=0.05):
     mosaic = np.zeros(mshape, dtype=np.uint16)
     total = reader.metadata.num_images
     for i in range(total):
-        sys.stdout.write("\r    assembling thumbnail %d/%d" % (i + 1, total))
-        sys.stdout.flush()
+        if verbose:
+            sys.stdout.write("\r    assembling thumbnail %d/%d" % (i + 1, total))
+            sys.stdout.flush()
         img = reader.read(c=channel, series=i)
         # We don't need anti-aliasing as long as the coarse features in the
         # images are bigger than the scale factor. This speeds up the rescaling
         # dramatically.
         img_s = rescale(img, scale, multichannel=False, anti_aliasing=False)
         utils.paste(mosaic, img_s, positions[i] * scale, np.maximum)
-    print()
+    if verbose:
+        print()
     return mosaic
 
 
@@ -33,7 +35,7 @@ def calculate_image_offset(img1, img2, upsample_factor=1):
     return shift
 
 
-def calculate_cycle_offset(reader1, reader2, scale=0.05):
+def calculate_cycle_offset(reader1, reader2, scale=0.05, verbose=True):
     if not hasattr(reader1, 'thumbnail'):
         raise ValueError('reader1 does not have a thumbnail')
     if not hasattr(reader2, 'thumbnail'):
@@ -49,10 +51,11 @@ def calculate_cycle_offset(reader1, reader2, scale=0.05):
         img2 = padded_img2
     img_offset = calculate_image_offset(img1, img2, int(1/scale)) / scale
     img_offset -= (reader2.metadata.origin - reader1.metadata.origin)
-    print(
-        '\r    estimated cycle offset [y x] =',
-        img_offset
-    )
+    if verbose:
+        print(
+            '\r    estimated cycle offset [y x] =',
+            img_offset
+        )
     return img_offset
 
 
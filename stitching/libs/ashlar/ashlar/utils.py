@@ -1,6 +1,7 @@
 import itertools
+import functools
+import threading
 import warnings
-import skimage.feature
 import skimage.io
 import skimage.restoration.uft
 import skimage.morphology
@@ -9,6 +10,10 @@ import skimage.util.dtype
 import scipy.ndimage
 import scipy.fft
 import numpy as np
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
 
 
 # Pre-calculate the Laplacian operator kernel. We'll always be using 2D images.
@@ -23,24 +28,127 @@ def whiten(img, sigma):
     return output
 
 
-def register(img1, img2, sigma, upsample=10):
+def downsample(img, factor):
+    """Reduce an image by an integer factor by averaging blocks of pixels.
+
+    Rows and columns that don't fill a whole block are dropped.
+
+    """
+    if factor == 1:
+        return img
+    h, w = np.array(img.shape) // factor
+    img = img[:h * factor, :w * factor]
+    return img.reshape(h, factor, w, factor).mean(axis=(1, 3), dtype=np.float32)
+
+
+class FFTWorkspace(object):
+    """Cache of real 2D FFT plans and buffers keyed by (shape, dtype).
+
+    Registration transforms many strips of the same few shapes, so planning
+    each shape once pays off. With pyFFTW installed, each plan owns aligned
+    input and output buffers that are reused for every call of that shape;
+    otherwise scipy.fft is used, which keeps its own internal plan cache, and
+    this only tracks which shapes have been seen. Plans are kept per thread
+    since pyFFTW plans and buffers can't be shared between threads.
+
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _plan(self, kind, shape, dtype):
+        plans = self._local.__dict__.setdefault('plans', {})
+        key = (kind, tuple(shape), np.dtype(dtype))
+        try:
+            plan = plans[key]
+            hit = True
+        except KeyError:
+            plan = plans[key] = self._build_plan(kind, shape, dtype)
+            hit = False
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return plan
+
+    @staticmethod
+    def _build_plan(kind, shape, dtype):
+        if pyfftw is None:
+            if kind == 'rfft2':
+                return scipy.fft.rfft2
+            else:
+                return functools.partial(scipy.fft.irfft2, s=shape)
+        if kind == 'rfft2':
+            buf = pyfftw.empty_aligned(shape, dtype)
+            fft = pyfftw.builders.rfft2(buf, planner_effort='FFTW_ESTIMATE')
+        else:
+            buf = pyfftw.empty_aligned((shape[0], shape[1] // 2 + 1), dtype)
+            fft = pyfftw.builders.irfft2(
+                buf, s=shape, planner_effort='FFTW_ESTIMATE'
+            )
+        # The plan's output buffer is reused, so hand out copies.
+        return lambda a: fft(a).copy()
+
+    def rfft2(self, img):
+        return self._plan('rfft2', img.shape, img.dtype)(img)
+
+    def irfft2(self, spectrum, shape):
+        return self._plan('irfft2', shape, spectrum.dtype)(spectrum)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __getstate__(self):
+        # Plans can't be pickled; each process builds its own.
+        return {'hits': 0, 'misses': 0}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def __repr__(self):
+        return (
+            '%d hits, %d misses (%.0f%% hit rate)'
+            % (self.hits, self.misses, self.hit_rate * 100)
+        )
+
+
+def register(img1, img2, sigma, upsample=10, workspace=None):
     img1w = whiten(img1, sigma)
     img2w = whiten(img2, sigma)
-    img1_f = scipy.fft.fft2(img1w)
-    img2_f = scipy.fft.fft2(img2w)
-    shift, _error, _phasediff = skimage.feature.register_translation(
-        img1_f, img2_f, upsample, 'fourier'
-    )
+    return register_whitened(img1w, img2w, upsample, workspace)
+
+
+def register_whitened(img1w, img2w, upsample=10, workspace=None):
+    """Register two images that have already been passed through `whiten`.
+
+    FFTs are taken through `workspace` (an FFTWorkspace) if one is given.
+
+    """
+    if workspace is None:
+        rfft2 = scipy.fft.rfft2
+        irfft2 = lambda a, shape: scipy.fft.irfft2(a, s=shape)
+    else:
+        rfft2 = workspace.rfft2
+        irfft2 = workspace.irfft2
+    # The whitened images are real, so we only need half of each spectrum.
+    img1_f = rfft2(img1w)
+    img2_f = rfft2(img2w)
+    shift = _phase_peak(img1_f, img2_f, img1w.shape, upsample, irfft2)
     # At this point we may have a shift in the wrong quadrant since the FFT
     # assumes the signal is periodic. We test all four possibilities and return
     # the shift that gives the highest direct correlation (sum of products).
-    shape = np.array(img1.shape)
+    shape = np.array(img1w.shape)
     shift_pos = (shift + shape) % shape
     shift_neg = shift_pos - shape
     shifts = list(itertools.product(*zip(shift_pos, shift_neg)))
     correlations = [
-        np.abs(np.sum(img1w * scipy.ndimage.shift(img2w, s, order=0)))
-        for s in shifts
+        np.abs(_shifted_product_sum(img1w, img2w, s)) for s in shifts
     ]
     idx = np.argmax(correlations)
     shift = shifts[idx]
@@ -53,9 +161,102 @@ def register(img1, img2, sigma, upsample=10):
     return shift, error
 
 
+def _phase_peak(img1_f, img2_f, shape, upsample, irfft2):
+    """Locate the cross-correlation peak given half-spectra from rfft2.
+
+    This is the algorithm of skimage's register_translation (whole-pixel peak
+    of the cross-correlation, refined by a matrix-multiply DFT upsampled
+    around it) working directly on the rfft2 half-spectra. The inverse FFT is
+    an irfft2 and the upsampling sums over the stored half of the spectrum,
+    recovering the other half from Hermitian symmetry.
+
+    """
+    product = img1_f * img2_f.conj()
+    correlation = irfft2(product, shape)
+    maxima = np.unravel_index(np.argmax(np.abs(correlation)), shape)
+    shape = np.array(shape)
+    shift = np.array(maxima, dtype=np.float64)
+    midpoints = np.fix(shape / 2)
+    shift[shift > midpoints] -= shape[shift > midpoints]
+    if upsample == 1:
+        return shift
+    shift = np.round(shift * upsample) / upsample
+    region_size = int(np.ceil(upsample * 1.5))
+    dftshift = np.fix(region_size / 2.0)
+    offset = dftshift - shift * upsample
+    correlation = _upsampled_dft_half(product, shape, region_size, upsample, offset)
+    maxima = np.unravel_index(np.argmax(np.abs(correlation)), correlation.shape)
+    return shift + (np.array(maxima, dtype=np.float64) - dftshift) / upsample
+
+
+def _upsampled_dft_half(product, shape, region_size, upsample, offset):
+    """Upsampled inverse DFT of a full spectrum given only its rfft2 half.
+
+    Equivalent to skimage's _upsampled_dft on the full cross-power spectrum
+    (conjugated in and out as register_translation does). The row transform
+    is applied to the stored columns only; the remaining columns follow from
+    Hermitian symmetry, with a rank-one correction for the Nyquist row of
+    even-height images, whose frequency is its own negative.
+
+    """
+    m, n = shape
+    freq_u = np.fft.fftfreq(m, 1 / m)
+    freq_v = np.fft.fftfreq(n, 1 / n)
+    row_kernel = np.exp(
+        (2j * np.pi / (m * upsample))
+        * np.outer(np.arange(region_size) - offset[0], freq_u)
+    )
+    col_kernel = np.exp(
+        (2j * np.pi / (n * upsample))
+        * np.outer(freq_v, np.arange(region_size) - offset[1])
+    )
+    half = row_kernel @ product
+    full = np.empty((region_size, n), complex)
+    full[:, :product.shape[1]] = half
+    # Column n - v holds the conjugate of column v, mirrored in rows. Applying
+    # the row kernel to that is the conjugate of applying it to column v,
+    # except at the Nyquist row where the mirror isn't a sign flip.
+    mirror = np.arange(1, (n + 1) // 2)
+    tail = half[:, mirror].conj()
+    if m % 2 == 0:
+        nyquist = row_kernel[:, m // 2]
+        tail += np.outer(2j * nyquist.imag, product[m // 2, mirror].conj())
+    full[:, n - mirror] = tail
+    return full @ col_kernel
+
+
+def _shifted_product_sum(img1, img2, shift):
+    """Return ``np.sum(img1 * scipy.ndimage.shift(img2, shift, order=0))``.
+
+    The nearest-neighbor shift only moves whole pixels and zeroes the pixels
+    shifted in from outside, so this is a plain sum of products over two
+    slices, without allocating the shifted image.
+
+    """
+    slices1 = []
+    slices2 = []
+    for s, size in zip(shift, img1.shape):
+        # ndimage samples img2 at i - s, rounding half up, for output pixels
+        # where that coordinate lies within [0, size - 1].
+        start = max(int(np.ceil(s)), 0)
+        stop = min(int(np.floor(size - 1 + s)), size - 1) + 1
+        if stop <= start:
+            return 0.0
+        r = int(np.ceil(s - 0.5))
+        slices1.append(slice(start, stop))
+        slices2.append(slice(start - r, stop - r))
+    return np.einsum(
+        'ij,ij->', img1[tuple(slices1)], img2[tuple(slices2)]
+    )
+
+
 def nccw(img1, img2, sigma):
     img1w = whiten(img1, sigma)
     img2w = whiten(img2, sigma)
+    return nccw_whitened(img1w, img2w)
+
+
+def nccw_whitened(img1w, img2w):
     correlation = np.abs(np.sum(img1w * img2w))
     total_amplitude = np.linalg.norm(img1w) * np.linalg.norm(img2w)
     if correlation > 0 and total_amplitude > 0:
@@ -73,6 +274,16 @@ def crop(img, offset, shape):
     return img
 
 
+# Sub-pixel shift methods for paste/place. 'spline' is scipy.ndimage.shift's
+# cubic spline, 'linear' is separable linear interpolation and 'fourier' a
+# phase ramp in frequency space.
+SUBPIXEL_METHODS = ('spline', 'linear', 'fourier')
+
+# Shared FFT plans for fourier_shift, which is called with the same tile shape
+# over and over during mosaic assembly.
+_shift_workspace = FFTWorkspace()
+
+
 # TODO:
 # - Deal with ringing from high-frequency elements. The wrapped edges of the
 #   image are especially bad, where the wrapping introduces sharp
@@ -81,53 +292,129 @@ def crop(img, offset, shape):
 #   trailing edge of the shifted result) but edges in the "true" image content
 #   would require proper pre-filtering. What filter to use, and how to apply it
 #   quickly?
-# - Can we use real FFT for a ~50% overall speedup? Fourier-space matrices will
-#   all be half-size in the last dimension, so FFT is around 50% faster and our
-#   fshift calculations will be too.
-# - Trailing edge pixels should be zeroed to match the behavior of
-#   scipy.ndimage.shift, which we rely on in our maximum-intensity projection.
-def fourier_shift(img, shift):
-    # Ensure properly aligned complex64 data (fft requires complex to avoid
-    # reallocation and copying).
+def fourier_shift(img, shift, workspace=None):
+    """Shift img by `shift` pixels using the Fourier shift theorem.
+
+    Returns a float32 image scaled as by img_as_float32. As with
+    scipy.ndimage.shift, pixels that would be sampled from outside the input
+    are set to zero rather than wrapped around. FFTs go through `workspace`
+    (an FFTWorkspace, using pyFFTW if available).
+
+    """
+    if workspace is None:
+        workspace = _shift_workspace
     img = skimage.util.img_as_float32(img)
-    img = pyfftw.byte_align(img, dtype=np.complex64)
-    # Compute per-axis frequency values according to the Fourier shift theorem.
-    # (Read "w" here as "omega".) We pre-multiply as many scalar values as
-    # possible on these vectors to avoid operations on the full w matrix below.
-    v = np.fft.fftfreq(img.shape[0])
-    wy = (2 * np.pi * v * shift[0]).astype(np.float32).reshape(-1, 1)
-    u = np.fft.fftfreq(img.shape[1])
-    wx = (2 * np.pi * u * shift[1]).astype(np.float32)
-    # Add column and row vector to get full expanded matrix of frequencies.
-    w = wy + wx
-    # We perform an explicit application of Euler's formula with careful
-    # management of output arrays to avoid extra memory allocations and copies,
-    # squeezing out some speed over the obvious np.exp(-1j*w).
-    fshift = np.empty_like(img, dtype=np.complex64)
-    np.cos(w, out=fshift.real)
-    np.sin(w, out=fshift.imag)
-    np.negative(fshift.imag, out=fshift.imag)
-    # Perform the FFT, multiply in-place by the shift matrix, then IFFT.
-    freq = pyfftw.builders.fft2(img, planner_effort='FFTW_ESTIMATE',
-                                avoid_copy=True, auto_align_input=True,
-                                auto_contiguous=True)()
-    freq *= fshift
-    img_s = pyfftw.builders.ifft2(freq, planner_effort='FFTW_ESTIMATE',
-                                  avoid_copy=True, auto_align_input=True,
-                                  auto_contiguous=True)()
-    # Any non-zero imaginary component of the resulting array is due to
-    # numerical error, so we can just return the real part.
-    # FIXME need to zero out row(s) and column(s) we shifted away from,
-    # since at this point we have a cyclic rotation rather than a shift.
-    return img_s.real
-
-
-def paste(target, img, pos, func=None):
+    # The phase ramp for a shift is separable, so rather than building the
+    # full matrix of frequencies we multiply by one complex exponential per
+    # row and one per column. Only half the spectrum exists for a real FFT.
+    # (Read "w" here as "omega".)
+    wy = 2 * np.pi * np.fft.fftfreq(img.shape[0]) * shift[0]
+    wx = 2 * np.pi * np.fft.rfftfreq(img.shape[1]) * shift[1]
+    freq = workspace.rfft2(img)
+    freq *= np.exp(-1j * wy).astype(np.complex64).reshape(-1, 1)
+    freq *= np.exp(-1j * wx).astype(np.complex64)
+    img_s = workspace.irfft2(freq, img.shape)
+    _zero_shifted_edges(img_s, shift)
+    return img_s
+
+
+def linear_shift(img, shift):
+    """Shift img by `shift` pixels using separable linear interpolation.
+
+    Equivalent to ``scipy.ndimage.shift(img, shift, order=1)`` for shifts of
+    less than one pixel, but as two passes of array arithmetic. Returns a
+    float32 image scaled as by img_as_float32.
+
+    """
+    img = skimage.util.img_as_float32(img)
+    for axis, s in enumerate(shift):
+        if s == 0:
+            continue
+        if not -1 < s < 1:
+            raise ValueError("linear_shift only supports sub-pixel shifts")
+        # Output pixel i samples the input at i - s, between i and its
+        # neighbor on the side we're shifting away from.
+        f = abs(s)
+        img = np.moveaxis(img, axis, 0)
+        # The edge row left out below is zeroed by _zero_shifted_edges, but
+        # it must not hold garbage for the pass along the other axis.
+        out = np.zeros_like(img)
+        if s > 0:
+            np.multiply(img[1:], 1 - f, out=out[1:])
+            out[1:] += f * img[:-1]
+        else:
+            np.multiply(img[:-1], 1 - f, out=out[:-1])
+            out[:-1] += f * img[1:]
+        img = np.moveaxis(out, 0, axis)
+    _zero_shifted_edges(img, shift)
+    return img
+
+
+def _zero_shifted_edges(img, shift):
+    """Zero the pixels shifted in from outside the image, in place."""
+    for axis, s in enumerate(shift):
+        n = min(int(np.ceil(abs(s))), img.shape[axis])
+        if n == 0:
+            continue
+        index = [slice(None)] * img.ndim
+        index[axis] = slice(None, n) if s > 0 else slice(-n, None)
+        img[tuple(index)] = 0
+
+
+def subpixel_shift(img, shift, method='spline'):
+    """Shift a 2D image by a fractional amount using one of SUBPIXEL_METHODS.
+
+    The spline method keeps the input dtype; the others return float32 scaled
+    as by img_as_float32.
+
+    """
+    if method == 'spline':
+        return scipy.ndimage.shift(img, shift)
+    elif method == 'linear':
+        return linear_shift(img, shift)
+    elif method == 'fourier':
+        return fourier_shift(img, shift)
+    else:
+        raise ValueError(
+            "method must be one of %s, not %r"
+            % (', '.join(SUBPIXEL_METHODS), method)
+        )
+
+
+def paste(target, img, pos, func=None, subpixel='spline'):
     """Composite img into target."""
+    placed = place(img, pos, target.shape[:2], subpixel)
+    if placed is None:
+        return
+    img, (yi, xi) = placed
+    target_slice = target[yi:yi+img.shape[0], xi:xi+img.shape[1]]
+    if np.issubdtype(img.dtype, np.floating):
+        np.clip(img, 0, 1, img)
+    img = skimage.util.dtype.convert(img, target.dtype)
+    if func is None:
+        target_slice[:] = img
+    elif isinstance(func, np.ufunc):
+        func(target_slice, img, out=target_slice)
+    else:
+        target_slice[:] = func(target_slice, img)
+
+
+def place(img, pos, shape, subpixel='spline'):
+    """Prepare img for compositing at pos into an image of the given shape.
+
+    The image is clipped to the target bounds and shifted by the fractional
+    part of pos, using the `subpixel` method (see SUBPIXEL_METHODS). Returns
+    the resulting image and the integer position of its upper-left corner, or
+    None if no part of the image would be visible.
+    Pasting the result at the returned position gives the same pixels as
+    pasting the original image at pos, so callers that composite one tile
+    into several target blocks need only do this work once.
+
+    """
     pos = np.array(pos)
     # Bail out if destination region is out of bounds.
-    if np.any(pos >= target.shape[:2]) or np.any(pos + img.shape[:2] < 0):
-        return
+    if np.any(pos >= shape) or np.any(pos + img.shape[:2] < 0):
+        return None
     pos_f, pos_i = np.modf(pos)
     yi, xi = pos_i.astype('i8')
     # Clip img to the edges of the mosaic.
@@ -137,15 +424,16 @@ def paste(target, img, pos, func=None):
     if xi < 0:
         img = img[:, -xi:]
         xi = 0
-    target_slice = target[yi:yi+img.shape[0], xi:xi+img.shape[1]]
-    img = crop_like(img, target_slice)
+    img = img[:shape[0] - yi, :shape[1] - xi]
     # Skip expensive sub-pixel shift if fractional position is zero.
     if pos_f.any():
         if img.ndim == 2:
-            img = scipy.ndimage.shift(img, pos_f)
+            img = subpixel_shift(img, pos_f, subpixel)
         else:
-            for c in range(img.shape[2]):
-                img[...,c] = scipy.ndimage.shift(img[...,c], pos_f)
+            img = np.stack([
+                subpixel_shift(img[...,c], pos_f, subpixel)
+                for c in range(img.shape[2])
+            ], axis=-1)
         # For any axis where there is a non-zero subpixel shift, crop out the
         # last row or column of pixels on the "losing" side. These pixels will
         # be darker than normal and will introduce artifacts in most blending
@@ -155,19 +443,12 @@ def paste(target, img, pos, func=None):
         x1 = None if pos_f[1] <= 0 else 1
         x2 = None if pos_f[1] >= 0 else -1
         img = img[y1:y2, x1:x2]
-        target_slice = target_slice[y1:y2, x1:x2]
+        yi += y1 or 0
+        xi += x1 or 0
         # Exit if image area is zero after subpixel shift.
         if not np.all(img.shape):
-            return
-    if np.issubdtype(img.dtype, np.floating):
-        np.clip(img, 0, 1, img)
-    img = skimage.util.dtype.convert(img, target.dtype)
-    if func is None:
-        target_slice[:] = img
-    elif isinstance(func, np.ufunc):
-        func(target_slice, img, out=target_slice)
-    else:
-        target_slice[:] = func(target_slice, img)
+            return None
+    return img, (yi, xi)
 
 
 def pastefunc_blend(target, img):
@@ -185,6 +466,101 @@ def pastefunc_blend(target, img):
     return target * alpha + img * (1 - alpha)
 
 
+@functools.lru_cache(maxsize=16)
+def feather_weights(shape):
+    """Return blending weights for a tile of the given shape.
+
+    Each pixel is weighted by its chessboard distance to the nearest tile
+    edge, counting the edge pixels themselves as 1, so overlapping tiles fade
+    linearly into each other and no pixel has zero weight. The weights depend
+    only on the tile shape, so the read-only result is cached and shared.
+
+    """
+    h, w = shape
+    wy = np.minimum(np.arange(1, h + 1), np.arange(h, 0, -1))
+    wx = np.minimum(np.arange(1, w + 1), np.arange(w, 0, -1))
+    weights = np.minimum.outer(wy, wx).astype(np.float32)
+    weights.flags.writeable = False
+    return weights
+
+
+def place_weighted(img, pos, shape, subpixel='spline'):
+    """Like `place`, but also return the matching crop of the tile's weights.
+
+    Returns ``(img, weights, (yi, xi))`` or None if no part of the image
+    would be visible.
+
+    """
+    placed = place(img, pos, shape, subpixel)
+    if placed is None:
+        return None
+    placed_img, (yi, xi) = placed
+    # place() only ever crops, so the offset of the placed image within the
+    # original tile follows from how far its origin moved from the truncated
+    # integer position.
+    y0 = yi - int(pos[0])
+    x0 = xi - int(pos[1])
+    h, w = placed_img.shape[:2]
+    weights = feather_weights(img.shape[:2])[y0:y0+h, x0:x0+w]
+    return placed_img, weights, (yi, xi)
+
+
+class WeightedBlender(object):
+    """Blend tiles into an image by feather-weighted averaging.
+
+    Each tile contributes its pixel values times `feather_weights` to a
+    running sum, and the weights themselves to a running total. `result`
+    divides the two, so pixels covered by a single tile come through
+    unchanged while overlaps get a smooth cross-fade. The cost of each paste
+    is proportional to the tile size, independent of what was pasted before.
+
+    """
+
+    def __init__(self, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.sum = np.zeros(self.shape, np.float32)
+        self.weight = np.zeros(self.shape, np.float32)
+
+    def paste(self, img, pos, subpixel='spline'):
+        placed = place_weighted(img, pos, self.shape, subpixel)
+        if placed is not None:
+            self.add(*placed)
+
+    def add(self, img, weights, pos):
+        """Add an image already prepared by `place_weighted`.
+
+        `pos` must be integral, but may put the image partly out of bounds.
+
+        """
+        yi, xi = pos
+        h, w = self.shape
+        y1, x1 = max(-yi, 0), max(-xi, 0)
+        y2 = min(img.shape[0], h - yi)
+        x2 = min(img.shape[1], w - xi)
+        if y2 <= y1 or x2 <= x1:
+            return
+        img = img[y1:y2, x1:x2]
+        weights = weights[y1:y2, x1:x2]
+        ys = slice(yi + y1, yi + y2)
+        xs = slice(xi + x1, xi + x2)
+        if np.issubdtype(img.dtype, np.floating):
+            img = np.clip(img, 0, 1)
+        img = skimage.util.dtype.convert(img, self.dtype)
+        self.sum[ys, xs] += img * weights
+        self.weight[ys, xs] += weights
+
+    def result(self):
+        """Return the blended image."""
+        out = np.divide(
+            self.sum, self.weight, out=np.zeros_like(self.sum),
+            where=self.weight > 0
+        )
+        if np.issubdtype(self.dtype, np.integer):
+            np.rint(out, out=out)
+        return out.astype(self.dtype)
+
+
 def crop_like(img, target):
     if (img.shape[0] > target.shape[0]):
         img = img[:target.shape[0], :]
@@ -193,6 +569,114 @@ def crop_like(img, target):
     return img
 
 
+# Lossless TIFF compression schemes for the output images. Apart from zlib,
+# these need the imagecodecs package.
+COMPRESSION_METHODS = ('none', 'zlib', 'zstd', 'lzw', 'jpegxr', 'ljpeg')
+
+
+def compression_kwargs(method):
+    """Return tifffile write arguments for one of COMPRESSION_METHODS.
+
+    The deflate-style schemes use horizontal differencing, which shrinks
+    smooth microscopy images considerably more than compressing raw pixels.
+    Raises ValueError if the scheme is unknown or its codec is missing.
+
+    """
+    if method not in COMPRESSION_METHODS:
+        raise ValueError(
+            "compression must be one of %s" % ', '.join(COMPRESSION_METHODS)
+        )
+    if method == 'none':
+        return {}
+    if method != 'zlib':
+        try:
+            import imagecodecs
+            available = getattr(imagecodecs, method.upper()).available
+        except (ImportError, AttributeError):
+            available = False
+        if not available:
+            raise ValueError(
+                "%s compression requires the imagecodecs package" % method
+            )
+    if method == 'jpegxr':
+        # Quality level 1 is lossless.
+        return dict(compression='jpegxr', compressionargs={'level': 1.0})
+    if method == 'ljpeg':
+        return dict(compression='jpeg', compressionargs={'lossless': True})
+    return dict(compression=method, predictor=True)
+
+
+def imsave_blocks(fname, blocks, shape, dtype, tile, **kwargs):
+    """Save an image to a tiled BigTIFF file one block at a time.
+
+    `blocks` must yield the image in row-major order as arrays of shape
+    `tile`, except at the bottom and right edges where they may be smaller.
+    Only the block being written needs to be in memory. Keyword arguments are
+    passed through as for `imsave`, plus tifffile's `compression` arguments
+    and `maxworkers`, the number of threads compressing tiles.
+
+    """
+
+    # The vendored tifffile in scikit-image can't write from an iterator, so
+    # this one path needs the standalone package.
+    import tifffile
+    append = kwargs.pop('append', False)
+    bigtiff = kwargs.pop('bigtiff', True)
+    resolution = kwargs.pop('resolution', None)
+    if resolution is not None:
+        if len(resolution) == 3:
+            units = {'cm': 'CENTIMETER', 'inch': 'INCH'}
+            kwargs['resolutionunit'] = units[resolution[2]]
+        kwargs['resolution'] = tuple(resolution[:2])
+
+    def padded(blocks):
+        for block in blocks:
+            if block.shape != tuple(tile):
+                full = np.zeros(tile, dtype)
+                full[:block.shape[0], :block.shape[1]] = block
+                block = full
+            yield block
+
+    with tifffile.TiffWriter(fname, bigtiff=bigtiff, append=append) as tw:
+        tw.write(
+            padded(blocks), shape=tuple(shape), dtype=dtype, tile=tuple(tile),
+            **kwargs
+        )
+
+
+def rewrite_blocks(fname, blocks, shape, dtype, tile, page=0):
+    """Overwrite blocks of a tiled TIFF file written by `imsave_blocks`.
+
+    `blocks` yields (index, block) pairs, where index is the block's position
+    in row-major order. The file is modified in place, so the page at index
+    `page` must be uncompressed and match `shape`, `dtype` and `tile`.
+
+    """
+    import tifffile
+    with tifffile.TiffFile(fname) as tif:
+        page = tif.pages[page]
+        if (
+            page.compression != tifffile.COMPRESSION.NONE
+            or page.shape != tuple(shape) or page.dtype != dtype
+            or (page.tilelength, page.tilewidth) != tuple(tile)
+        ):
+            raise ValueError(
+                "%s is not an uncompressed %s %s image with %s tiles"
+                % (fname, shape, np.dtype(dtype), tile)
+            )
+        offsets = page.dataoffsets
+        byte_counts = page.databytecounts
+        file_dtype = np.dtype(dtype).newbyteorder(tif.byteorder)
+    with open(fname, 'r+b') as f:
+        for index, block in blocks:
+            full = np.zeros(tile, file_dtype)
+            full[:block.shape[0], :block.shape[1]] = block
+            data = full.tobytes()
+            assert len(data) == byte_counts[index], "Unexpected tile size"
+            f.seek(offsets[index])
+            f.write(data)
+
+
 def imsave(fname, arr, **kwargs):
     """Save an image to file.
 
@@ -21,6 +21,11 @@ requires = [
     'scikit-image==0.16.2',
     'scikit-learn>=0.21.1',
     'blessed>=1.17',
+    # Standalone tifffile for block-wise (streaming) mosaic output. From
+    # 2022.7.28 codec options go in compressionargs, as compression_kwargs in
+    # utils.py passes them, rather than in deprecated tuples. It needs Python
+    # 3.8, as python_requires below declares.
+    'tifffile>=2022.7.28',
 ]
 
 
@@ -106,6 +111,8 @@ setup(
     cmdclass=versioneer.get_cmdclass(cmdclass),
     packages=find_packages(),
     include_package_data=True,
+    # multiprocessing.shared_memory (parallel.SharedArray) is new in 3.8.
+    python_requires='>=3.8',
     install_requires=requires,
     entry_points={
         'console_scripts': [
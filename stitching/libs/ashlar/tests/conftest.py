@@ -0,0 +1,49 @@
+import numpy as np
+import scipy.ndimage
+import tifffile
+import pytest
+from ashlar import filepattern
+
+PATTERN = 'img_r{row:03}_c{col:03}.tif'
+OVERLAP = 0.2
+
+
+def write_tiles(path, rows, cols, shape=(128, 160), jitter=3, seed=0):
+    """Write a grid of noisy, jittered tiles cut from one random texture.
+
+    Tiles are named after PATTERN with rows and columns starting at 1.
+    Returns the true (y, x) position of each tile in row-major order.
+
+    """
+    rng = np.random.RandomState(seed)
+    th, tw = shape
+    sy, sx = int(th * (1 - OVERLAP)), int(tw * (1 - OVERLAP))
+    margin = 2 * jitter + 1
+    h, w = sy * (rows - 1) + th + 2 * margin, sx * (cols - 1) + tw + 2 * margin
+    texture = scipy.ndimage.gaussian_filter(rng.rand(h, w), 2)
+    texture += scipy.ndimage.gaussian_filter(rng.rand(h, w) > 0.995, 1.5) * 3
+    texture = (texture - texture.min()) / (texture.max() - texture.min())
+    texture = texture * 40000 + 1000
+    positions = []
+    for r in range(rows):
+        for c in range(cols):
+            dy, dx = rng.randint(-jitter, jitter + 1, 2) + margin
+            y, x = r * sy + dy, c * sx + dx
+            tile = texture[y:y + th, x:x + tw] + rng.normal(0, 500, shape)
+            tifffile.imwrite(
+                path / PATTERN.format(row=r + 1, col=c + 1),
+                tile.clip(0, 65535).astype(np.uint16)
+            )
+            positions.append((y, x))
+    return np.array(positions)
+
+
+def open_reader(path):
+    return filepattern.FilePatternReader(path, PATTERN, OVERLAP)
+
+
+@pytest.fixture
+def tile_reader(tmp_path):
+    """A FilePatternReader over a 3x4 grid of synthetic tiles."""
+    write_tiles(tmp_path, 3, 4)
+    return open_reader(tmp_path)
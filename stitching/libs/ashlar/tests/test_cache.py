@@ -0,0 +1,68 @@
+import pickle
+import numpy as np
+from ashlar import cache, parallel
+
+
+def fill(tile_cache, count):
+    for i in range(count):
+        tile_cache.put(i, np.full((16, 16), i, np.uint16))
+
+
+def spill_in_worker(tile_cache):
+    fill(tile_cache, 4)
+    spilled = sorted(str(p) for p in tile_cache._spilled.values())
+    return str(tile_cache._spill_dir), spilled, int(tile_cache.get(0)[0, 0])
+
+
+def test_tile_cache_pickle_keeps_spill_path(tmp_path):
+    tile_cache = cache.TileCache(2 * 16 * 16 * 2, tmp_path)
+    fill(tile_cache, 4)
+    copy = pickle.loads(pickle.dumps(tile_cache))
+    assert copy.max_bytes == tile_cache.max_bytes
+    assert copy.spill_path == tile_cache.spill_path
+    # The copy starts empty and spills to a directory of its own.
+    assert len(copy) == 0 and 0 not in copy
+    assert copy._spill_dir != tile_cache._spill_dir
+    assert copy._spill_dir.parent == tmp_path
+    fill(copy, 4)
+    assert copy.spills == 2
+    assert copy.get(0)[0, 0] == 0 and copy.spill_hits == 1
+    copy.close()
+    assert not copy._spill_dir.exists()
+    assert tile_cache._spill_dir.exists()
+    tile_cache.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_tile_cache_spills_in_worker_process(tmp_path):
+    tile_cache = cache.TileCache(2 * 16 * 16 * 2, tmp_path)
+    with parallel.build_executor('process', 1) as executor:
+        spill_dir, spilled, value = executor.submit(
+            spill_in_worker, tile_cache
+        ).result()
+    assert value == 0
+    assert len(spilled) == 2
+    assert all(p.startswith(spill_dir) for p in spilled)
+    assert spill_dir != str(tile_cache._spill_dir)
+    # The worker's spill directory is removed when it exits.
+    assert sorted(p.name for p in tmp_path.iterdir()) \
+        == [tile_cache._spill_dir.name]
+    tile_cache.close()
+
+
+def test_digest_of_numpy_values(tmp_path):
+    plain = ('edge', (3, 0.5, (128, 160)), True, None, [1.25, -2.0])
+    numpy = (
+        'edge', (np.int64(3), np.float64(0.5), tuple(np.array([128, 160]))),
+        np.bool_(True), None, np.array([1.25, -2.0]),
+    )
+    assert cache.digest(*numpy) == cache.digest(*plain)
+    assert cache.digest(np.int32(3)) == cache.digest(np.uint16(3))
+    assert cache.digest(3) != cache.digest('3')
+    assert cache.digest(1, 2) != cache.digest((1, 2))
+    # Entries written under one key are found under the other.
+    registration_cache = cache.RegistrationCache(tmp_path)
+    registration_cache.put(numpy, np.arange(3))
+    np.testing.assert_array_equal(registration_cache.get(plain), np.arange(3))
+    assert cache.Checkpoint(tmp_path / 'c.npz', numpy).fingerprint \
+        == cache.Checkpoint(tmp_path / 'c.npz', plain).fingerprint
@@ -0,0 +1,158 @@
+import os
+import numpy as np
+import tifffile
+from ashlar import incremental, pyramid, reg
+from conftest import PATTERN, open_reader, write_tiles
+
+ROWS, COLS = 3, 4
+BLOCK = 64
+
+
+def align(path, state=None):
+    aligner = reg.EdgeAligner(
+        open_reader(path), filter_sigma=1, do_make_thumbnail=False
+    )
+    regions = incremental.align(aligner, state)
+    return aligner, regions
+
+
+def mosaic(aligner, shape, out):
+    return reg.Mosaic(
+        aligner, shape, str(out / 'mosaic_{channel}.tif'), streaming=True,
+        tile_size=BLOCK
+    )
+
+
+def render(aligner, shape, out):
+    out.mkdir(exist_ok=True)
+    m = mosaic(aligner, shape, out)
+    m.run(mode='write')
+    m.write_levels()
+    return out / 'mosaic_0.tif'
+
+
+def read_levels(path):
+    with tifffile.TiffFile(path) as tif:
+        return [page.asarray() for page in tif.pages]
+
+
+def assert_same_mosaic(path, expected_path):
+    """Compare two mosaic files, including their reduced levels."""
+    assert pyramid.has_levels(path)
+    levels = read_levels(path)
+    expected = read_levels(expected_path)
+    assert len(levels) == len(expected) > 1
+    for level, expected_level in zip(levels, expected):
+        np.testing.assert_array_equal(level, expected_level)
+
+
+def relative(positions):
+    return positions - positions[0]
+
+
+def restitch(tmp_path, change):
+    """Stitch the tiles in tmp_path/tiles, call `change` on their directory
+    and stitch again incrementally, updating the mosaic in place if possible.
+
+    Returns the tile positions before the change, by tile key, and the
+    aligner and regions of the incremental run.
+
+    """
+    tiles = tmp_path / 'tiles'
+    out = tmp_path / 'out'
+    aligner, regions = align(tiles)
+    assert regions is None
+    shape = aligner.mosaic_shape
+    render(aligner, shape, out)
+    incremental.StitchState(aligner, shape).save(tmp_path / 'state.npz')
+    before = dict(zip(
+        incremental.tile_keys(aligner.metadata), aligner.positions.tolist()
+    ))
+    change(tiles)
+    state = incremental.StitchState.load(tmp_path / 'state.npz')
+    assert state is not None and state.shape == tuple(shape)
+    aligner, regions = align(tiles, state)
+    if regions is None:
+        render(aligner, aligner.mosaic_shape, out)
+    else:
+        blocks = -(-shape[0] // BLOCK) * -(-shape[1] // BLOCK)
+        updated = mosaic(aligner, state.shape, out).update(regions)
+        assert 0 < updated < blocks
+    return before, aligner, regions
+
+
+def check_unchanged(before, aligner, changed):
+    """Tiles other than `changed` keep their places relative to each other."""
+    keys = incremental.tile_keys(aligner.metadata)
+    assert set(before) <= set(keys)
+    assert {i for i, k in enumerate(keys) if k not in before} <= set(changed)
+    unchanged = [i for i in range(len(keys)) if i not in changed]
+    old = np.array([before[keys[i]] for i in unchanged])
+    new = aligner.positions[unchanged]
+    np.testing.assert_array_equal(new - new[0], old - old[0])
+
+
+def check_against_full(tmp_path, aligner, atol):
+    """The mosaic is the one a from-scratch render of the incremental
+    positions gives, and those are within `atol` of a full re-stitch."""
+    path = tmp_path / 'out' / 'mosaic_0.tif'
+    with tifffile.TiffFile(path) as tif:
+        shape = tif.pages[0].shape
+    expected = render(aligner, shape, tmp_path / 'expected')
+    assert_same_mosaic(path, expected)
+    # Rendering the full re-stitch isn't compared pixel for pixel: positions
+    # summed along different paths differ in the last bits, which can move a
+    # tile a whole pixel when it sits exactly on a pixel boundary.
+    full, regions = align(tmp_path / 'tiles')
+    assert regions is None
+    np.testing.assert_allclose(
+        relative(aligner.positions), relative(full.positions), atol=atol
+    )
+
+
+def test_replace_tile(tmp_path):
+    tiles = tmp_path / 'tiles'
+    tiles.mkdir()
+    truth = write_tiles(tiles, ROWS, COLS)
+    name = PATTERN.format(row=2, col=3)
+
+    def change(tiles):
+        img = tifffile.imread(tiles / name)
+        img[40:70, 50:90] = 60000
+        tifffile.imwrite(tiles / name, img)
+
+    before, aligner, regions = restitch(tmp_path, change)
+    assert regions is not None
+    check_unchanged(before, aligner, [(2 - 1) * COLS + (3 - 1)])
+    check_against_full(tmp_path, aligner, atol=1e-9)
+    np.testing.assert_allclose(
+        relative(aligner.positions), relative(truth), atol=1
+    )
+
+
+def test_add_row(tmp_path):
+    tiles = tmp_path / 'tiles'
+    tiles.mkdir()
+    truth = write_tiles(tiles, ROWS, COLS)
+    added = tmp_path / 'added'
+    added.mkdir()
+    for col in range(1, COLS + 1):
+        name = PATTERN.format(row=ROWS, col=col)
+        os.rename(tiles / name, added / name)
+
+    def change(tiles):
+        for path in added.iterdir():
+            os.rename(path, tiles / path.name)
+
+    before, aligner, regions = restitch(tmp_path, change)
+    # The mosaic grows, so it is rendered again from the new positions.
+    assert regions is None
+    check_unchanged(
+        before, aligner, range((ROWS - 1) * COLS, ROWS * COLS)
+    )
+    # New tiles are placed from their neighbors rather than along the
+    # spanning tree of a full re-stitch, so they may land slightly apart.
+    check_against_full(tmp_path, aligner, atol=0.5)
+    np.testing.assert_allclose(
+        relative(aligner.positions), relative(truth), atol=1
+    )
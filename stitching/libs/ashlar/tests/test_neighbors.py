@@ -0,0 +1,61 @@
+import types
+import numpy as np
+import scipy.spatial.distance
+import networkx as nx
+import pytest
+from ashlar import reg
+
+
+def fake_aligner(positions, size):
+    metadata = types.SimpleNamespace(
+        positions=positions, size=np.array(size),
+        num_images=len(positions),
+    )
+    return types.SimpleNamespace(metadata=metadata)
+
+
+def reference_graph(positions, size):
+    """neighbors_graph as built from the full distance matrix."""
+    pdist = scipy.spatial.distance.pdist(positions, metric='cityblock')
+    sp = scipy.spatial.distance.squareform(pdist)
+    max_distance = np.max(size) + 1
+    graph = nx.from_edgelist(zip(*np.nonzero((sp > 0) & (sp < max_distance))))
+    graph.add_nodes_from(range(len(positions)))
+    return graph
+
+
+def irregular_grid(seed, rows=9, cols=11, size=(200, 300)):
+    rng = np.random.RandomState(seed)
+    step = np.array(size) * 0.85
+    grid = np.array([(r, c) for r in range(rows) for c in range(cols)]) * step
+    positions = grid + rng.uniform(-40, 40, grid.shape)
+    if seed % 2:
+        # Round like stage coordinates and shuffle the acquisition order.
+        positions = np.round(positions)
+        positions = positions[rng.permutation(len(positions))]
+    # Drop some tiles, as around the edges of irregular tissue.
+    positions = positions[rng.rand(len(positions)) > 0.2]
+    # Coincident and isolated tiles.
+    positions = np.vstack([positions, positions[:2], [[5000.0, 8000.0]]])
+    return positions
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_neighbors_graph_matches_distance_matrix(seed):
+    size = (200, 300)
+    positions = irregular_grid(seed, size=size)
+    graph = reg.neighbors_graph.fget(fake_aligner(positions, size))
+    expected = reference_graph(positions, size)
+    assert list(graph.nodes) == list(expected.nodes)
+    assert list(graph.edges) == list(expected.edges)
+    for i, j in graph.edges:
+        np.testing.assert_array_equal(
+            graph.edges[i, j]['overlap'],
+            np.array(size) - np.abs(positions[i] - positions[j])
+        )
+
+
+def test_neighbors_graph_is_cached():
+    aligner = fake_aligner(irregular_grid(0), (200, 300))
+    graph = reg.neighbors_graph.fget(aligner)
+    assert reg.neighbors_graph.fget(aligner) is graph
@@ -0,0 +1,199 @@
+import os
+import json
+import numpy as np
+import pytest
+import tifffile
+from ashlar import ngff, pyramid, reg
+from conftest import open_reader
+
+CHUNK = 64
+
+
+def blocks(img, size=CHUNK):
+    return pyramid.strip_blocks(pyramid.array_strips(img, size), size)
+
+
+def make_channels(shape, num_channels, seed=0):
+    rng = np.random.RandomState(seed)
+    return [
+        rng.randint(0, 65536, shape).astype(np.uint16)
+        for _ in range(num_channels)
+    ]
+
+
+def write_store(path, channels, compression='none'):
+    ngff.create(path)
+    for c, img in enumerate(channels):
+        channel = ngff.write_channel(
+            path, blocks(img), img.shape, img.dtype, CHUNK, compression,
+            workers=2
+        )
+        assert channel == c
+
+
+SHAPES = [(300, 470), (64, 64), (65, 1), (200, 129)]
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+def test_read_rows_round_trip(tmp_path, shape, compression):
+    path = str(tmp_path / 'store.zarr')
+    channels = make_channels(shape, 2)
+    write_store(path, channels, compression)
+    array = ngff.ZarrArray(os.path.join(path, '0'))
+    assert array.shape == (2,) + shape
+    assert array.chunks == (1, CHUNK, CHUNK)
+    assert array.compression == compression
+    rows, cols = array.grid
+    assert (rows, cols) == (-(-shape[0] // CHUNK), -(-shape[1] // CHUNK))
+    h, w = shape
+    ranges = [(0, h), (0, 1), (h - 1, h), (h // 3, h - h // 4)]
+    ranges += [(CHUNK - 1, CHUNK + 1), (CHUNK, 2 * CHUNK)]
+    for c, img in enumerate(channels):
+        # Edge chunks are stored padded to the full chunk size with zeros.
+        chunk = array.read_chunk(c, rows - 1, cols - 1)
+        assert chunk.shape == (CHUNK, CHUNK)
+        y, x = (rows - 1) * CHUNK, (cols - 1) * CHUNK
+        np.testing.assert_array_equal(chunk[:h - y, :w - x], img[y:, x:])
+        assert not chunk[h - y:].any() and not chunk[:, w - x:].any()
+        for y1, y2 in ranges:
+            y2 = min(y2, h)
+            if y1 >= y2:
+                continue
+            np.testing.assert_array_equal(
+                array.read_rows(c, y1, y2), img[y1:y2]
+            )
+
+
+def test_missing_chunks_read_as_fill_value(tmp_path):
+    path = str(tmp_path / 'store.zarr')
+    img = make_channels((150, 150), 1)[0]
+    write_store(path, [img])
+    os.remove(os.path.join(path, '0', '0', '1', '2'))
+    array = ngff.ZarrArray(os.path.join(path, '0'))
+    expected = img.copy()
+    expected[CHUNK:2 * CHUNK, 2 * CHUNK:] = 0
+    np.testing.assert_array_equal(array.read_rows(0, 0, 150), expected)
+
+
+def test_write_channel_checks_shape(tmp_path):
+    path = str(tmp_path / 'store.zarr')
+    write_store(path, make_channels((100, 100), 1))
+    img = make_channels((100, 101), 1)[0]
+    with pytest.raises(ValueError):
+        ngff.write_channel(path, blocks(img), img.shape, img.dtype, CHUNK)
+
+
+@pytest.mark.parametrize('executor', ['serial', 'thread', 'process'])
+@pytest.mark.parametrize('shape', [(300, 470), (517, 129)])
+def test_build_multiscales(tmp_path, executor, shape):
+    path = str(tmp_path / 'store.zarr')
+    channels = make_channels(shape, 2)
+    write_store(path, channels, 'zlib')
+    ngff.build_multiscales(path, 0.5, executor=executor, workers=2)
+    shapes = pyramid.level_shapes(shape, CHUNK)
+    assert len(shapes) > 2
+    for c, img in enumerate(channels):
+        expected = img
+        for level, level_shape in enumerate(shapes):
+            array = ngff.ZarrArray(os.path.join(path, str(level)))
+            assert array.shape == (2,) + tuple(level_shape)
+            assert array.compression == 'zlib'
+            np.testing.assert_array_equal(
+                array.read_rows(c, 0, array.shape[1]), expected
+            )
+            expected = pyramid.reduce_block(expected)
+    with open(os.path.join(path, '.zattrs')) as f:
+        multiscales = json.load(f)['multiscales'][0]
+    assert [d['path'] for d in multiscales['datasets']] \
+        == [str(i) for i in range(len(shapes))]
+    scales = [
+        d['coordinateTransformations'][0]['scale']
+        for d in multiscales['datasets']
+    ]
+    assert scales == [
+        [1.0, 0.5 * 2 ** i, 0.5 * 2 ** i] for i in range(len(shapes))
+    ]
+
+
+def test_build_multiscales_without_levels(tmp_path):
+    path = str(tmp_path / 'store.zarr')
+    write_store(path, make_channels((300, 470), 1))
+    ngff.build_multiscales(path, 1.0, levels=False)
+    with open(os.path.join(path, '.zattrs')) as f:
+        datasets = json.load(f)['multiscales'][0]['datasets']
+    assert [d['path'] for d in datasets] == ['0']
+    assert not os.path.exists(os.path.join(path, '1'))
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_mosaic_ngff(tmp_path, tile_reader, streaming):
+    aligner = reg.EdgeAligner(
+        tile_reader, filter_sigma=1, do_make_thumbnail=False
+    )
+    aligner.run()
+    shape = aligner.mosaic_shape
+    expected = reg.Mosaic(
+        aligner, shape, str(tmp_path / 'unused_{channel}.tif')
+    ).run(mode='return')[0]
+    path = str(tmp_path / 'mosaic_{channel}.zarr')
+    reg.Mosaic(
+        aligner, shape, path, tile_size=CHUNK, streaming=streaming,
+        output_format='ngff'
+    ).run(mode='write')
+    ngff.build_multiscales(path.format(channel=0), 1.0)
+    array = ngff.ZarrArray(os.path.join(path.format(channel=0), '0'))
+    assert array.shape == (1,) + tuple(shape)
+    np.testing.assert_array_equal(array.read_rows(0, 0, shape[0]), expected)
+    level = ngff.ZarrArray(os.path.join(path.format(channel=0), '1'))
+    np.testing.assert_array_equal(
+        level.read_rows(0, 0, level.shape[1]), pyramid.reduce_block(expected)
+    )
+
+
+def test_mosaic_update_levels(tmp_path, tile_reader):
+    aligner = reg.EdgeAligner(
+        tile_reader, filter_sigma=1, do_make_thumbnail=False
+    )
+    aligner.run()
+    shape = aligner.mosaic_shape
+
+    def write(path):
+        reg.Mosaic(
+            aligner, shape, path, tile_size=CHUNK, streaming=True,
+            output_format='ngff'
+        ).run(mode='write')
+        ngff.build_multiscales(path.format(channel=0), 1.0)
+
+    path = str(tmp_path / 'mosaic_{channel}.zarr')
+    write(path)
+    # Replace one tile and redraw where it lies.
+    tile = 5
+    name = tile_reader.path / tile_reader.filename(tile, 0)
+    img = tifffile.imread(name)
+    img[20:60, 30:90] = 60000
+    tifffile.imwrite(name, img)
+    # A new aligner, so the tile isn't served from the old one's cache.
+    positions = aligner.positions
+    aligner = reg.EdgeAligner(
+        open_reader(tile_reader.path), do_make_thumbnail=False
+    )
+    aligner.positions = positions
+    position = positions[tile]
+    updated = reg.Mosaic(
+        aligner, shape, path, tile_size=CHUNK, streaming=True,
+        output_format='ngff'
+    ).update([(position, position + aligner.metadata.size)])
+    assert updated > 0
+    expected = str(tmp_path / 'expected_{channel}.zarr')
+    write(expected)
+    store, expected = path.format(channel=0), expected.format(channel=0)
+    num_levels = len(pyramid.level_shapes(shape, CHUNK))
+    assert num_levels > 2
+    for level in range(num_levels):
+        array = ngff.ZarrArray(os.path.join(store, str(level)))
+        reference = ngff.ZarrArray(os.path.join(expected, str(level)))
+        np.testing.assert_array_equal(
+            array.read_rows(0, 0, array.shape[1]),
+            reference.read_rows(0, 0, reference.shape[1])
+        )
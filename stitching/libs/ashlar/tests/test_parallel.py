@@ -0,0 +1,54 @@
+import pickle
+import numpy as np
+import pytest
+from ashlar import parallel, reg
+
+
+def align(reader, executor, workers=None):
+    aligner = reg.EdgeAligner(
+        reader, filter_sigma=1, do_make_thumbnail=False, executor=executor,
+        workers=workers
+    )
+    aligner.run()
+    return aligner
+
+
+def fill_shared(shared, value):
+    shared.array[:] = value
+    return float(shared.array.sum())
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_executors_match_serial(tile_reader, executor):
+    expected = align(tile_reader, 'serial')
+    aligner = align(tile_reader, executor, workers=2)
+    assert aligner.max_error == expected.max_error
+    np.testing.assert_array_equal(
+        aligner.errors_negative_sampled, expected.errors_negative_sampled
+    )
+    assert sorted(aligner._cache) == sorted(expected._cache)
+    for key, (shift, error) in expected._cache.items():
+        np.testing.assert_array_equal(aligner._cache[key][0], shift)
+        assert aligner._cache[key][1] == error
+    np.testing.assert_array_equal(aligner.positions, expected.positions)
+
+
+def test_shared_array_pickle():
+    shared = parallel.SharedArray((3, 5), np.uint16)
+    try:
+        shared.array[:] = np.arange(15).reshape(3, 5)
+        copy = pickle.loads(pickle.dumps(shared))
+        assert copy.shape == (3, 5) and copy.dtype == np.uint16
+        np.testing.assert_array_equal(copy.array, shared.array)
+        # The copy attaches to the same memory rather than holding the data.
+        assert len(pickle.dumps(shared)) < shared.array.nbytes + 100
+        copy.array[0, 0] = 99
+        assert shared.array[0, 0] == 99
+        copy.close()
+        # A spawned worker process writes through to the parent's array.
+        with parallel.build_executor('process', 1) as executor:
+            total = executor.submit(fill_shared, shared, 7).result()
+        assert total == 7 * 15
+        assert (shared.array == 7).all()
+    finally:
+        shared.close()
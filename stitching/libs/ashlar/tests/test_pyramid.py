@@ -0,0 +1,113 @@
+import numpy as np
+import tifffile
+import pytest
+from ashlar import pyramid, utils
+
+TILE = 64
+
+
+def reference_reduce(img):
+    """2x2 mean, rounded half up for integers, with odd edges repeated."""
+    h, w = img.shape
+    img = np.pad(img, ((0, h % 2), (0, w % 2)), mode='edge')
+    total = img.reshape(img.shape[0] // 2, 2, img.shape[1] // 2, 2)
+    if img.dtype.kind == 'f':
+        total = total.astype(np.float64).sum(axis=(1, 3))
+        return (total / 4).astype(img.dtype)
+    total = total.astype(np.int64).sum(axis=(1, 3))
+    return ((total + 2) // 4).astype(img.dtype)
+
+
+def assert_same(actual, expected):
+    """Integer levels must match exactly; float ones up to summation order."""
+    assert actual.dtype == expected.dtype and actual.shape == expected.shape
+    if expected.dtype.kind == 'f':
+        np.testing.assert_allclose(actual, expected, rtol=1e-6)
+    else:
+        np.testing.assert_array_equal(actual, expected)
+
+
+def reference_levels(img, tile_size):
+    levels = [img]
+    while max(levels[-1].shape) > tile_size:
+        levels.append(reference_reduce(levels[-1]))
+    return levels
+
+
+def make_channels(shape, dtype, num_channels, seed=0):
+    rng = np.random.RandomState(seed)
+    if np.dtype(dtype).kind == 'f':
+        return [rng.rand(*shape).astype(dtype) for _ in range(num_channels)]
+    info = np.iinfo(dtype)
+    return [
+        rng.randint(info.min, info.max + 1, shape).astype(dtype)
+        for _ in range(num_channels)
+    ]
+
+
+def write_base(path, channels, compression='none'):
+    for i, img in enumerate(channels):
+        blocks = pyramid.strip_blocks(pyramid.array_strips(img, TILE), TILE)
+        utils.imsave_blocks(
+            path, blocks, img.shape, img.dtype, (TILE, TILE), append=i > 0,
+            photometric='minisblack', metadata=None,
+            **utils.compression_kwargs(compression)
+        )
+
+
+SHAPES = [(517, 1029), (600, 333), (64, 65), (10, 10)]
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+def test_reduce_block(shape, dtype):
+    img = make_channels(shape, dtype, 1)[0]
+    assert_same(pyramid.reduce_block(img), reference_reduce(img))
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_reduce_channel(tmp_path, shape):
+    img = make_channels(shape, np.uint16, 1)[0]
+    path = tmp_path / 'base.tif'
+    write_base(path, [img])
+    expected = reference_levels(img, TILE)
+    shapes = pyramid.level_shapes(shape, TILE)
+    assert [tuple(s) for s in shapes] == [e.shape for e in expected]
+    if len(shapes) < 2:
+        return
+    spills = [np.zeros(s, img.dtype) for s in shapes[2:]]
+    with tifffile.TiffFile(path) as tif:
+        tiles = list(pyramid.reduce_channel(tif.pages[0], TILE, spills))
+    rows, cols = (-(-s // TILE) for s in shapes[1])
+    assert len(tiles) == rows * cols
+    level1 = np.vstack([
+        np.hstack(tiles[r * cols:(r + 1) * cols]) for r in range(rows)
+    ])
+    np.testing.assert_array_equal(level1, expected[1])
+    for spill, level in zip(spills, expected[2:]):
+        np.testing.assert_array_equal(spill, level)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('executor', ['serial', 'thread', 'process'])
+@pytest.mark.parametrize(
+    'dtype, compression', [(np.uint16, 'none'), (np.float32, 'zlib')]
+)
+def test_write_levels(tmp_path, shape, executor, dtype, compression):
+    channels = make_channels(shape, dtype, 2)
+    path = tmp_path / 'pyramid.tif'
+    write_base(path, channels, compression)
+    shapes = pyramid.level_shapes(shape, TILE)
+    pyramid.write_levels(
+        path, len(channels), shapes, np.dtype(dtype), TILE,
+        executor=executor, workers=2, compression=compression
+    )
+    expected = [reference_levels(img, TILE) for img in channels]
+    with tifffile.TiffFile(path) as tif:
+        assert len(tif.pages) == len(shapes) * len(channels)
+        # All channels of a level come before the next level.
+        for i, page in enumerate(tif.pages):
+            level, c = divmod(i, len(channels))
+            assert_same(page.asarray(), expected[c][level])
+    # Temporary files are removed.
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['pyramid.tif']
@@ -0,0 +1,102 @@
+import itertools
+import numpy as np
+import scipy.fft
+import scipy.ndimage
+import pytest
+from ashlar import utils
+
+try:
+    from skimage.registration import phase_cross_correlation
+except ImportError:
+    # scikit-image < 0.17
+    from skimage.feature import register_translation as phase_cross_correlation
+
+
+def reference_peak(img1_f, img2_f, upsample):
+    """Peak from skimage on the full spectra, as register used to find it."""
+    try:
+        result = phase_cross_correlation(
+            img1_f, img2_f, upsample_factor=upsample, space='fourier',
+            normalization=None
+        )
+    except TypeError:
+        # No normalization option before scikit-image 0.19.
+        result = phase_cross_correlation(
+            img1_f, img2_f, upsample_factor=upsample, space='fourier'
+        )
+    return result[0]
+
+
+def reference_register(img1, img2, sigma, upsample=10):
+    """register as written before it switched to rfft2."""
+    img1w = utils.whiten(img1, sigma)
+    img2w = utils.whiten(img2, sigma)
+    shift = reference_peak(
+        scipy.fft.fft2(img1w), scipy.fft.fft2(img2w), upsample
+    )
+    shape = np.array(img1.shape)
+    shift_pos = (shift + shape) % shape
+    shift_neg = shift_pos - shape
+    shifts = list(itertools.product(*zip(shift_pos, shift_neg)))
+    correlations = [
+        np.abs(np.sum(img1w * scipy.ndimage.shift(img2w, s, order=0)))
+        for s in shifts
+    ]
+    idx = np.argmax(correlations)
+    total_amplitude = np.linalg.norm(img1w) * np.linalg.norm(img2w)
+    return shifts[idx], -np.log(correlations[idx] / total_amplitude)
+
+
+def shifted_pair(shape, shift, seed):
+    """Two noisy views of a random texture, the second moved by `shift`."""
+    rng = np.random.RandomState(seed)
+    h, w = shape
+    field = scipy.ndimage.gaussian_filter(rng.rand(h + 40, w + 40), 2)
+    moved = scipy.ndimage.shift(field, shift, order=3, mode='wrap')
+    img1 = field[20:20 + h, 20:20 + w] + rng.normal(0, 0.01, shape)
+    img2 = moved[20:20 + h, 20:20 + w] + rng.normal(0, 0.01, shape)
+    return img1.astype(np.float32), img2.astype(np.float32)
+
+
+SHAPES = [(64, 80), (63, 81), (50, 51), (96, 33)]
+SHIFTS = [(0, 0), (3, -7), (-12.3, 5.6), (8.5, -0.5), (-19.9, 14.2)]
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('shift', SHIFTS)
+def test_register_matches_skimage(shape, shift):
+    img1, img2 = shifted_pair(shape, shift, seed=0)
+    expected_shift, expected_error = reference_register(img1, img2, 1)
+    for workspace in (None, utils.FFTWorkspace()):
+        got_shift, got_error = utils.register(
+            img1, img2, 1, workspace=workspace
+        )
+        np.testing.assert_allclose(got_shift, expected_shift, atol=1e-6)
+        np.testing.assert_allclose(got_error, expected_error, rtol=1e-5)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('upsample', [1, 10, 7])
+def test_phase_peak_matches_skimage(shape, upsample):
+    img1, img2 = shifted_pair(shape, (-6.4, 9.3), seed=1)
+    expected = reference_peak(
+        scipy.fft.fft2(img1), scipy.fft.fft2(img2), upsample
+    )
+    got = utils._phase_peak(
+        scipy.fft.rfft2(img1), scipy.fft.rfft2(img2), shape, upsample,
+        lambda a, s: scipy.fft.irfft2(a, s=s)
+    )
+    np.testing.assert_allclose(got, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    'shift', [(0, 0), (2, -3), (-4.5, 0.5), (5.49, -6.51), (-30, 2), (60, 0)]
+)
+def test_shifted_product_sum(shift):
+    rng = np.random.RandomState(0)
+    img1 = rng.rand(31, 40)
+    img2 = rng.rand(31, 40)
+    expected = np.sum(img1 * scipy.ndimage.shift(img2, shift, order=0))
+    np.testing.assert_allclose(
+        utils._shifted_product_sum(img1, img2, shift), expected, rtol=1e-12
+    )
@@ -7,13 +7,28 @@ from celery_tasks.tasks import StitchingCeleryTask
 from celery_tasks.utils import create_worker_from
 
 from ashlar import filepattern
+from ashlar import incremental
+from ashlar import pyramid
 from ashlar import reg
 
+# Shared volume (see docker-compose.yml). Edge registrations are cached here
+# so retried and repeated stitching jobs skip straight to the mosaic.
+CACHE_PATH = Path('/cache-storage')
+REGISTRATION_CACHE_PATH = CACHE_PATH / 'ashlar' / 'registration'
+# Written next to the mosaic so the next run can update it incrementally.
+STATE_FILE_NAME = 'stitch_state.npz'
 
-def ashlar_stitch(tiles, pattern):
+
+def ashlar_stitch(tiles, pattern, full=False):
     """
     Stitches tiles using the Ashlar library.
 
+    Tiles are uploaded to /cache-storage/<user>/tiles in batches, and the
+    mosaic is written to /cache-storage/<user>/stitched. When a previous
+    result exists there, only edges touching new or replaced tiles are
+    registered and only the affected parts of the mosaic are rewritten,
+    unless `full` is set.
+
     Separate function for testing purposes
     """
 
@@ -21,37 +36,58 @@ def ashlar_stitch(tiles, pattern):
     tiles = [json.loads(t) for t in tiles]
 
     tile_folder = Path(tiles[0].get("absolute_path")).parent
+    output_folder = tile_folder.parent / "stitched"
+    output_folder.mkdir(parents=True, exist_ok=True)
+    out_file_format = str(output_folder / "stitched_{channel}.tif")
+    state_path = output_folder / STATE_FILE_NAME
 
     reader = filepattern.FilePatternReader(path=str(tile_folder),
                                            pattern=pattern, overlap=0.2)
+    state = None
+    outputs = [Path(out_file_format.format(channel=c))
+               for c in range(reader.metadata.num_channels)]
+    # Files from before reduced levels were written are rebuilt in full, so
+    # the tile server never has to reduce a whole mosaic itself.
+    if not full and all(p.exists() and pyramid.has_levels(p) for p in outputs):
+        state = incremental.StitchState.load(state_path)
+
     start = time.perf_counter()
     # perform actual alignment
     aligner = reg.EdgeAligner(reader, channel=0, filter_sigma=10, max_shift=500, verbose=True,
-                              do_make_thumbnail=True, permutations_multiplier=1)
+                              do_make_thumbnail=False, permutations_multiplier=1,
+                              cache_path=REGISTRATION_CACHE_PATH)
     # aligner = reg.EdgeAligner(reader, channel=0, filter_sigma=10, verbose=True, do_make_thumbnail=True)
-    aligner.run()
+    regions = incremental.align(aligner, state)
 
     print(f"EdgeAligner took: {time.perf_counter() - start: 0.4f} seconds")
 
     # generate stitched file
     start = time.perf_counter()
 
-    out_file_format = "stitched_{channel}.tif"
-
-    mosaic = reg.Mosaic(
-        aligner=aligner,
-        shape=aligner.mosaic_shape,
-        filename_format=out_file_format
-    )
-
-    # output result to array in python -> need to perform cropping
-    
-    merged = mosaic.run(mode='return')
-    merged = mosaic.run(mode='write')
+    # Streaming output is an uncompressed tiled TIFF, which lets later
+    # incremental runs rewrite just the tiles that changed. The reduced
+    # levels served to zoomed-out viewers are appended to each file and
+    # updated along with it.
+    if regions is None:
+        mosaic = reg.Mosaic(
+            aligner=aligner,
+            shape=aligner.mosaic_shape,
+            filename_format=out_file_format,
+            streaming=True
+        )
+        mosaic.run(mode='write')
+        mosaic.write_levels()
+    else:
+        mosaic = reg.Mosaic(
+            aligner=aligner,
+            shape=state.shape,
+            filename_format=out_file_format,
+            streaming=True
+        )
+        mosaic.update(regions)
+    incremental.StitchState(aligner, mosaic.shape).save(state_path)
     print(f"mosaic took: {time.perf_counter() - start: 0.4f} seconds")
 
-    # merged_array = np.array(merged)
-
     return {'foo': 123}
 
 